@@ -1,12 +1,38 @@
 import asyncio
 import aiohttp
+import json
 import logging
+import os
+import random
 from typing import List, Dict, Any
 
+from protocol_client import ProtocolClient
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Адрес сервера
+SERVER_URL = os.getenv("SERVER_URL", "http://server:8080").rstrip('/')
+# Протокол операций над ВМ: http или tcp (списки всегда запрашиваются по HTTP)
+CLIENT_PROTOCOL = os.getenv("CLIENT_PROTOCOL", "http")
+# Адрес протокола TCP сервера
+SERVER_PROTOCOL_ADDR = os.getenv("SERVER_PROTOCOL_ADDR", "server:8081")
+# Число ВМ, которые обрабатываются одновременно
+CLIENT_CONCURRENCY = int(os.getenv("CLIENT_CONCURRENCY", "10"))
+# Максимальное число соединений с сервером, которые переиспользуются между запросами
+CLIENT_CONNECTION_LIMIT = int(os.getenv("CLIENT_CONNECTION_LIMIT", str(CLIENT_CONCURRENCY)))
+CLIENT_KEEPALIVE_TIMEOUT = float(os.getenv("CLIENT_KEEPALIVE_TIMEOUT", "30"))
+# Таймаут одного запроса, секунды
+CLIENT_TIMEOUT = float(os.getenv("CLIENT_TIMEOUT", "10"))
+# Число повторов запроса после ошибки и параметры экспоненциальной задержки между ними, секунды
+CLIENT_RETRIES = int(os.getenv("CLIENT_RETRIES", "3"))
+CLIENT_BACKOFF_BASE = float(os.getenv("CLIENT_BACKOFF_BASE", "0.2"))
+CLIENT_BACKOFF_MAX = float(os.getenv("CLIENT_BACKOFF_MAX", "5"))
+
+# Ответы, после которых запрос стоит повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 # Список виртуальных машин для тестирования
 VIRTUAL_MACHINES = [
     {"vm_id": "vm-1", "ram": 1024, "cpu": 2, "disks": [{"disk_id": "disk-1", "size": 500}]},
@@ -21,102 +47,156 @@ VIRTUAL_MACHINES = [
     {"vm_id": "vm-10", "ram": 8192, "cpu": 4, "disks": [{"disk_id": "disk-10", "size": 1000}]}
 ]
 
-async def add_vm(session: aiohttp.ClientSession, vm: Dict[str, Any]):
+# Все ВМ обрабатываются по одному соединению протокола TCP: запросы отправляются, не дожидаясь ответов
+protocol_client = ProtocolClient.from_address(SERVER_PROTOCOL_ADDR) if CLIENT_PROTOCOL == 'tcp' else None
+
+class RetryableStatus(Exception):
+    """Ответ сервера, после которого запрос повторяется"""
+
+class RequestFailed(Exception):
+    """Ответ протокола TCP с ошибкой, после которой запрос не повторяется"""
+
+def backoff_delay(attempt: int) -> float:
+    """Задержка перед повтором: экспоненциальный рост со случайным разбросом"""
+    return random.uniform(0, min(CLIENT_BACKOFF_MAX, CLIENT_BACKOFF_BASE * 2 ** attempt))
+
+async def protocol_request(path: str, payload: Any) -> str:
+    """Операция по протоколу TCP; имя операции совпадает с путем HTTP-маршрута"""
+    status, result = await asyncio.wait_for(protocol_client.call(path.lstrip('/'), payload), CLIENT_TIMEOUT)
+    if status in RETRY_STATUSES:
+        raise RetryableStatus(f"{status} {result}")
+    if status >= 400:
+        raise RequestFailed(f"{status} {result}")
+    return result if isinstance(result, str) else json.dumps(result)
+
+async def request(session: aiohttp.ClientSession, method: str, path: str, payload: Any = None) -> str:
+    """Запрос к серверу с таймаутом и повторами; после последней неудачной попытки исключение пробрасывается"""
+    for attempt in range(CLIENT_RETRIES + 1):
+        try:
+            if protocol_client is not None and method == 'POST':
+                return await protocol_request(path, payload)
+            async with session.request(method, SERVER_URL + path, json=payload) as response:
+                if response.status in RETRY_STATUSES:
+                    raise RetryableStatus(f"{response.status} {response.reason}")
+                response.raise_for_status()
+                return await response.text()
+        except (aiohttp.ClientConnectionError, ConnectionError, asyncio.TimeoutError, RetryableStatus) as e:
+            if attempt == CLIENT_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"Ошибка запроса {method} {path}: {e!r}, повтор через {delay:.2f} с")
+            await asyncio.sleep(delay)
+
+async def add_vm(session: aiohttp.ClientSession, vm: Dict[str, Any]) -> bool:
     """Добавление виртуальной машины"""
     try:
-        async with session.post('http://server:8080/add_vm', json=vm) as response:
-            response_text = await response.text()
-            logger.info(f"Ответ на добавление ВМ {vm['vm_id']}: {response_text}")
+        response_text = await request(session, 'POST', '/add_vm', vm)
+        logger.info(f"Ответ на добавление ВМ {vm['vm_id']}: {response_text}")
+        return True
     except Exception as e:
-        logger.error(f"Ошибка при добавлении ВМ {vm['vm_id']}: {e}")
+        logger.error(f"Ошибка при добавлении ВМ {vm['vm_id']}: {e!r}")
+        return False
 
-async def connect_vm(session: aiohttp.ClientSession, vm: Dict[str, Any]):
+async def connect_vm(session: aiohttp.ClientSession, vm: Dict[str, Any]) -> bool:
     """Подключение виртуальной машины"""
     try:
-        async with session.post('http://server:8080/connect_vm', json=vm) as response:
-            response_text = await response.text()
-            logger.info(f"Ответ на подключение ВМ {vm['vm_id']}: {response_text}")
+        response_text = await request(session, 'POST', '/connect_vm', vm)
+        logger.info(f"Ответ на подключение ВМ {vm['vm_id']}: {response_text}")
+        return True
     except Exception as e:
-        logger.error(f"Ошибка при подключении ВМ {vm['vm_id']}: {e}")
+        logger.error(f"Ошибка при подключении ВМ {vm['vm_id']}: {e!r}")
+        return False
 
-async def authorize_vm(session: aiohttp.ClientSession, vm_id: str):
+async def authorize_vm(session: aiohttp.ClientSession, vm_id: str) -> bool:
     """Авторизация виртуальной машины"""
     try:
-        async with session.post('http://server:8080/authorize_vm', json={"vm_id": vm_id}) as response:
-            response_text = await response.text()
-            logger.info(f"Ответ на авторизацию ВМ {vm_id}: {response_text}")
+        response_text = await request(session, 'POST', '/authorize_vm', {"vm_id": vm_id})
+        logger.info(f"Ответ на авторизацию ВМ {vm_id}: {response_text}")
+        return True
     except Exception as e:
-        logger.error(f"Ошибка при авторизации ВМ {vm_id}: {e}")
+        logger.error(f"Ошибка при авторизации ВМ {vm_id}: {e!r}")
+        return False
 
-async def deauthorize_vm(session: aiohttp.ClientSession, vm_id: str):
+async def deauthorize_vm(session: aiohttp.ClientSession, vm_id: str) -> bool:
     """Деавторизация виртуальной машины"""
     try:
-        async with session.post('http://server:8080/deauthorize_vm', json={"vm_id": vm_id}) as response:
-            response_text = await response.text()
-            logger.info(f"Ответ на деавторизацию ВМ {vm_id}: {response_text}")
+        response_text = await request(session, 'POST', '/deauthorize_vm', {"vm_id": vm_id})
+        logger.info(f"Ответ на деавторизацию ВМ {vm_id}: {response_text}")
+        return True
     except Exception as e:
-        logger.error(f"Ошибка при деавторизации ВМ {vm_id}: {e}")
+        logger.error(f"Ошибка при деавторизации ВМ {vm_id}: {e!r}")
+        return False
 
-async def update_vm(session: aiohttp.ClientSession, vm: Dict[str, Any]):
+async def update_vm(session: aiohttp.ClientSession, vm: Dict[str, Any]) -> bool:
     """Обновление данных виртуальной машины"""
     try:
-        async with session.post('http://server:8080/update_vm', json=vm) as response:
-            response_text = await response.text()
-            logger.info(f"Ответ на обновление ВМ {vm['vm_id']}: {response_text}")
+        response_text = await request(session, 'POST', '/update_vm', vm)
+        logger.info(f"Ответ на обновление ВМ {vm['vm_id']}: {response_text}")
+        return True
     except Exception as e:
-        logger.error(f"Ошибка при обновлении ВМ {vm['vm_id']}: {e}")
+        logger.error(f"Ошибка при обновлении ВМ {vm['vm_id']}: {e!r}")
+        return False
 
 async def get_all_vms(session: aiohttp.ClientSession):
     """Получение списка всех виртуальных машин"""
     try:
-        async with session.get('http://server:8080/get_all_vms') as response:
-            json_resp = await response.json()
-            logger.info(f"Список всех ВМ: {json_resp}")
+        json_resp = json.loads(await request(session, 'GET', '/get_all_vms'))
+        logger.info(f"Список всех ВМ: {json_resp}")
     except Exception as e:
-        logger.error(f"Ошибка при получении списка всех ВМ: {e}")
+        logger.error(f"Ошибка при получении списка всех ВМ: {e!r}")
 
 async def get_connected_vms(session: aiohttp.ClientSession):
     """Получение списка подключенных виртуальных машин"""
     try:
-        async with session.get('http://server:8080/get_connected_vms') as response:
-            json_resp = await response.json()
-            logger.info(f"Список подключенных ВМ: {json_resp}")
+        json_resp = json.loads(await request(session, 'GET', '/get_connected_vms'))
+        logger.info(f"Список подключенных ВМ: {json_resp}")
     except Exception as e:
-        logger.error(f"Ошибка при получении списка подключенных ВМ: {e}")
+        logger.error(f"Ошибка при получении списка подключенных ВМ: {e!r}")
 
 async def get_authorized_vms(session: aiohttp.ClientSession):
     """Получение списка авторизованных виртуальных машин"""
     try:
-        async with session.get('http://server:8080/get_authorized_vms') as response:
-            json_resp = await response.json()
-            logger.info(f"Список авторизованных ВМ: {json_resp}")
+        json_resp = json.loads(await request(session, 'GET', '/get_authorized_vms'))
+        logger.info(f"Список авторизованных ВМ: {json_resp}")
     except Exception as e:
-        logger.error(f"Ошибка при получении списка авторизованных ВМ: {e}")
+        logger.error(f"Ошибка при получении списка авторизованных ВМ: {e!r}")
 
 async def get_all_disks(session: aiohttp.ClientSession):
     """Получение списка всех жестких дисков"""
     try:
-        async with session.get('http://server:8080/get_all_disks') as response:
-            json_resp = await response.json()
-            logger.info(f"Список всех дисков: {json_resp}")
+        json_resp = json.loads(await request(session, 'GET', '/get_all_disks'))
+        logger.info(f"Список всех дисков: {json_resp}")
     except Exception as e:
-        logger.error(f"Ошибка при получении списка всех дисков: {e}")
+        logger.error(f"Ошибка при получении списка всех дисков: {e!r}")
+
+async def run_vm_lifecycle(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, vm: Dict[str, Any]) -> bool:
+    """Последовательный сценарий одной ВМ; прерывается на первом шаге, который не удался после всех повторов"""
+    async with semaphore:
+        updated = {**vm, "ram": vm["ram"] * 2, "cpu": vm["cpu"] * 2, "disks": [{"disk_id": vm["disks"][0]["disk_id"], "size": vm["disks"][0]["size"] * 2}]}
+        return (await add_vm(session, vm)
+                and await connect_vm(session, vm)
+                and await authorize_vm(session, vm['vm_id'])
+                and await update_vm(session, updated)
+                and await deauthorize_vm(session, vm['vm_id']))
 
 async def main():
-    """Основная функция для запуска клиентских задач"""
-    async with aiohttp.ClientSession() as session:
-        for vm in VIRTUAL_MACHINES:
-            await add_vm(session, vm)
-            await connect_vm(session, vm)
-            await authorize_vm(session, vm['vm_id'])
-            await update_vm(session, {**vm, "ram": vm["ram"] * 2, "cpu": vm["cpu"] * 2, "disks": [{"disk_id": vm["disks"][0]["disk_id"], "size": vm["disks"][0]["size"] * 2}]})
-            await deauthorize_vm(session, vm['vm_id'])
+    """Основная функция для запуска клиентских задач: ВМ обрабатываются параллельно, не более CLIENT_CONCURRENCY сразу"""
+    connector = aiohttp.TCPConnector(limit=CLIENT_CONNECTION_LIMIT, keepalive_timeout=CLIENT_KEEPALIVE_TIMEOUT)
+    timeout = aiohttp.ClientTimeout(total=CLIENT_TIMEOUT)
+    semaphore = asyncio.Semaphore(CLIENT_CONCURRENCY)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        results = await asyncio.gather(*(run_vm_lifecycle(session, semaphore, vm) for vm in VIRTUAL_MACHINES))
+        failed = [vm['vm_id'] for vm, ok in zip(VIRTUAL_MACHINES, results) if not ok]
+        if failed:
+            logger.error(f"Сценарий не завершен для ВМ: {failed}")
 
         await get_all_vms(session)
         await get_connected_vms(session)
         await get_authorized_vms(session)
         await get_all_disks(session)
+    if protocol_client is not None:
+        await protocol_client.close()
 
 if __name__ == '__main__':
-    logger.info("Запуск клиента")
+    logger.info(f"Запуск клиента: сервер {SERVER_URL}, протокол {CLIENT_PROTOCOL}, параллельно ВМ: {CLIENT_CONCURRENCY}")
     asyncio.run(main())
@@ -0,0 +1,333 @@
+"""Нагрузочное тестирование сервера управления ВМ.
+
+Генерирует смесь запросов к API с заданной конкурентностью и длительностью либо воспроизводит
+записанный поток запросов из NDJSON-файла и выводит по каждому маршруту задержки (p50/p95/p99),
+пропускную способность и долю ошибок. Результат можно сохранить в JSON и сравнить с результатом
+прошлой версии сервера.
+
+Примеры:
+    python loadtest.py --url http://localhost:8080 --concurrency 50 --duration 30 --vms 1000
+    python loadtest.py --mix add_vm=1,get_connected_vms=4 --output result.json
+    python loadtest.py --replay requests.jsonl --baseline result.json --max-regression 0.2
+
+Формат файла воспроизведения: одна JSON-запись на строку,
+    {"method": "POST", "path": "/add_vm", "body": {...}}
+Поле method необязательно (POST при наличии body, иначе GET). Строка с объектом ВМ
+без поля path отправляется как /add_vm.
+
+С --tcp операции над ВМ (POST) отправляются по протоколу TCP сервера, списки по-прежнему
+запрашиваются по HTTP. Каждый поток нагрузки использует одно из --tcp-connections соединений,
+запросы потоков в одном соединении отправляются, не дожидаясь ответов друг друга:
+    python loadtest.py --url http://localhost:8080 --tcp localhost:8081 --mix add_vm=1,connect_vm=1
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+from typing import List, Dict, Any, Optional, Iterator, Tuple
+
+import aiohttp
+
+from protocol_client import ProtocolClient
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SERVER_URL = os.getenv("SERVER_URL", "http://server:8080")
+
+# Смесь запросов по умолчанию: маршрут и его вес
+DEFAULT_MIX = {
+    'add_vm': 2,
+    'connect_vm': 2,
+    'authorize_vm': 2,
+    'update_vm': 2,
+    'deauthorize_vm': 1,
+    'get_all_vms': 1,
+    'get_connected_vms': 1,
+    'get_authorized_vms': 1,
+    'get_all_disks': 1,
+}
+
+PERCENTILES = (50, 95, 99)
+
+
+def make_vm(index: int, prefix: str) -> Dict[str, Any]:
+    """Тестовая ВМ с детерминированными параметрами"""
+    vm_id = f"{prefix}-vm-{index}"
+    return {
+        'vm_id': vm_id,
+        'ram': 512 * (1 + index % 64),
+        'cpu': 1 + index % 32,
+        'disks': [{'disk_id': f"{vm_id}-disk-{n}", 'size': 100 * (1 + (index + n) % 100)} for n in range(1 + index % 3)],
+    }
+
+
+def build_request(operation: str, vm: Dict[str, Any]) -> Tuple[str, str, Optional[Dict[str, Any]]]:
+    """Метод, путь и тело запроса для операции над ВМ"""
+    if operation in ('add_vm', 'connect_vm'):
+        return 'POST', f'/{operation}', vm
+    if operation == 'update_vm':
+        return 'POST', '/update_vm', {**vm, 'ram': vm['ram'] * 2, 'cpu': vm['cpu'] * 2}
+    if operation in ('authorize_vm', 'deauthorize_vm'):
+        return 'POST', f'/{operation}', {'vm_id': vm['vm_id']}
+    return 'GET', f'/{operation}', None
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    """Разбор смеси запросов вида add_vm=2,get_all_vms=1"""
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"Неизвестный маршрут в смеси: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def iter_replay(path: str, loop: bool) -> Iterator[Tuple[str, str, Optional[Dict[str, Any]]]]:
+    """Чтение записанных запросов из NDJSON-файла без загрузки файла целиком"""
+    while True:
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if 'path' not in record:
+                    yield 'POST', '/add_vm', record
+                    continue
+                body = record.get('body')
+                yield record.get('method', 'POST' if body is not None else 'GET'), record['path'], body
+        if not loop:
+            return
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Процентиль по методу ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct * len(ordered) / 100) - 1))
+    return ordered[rank]
+
+
+class Recorder:
+    """Накопление задержек и ошибок по маршрутам"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.bytes: Dict[str, int] = {}
+
+    def record(self, endpoint: str, latency: float, ok: bool, size: int = 0):
+        self.latencies.setdefault(endpoint, []).append(latency)
+        self.bytes[endpoint] = self.bytes.get(endpoint, 0) + size
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        endpoints = {}
+        total = errors = 0
+        for endpoint, values in sorted(self.latencies.items()):
+            count = len(values)
+            failed = self.errors.get(endpoint, 0)
+            total += count
+            errors += failed
+            endpoints[endpoint] = {
+                'requests': count,
+                'errors': failed,
+                'error_rate': round(failed / count, 4),
+                'throughput_rps': round(count / elapsed, 2),
+                'mean_ms': round(sum(values) / count * 1000, 3),
+                'max_ms': round(max(values) * 1000, 3),
+                'bytes': self.bytes.get(endpoint, 0),
+                **{f'p{pct}_ms': round(percentile(values, pct) * 1000, 3) for pct in PERCENTILES},
+            }
+        return {
+            'elapsed_s': round(elapsed, 3),
+            'requests': total,
+            'errors': errors,
+            'error_rate': round(errors / total, 4) if total else 0.0,
+            'throughput_rps': round(total / elapsed, 2) if elapsed else 0.0,
+            'endpoints': endpoints,
+        }
+
+
+async def send(session: aiohttp.ClientSession, base_url: str, recorder: Recorder,
+               method: str, path: str, body: Optional[Dict[str, Any]]):
+    """Отправка одного запроса с замером задержки"""
+    endpoint = path.split('?', 1)[0].lstrip('/')
+    started = time.perf_counter()
+    try:
+        async with session.request(method, base_url + path, json=body) as response:
+            payload = await response.read()
+            recorder.record(endpoint, time.perf_counter() - started, response.status < 400, len(payload))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        recorder.record(endpoint, time.perf_counter() - started, False)
+        logger.debug(f"Ошибка запроса {method} {path}: {e}")
+
+
+async def send_tcp(client: ProtocolClient, recorder: Recorder, path: str, body: Optional[Dict[str, Any]], timeout: float):
+    """Отправка операции по протоколу TCP с замером задержки"""
+    endpoint = path.split('?', 1)[0].lstrip('/')
+    started = time.perf_counter()
+    try:
+        status, result = await asyncio.wait_for(client.call(endpoint, body), timeout)
+        recorder.record(endpoint, time.perf_counter() - started, status < 400, len(str(result)))
+    except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+        recorder.record(endpoint, time.perf_counter() - started, False)
+        logger.debug(f"Ошибка операции {endpoint} по TCP: {e}")
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    recorder = Recorder()
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    prefix = args.prefix or f"lt{int(time.time())}"
+    deadline = time.perf_counter() + args.duration if args.duration else None
+    remaining = [args.requests] if args.requests else None
+
+    def has_budget() -> bool:
+        if deadline is not None and time.perf_counter() >= deadline:
+            return False
+        if remaining is not None:
+            if remaining[0] <= 0:
+                return False
+            remaining[0] -= 1
+        return True
+
+    clients = [ProtocolClient.from_address(args.tcp) for _ in range(args.tcp_connections)] if args.tcp else []
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        def dispatch(number: int, method: str, path: str, body: Optional[Dict[str, Any]]):
+            if clients and method == 'POST':
+                return send_tcp(clients[number % len(clients)], recorder, path, body, args.timeout)
+            return send(session, args.url, recorder, method, path, body)
+
+        if args.replay:
+            replay = iter_replay(args.replay, args.replay_loop)
+
+            async def worker(number: int):
+                while has_budget():
+                    request = next(replay, None)
+                    if request is None:
+                        return
+                    await dispatch(number, *request)
+        else:
+            operations = list(args.mix)
+            weights = [args.mix[name] for name in operations]
+            vms = [make_vm(index, prefix) for index in range(args.vms)]
+
+            async def worker(number: int):
+                rng = random.Random()
+                while has_budget():
+                    operation = rng.choices(operations, weights)[0]
+                    await dispatch(number, *build_request(operation, rng.choice(vms)))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(number) for number in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    for client in clients:
+        await client.close()
+
+    report = recorder.report(elapsed)
+    report['config'] = {
+        'url': args.url,
+        'concurrency': args.concurrency,
+        'duration_s': args.duration,
+        'requests': args.requests,
+        'vms': args.vms,
+        'mix': args.mix,
+        'replay': args.replay,
+        'tcp': args.tcp,
+        'tcp_connections': args.tcp_connections if args.tcp else None,
+    }
+    return report
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """Сравнение с результатом прошлого запуска: список регрессий p95, пропускной способности и ошибок"""
+    regressions = []
+    if report['throughput_rps'] < baseline['throughput_rps'] * (1 - max_regression):
+        regressions.append(f"пропускная способность {report['throughput_rps']} rps < "
+                           f"{baseline['throughput_rps']} rps в базовом запуске")
+    for endpoint, current in report['endpoints'].items():
+        previous = baseline['endpoints'].get(endpoint)
+        if previous is None:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + max_regression):
+            regressions.append(f"{endpoint}: p95 {current['p95_ms']} мс > {previous['p95_ms']} мс в базовом запуске")
+        if current['error_rate'] > previous['error_rate'] + max_regression / 10:
+            regressions.append(f"{endpoint}: доля ошибок {current['error_rate']} > {previous['error_rate']}")
+    return regressions
+
+
+def print_report(report: Dict[str, Any]):
+    header = f"{'endpoint':<20} {'reqs':>8} {'err%':>6} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+    print(header)
+    print('-' * len(header))
+    for endpoint, r in report['endpoints'].items():
+        print(f"{endpoint:<20} {r['requests']:>8} {r['error_rate'] * 100:>6.2f} {r['throughput_rps']:>9.1f} "
+              f"{r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['max_ms']:>9.2f}")
+    print('-' * len(header))
+    print(f"всего: {report['requests']} запросов за {report['elapsed_s']} с, "
+          f"{report['throughput_rps']} rps, ошибок {report['error_rate'] * 100:.2f}%")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default=SERVER_URL, help="Адрес сервера")
+    parser.add_argument('--concurrency', type=int, default=10, help="Число одновременных запросов")
+    parser.add_argument('--duration', type=float, default=10.0, help="Длительность теста, секунды (0 — без ограничения)")
+    parser.add_argument('--requests', type=int, default=0, help="Общее число запросов (0 — без ограничения)")
+    parser.add_argument('--vms', type=int, default=100, help="Число тестовых ВМ")
+    parser.add_argument('--prefix', default='', help="Префикс идентификаторов тестовых ВМ")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help="Смесь запросов: add_vm=2,get_all_vms=1")
+    parser.add_argument('--replay', help="NDJSON-файл с записанными запросами")
+    parser.add_argument('--replay-loop', action='store_true', help="Повторять файл воспроизведения по кругу")
+    parser.add_argument('--tcp', help="Адрес протокола TCP сервера (host:port) для операций над ВМ")
+    parser.add_argument('--tcp-connections', type=int, default=1, help="Число соединений протокола TCP")
+    parser.add_argument('--timeout', type=float, default=30.0, help="Таймаут одного запроса, секунды")
+    parser.add_argument('--output', help="Файл для результата в JSON")
+    parser.add_argument('--json', action='store_true', help="Вывести результат в JSON вместо таблицы")
+    parser.add_argument('--baseline', help="JSON-результат прошлого запуска для сравнения")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="Допустимое ухудшение относительно базового запуска (доля)")
+    args = parser.parse_args(argv)
+    if not args.duration and not args.requests and not (args.replay and not args.replay_loop):
+        parser.error("нужно ограничить тест: --duration, --requests или конечный --replay")
+    args.url = args.url.rstrip('/')
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    logger.info(f"Нагрузочный тест {args.url}: конкурентность {args.concurrency}")
+    report = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            regressions = compare(report, json.load(file), args.max_regression)
+        for regression in regressions:
+            logger.error(f"Регрессия: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
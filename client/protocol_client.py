@@ -0,0 +1,104 @@
+"""Клиент протокола TCP сервера управления ВМ.
+
+Кадр — длина тела (4 байта, big-endian) и тело в msgpack или JSON: запрос [id, операция, тело],
+ответ [id, статус, результат]. Запросы отправляются, не дожидаясь ответов на предыдущие, по одному
+соединению. Сервер отвечает в порядке запросов, поэтому ответ достается самому старому
+ожидающему запросу.
+"""
+import asyncio
+import json
+import struct
+from collections import deque
+from typing import Any, Deque, Optional, Tuple
+
+try:
+    import msgpack
+except ImportError:  # Без msgpack сообщения кодируются в JSON
+    msgpack = None
+
+HEADER = struct.Struct('>I')
+
+
+class ProtocolClient:
+    """Соединение с сервером по протоколу TCP; подключается при первом запросе и после обрыва"""
+
+    def __init__(self, host: str, port: int, binary: bool = msgpack is not None):
+        if binary and msgpack is None:
+            raise ValueError("для binary=True нужен пакет msgpack")
+        self.host = host
+        self.port = port
+        self.binary = binary
+        self.next_id = 0
+        self.waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.reader_task: Optional[asyncio.Task] = None
+        self.connecting = asyncio.Lock()
+
+    @classmethod
+    def from_address(cls, address: str, **kwargs) -> 'ProtocolClient':
+        """Клиент по адресу вида host:port"""
+        host, _, port = address.rpartition(':')
+        return cls(host or 'localhost', int(port), **kwargs)
+
+    def encode(self, message: Any) -> bytes:
+        body = msgpack.packb(message) if self.binary else json.dumps(message).encode()
+        return HEADER.pack(len(body)) + body
+
+    async def connect(self):
+        async with self.connecting:
+            if self.writer is not None:
+                return
+            reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            self.reader_task = asyncio.get_running_loop().create_task(self.read_responses(reader))
+
+    async def read_responses(self, reader: asyncio.StreamReader):
+        """Чтение ответов; при обрыве соединения ожидающие запросы завершаются ошибкой"""
+        try:
+            while True:
+                (size,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+                body = await reader.readexactly(size)
+                response = msgpack.unpackb(body) if self.binary else json.loads(body)
+                request_id, future = self.waiters.popleft()
+                if response[0] is not None and response[0] != request_id:
+                    raise ConnectionError(f"ответ {response[0]} пришел вместо ответа на запрос {request_id}")
+                # Запрос, отмененный по таймауту, свой ответ уже не ждет
+                if not future.done():
+                    future.set_result((response[1], response[2]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = e if isinstance(e, ConnectionError) else ConnectionError(f"соединение с сервером прервано: {e!r}")
+            self._disconnect(error)
+
+    def _disconnect(self, error: Exception):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        while self.waiters:
+            _, future = self.waiters.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    async def call(self, operation: str, body: Any = None) -> Tuple[int, Any]:
+        """Статус и результат операции"""
+        if self.writer is None:
+            await self.connect()
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((self.next_id, future))
+        self.writer.write(self.encode([self.next_id, operation, body]))
+        if self.writer.transport.get_write_buffer_size() > 64 * 1024:
+            await self.writer.drain()
+        return await future
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            self.reader_task = None
+        writer = self.writer
+        self._disconnect(ConnectionError("клиент закрыт"))
+        if writer is not None:
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
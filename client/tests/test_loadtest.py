@@ -0,0 +1,17 @@
+from loadtest import percentile
+
+
+def test_percentile_nearest_rank():
+    ten = [float(n) for n in range(1, 11)]
+    twenty = [float(n) for n in range(1, 21)]
+    # Ранг ceil(p/100 * n): при p*n/100 целом берется ровно этот элемент, а не следующий
+    assert percentile(ten, 50) == 5.0
+    assert percentile(twenty, 95) == 19.0
+    assert percentile(twenty, 50) == 10.0
+    assert percentile(ten, 99) == 10.0
+    assert percentile(ten, 100) == 10.0
+    assert percentile(ten, 0) == 1.0
+    assert percentile(list(reversed(ten)), 30) == 3.0
+    assert percentile([float(n) for n in range(1, 101)], 7) == 7.0
+    assert percentile([7.0], 50) == 7.0
+    assert percentile([], 95) == 0.0
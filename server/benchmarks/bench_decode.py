@@ -0,0 +1,101 @@
+"""Микробенчмарк разбора тел запросов записи ВМ и памяти подключенных ВМ.
+
+Сравниваются два пути от тела /connect_vm до ВМ в connected_vms:
+- legacy: json.loads и ВМ с __dict__, которая хранит диски списком исходных словарей
+  (как обработчики до проверки по схеме);
+- schema: parse_json, проверка по схеме и ВМ со __slots__ и кортежем дисков Disk.
+
+Для каждого пути выводятся число разобранных тел в секунду и память, которую занимают
+подключенные ВМ (по tracemalloc), в пересчете на --vms ВМ. База данных не нужна.
+
+Запуск:
+    python benchmarks/bench_decode.py --vms 100000 --disks 2
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from models import orjson  # noqa: E402
+from schema import decode_vm, parse_json  # noqa: E402
+
+
+class LegacyVirtualMachine:
+    """Прежняя ВМ: атрибуты в __dict__, диски — словари из тела запроса"""
+
+    def __init__(self, vm_id: str, ram: int, cpu: int, disks: List[Dict[str, Any]]):
+        self.vm_id = vm_id
+        self.ram = ram
+        self.cpu = cpu
+        self.disks = disks
+
+
+def legacy_decode(body: bytes) -> LegacyVirtualMachine:
+    data = json.loads(body)
+    return LegacyVirtualMachine(data['vm_id'], data['ram'], data['cpu'], data['disks'])
+
+
+def schema_decode(body: bytes):
+    return decode_vm(parse_json(body))
+
+
+def make_bodies(count: int, disk_count: int) -> List[bytes]:
+    return [json.dumps({
+        'vm_id': f"bench-vm-{n}",
+        'ram': 512 * (1 + n % 64),
+        'cpu': 1 + n % 32,
+        'disks': [{'disk_id': f"bench-vm-{n}-d{d}", 'size': 100 * (1 + d)} for d in range(disk_count)],
+    }).encode() for n in range(count)]
+
+
+def measure(decode: Callable[[bytes], Any], bodies: List[bytes], repeat: int) -> Dict[str, Any]:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for body in bodies:
+            decode(body)
+        best = min(best, time.perf_counter() - started)
+
+    # Память считается после разбора: тела запросов к этому моменту уже освобождены
+    tracemalloc.start()
+    connected = {}
+    for body in bodies:
+        vm = decode(body)
+        connected[vm.vm_id] = vm
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'decode_per_s': round(len(bodies) / best),
+        'memory_mib': round(current / 2 ** 20, 1),
+        'bytes_per_vm': round(current / len(bodies)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vms', type=int, default=100000)
+    parser.add_argument('--disks', type=int, default=2, help="Число дисков у каждой ВМ")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help="Вывод результата в JSON")
+    args = parser.parse_args()
+
+    bodies = make_bodies(args.vms, args.disks)
+    results = {name: measure(decode, bodies, args.repeat)
+               for name, decode in (('legacy', legacy_decode), ('schema', schema_decode))}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{args.vms} ВМ по {args.disks} диска, orjson: {'да' if orjson is not None else 'нет'}")
+    print(f"{'path':>8} | {'decode/s':>10} | {'memory MiB':>10} | {'bytes/VM':>9}")
+    for name, r in results.items():
+        print(f"{name:>8} | {r['decode_per_s']:>10} | {r['memory_mib']:>10} | {r['bytes_per_vm']:>9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Объединение одновременных записей ВМ в пакеты (group commit).
+
+Записи, пришедшие в течение окна или до заполнения пакета, применяются одной транзакцией,
+а каждый вызывающий получает свой результат. Пакеты выполняются строго по очереди, поэтому,
+пока один пакет фиксируется, следующий набирается из новых записей.
+
+Внутри пакета хранилище может применить записи не в порядке поступления (сначала добавления,
+затем обновления). Чтобы это не меняло результат, запись, которая затрагивает vm_id или disk_id
+из набираемого пакета, закрывает его и начинает следующий: записи одного пакета независимы.
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, NamedTuple, Optional, Set
+
+from models import VirtualMachine
+
+logger = logging.getLogger(__name__)
+
+
+class Write(NamedTuple):
+    """Запись в пакете: вид ('add' или 'update'), ВМ и результат для вызывающего"""
+    kind: str
+    vm: VirtualMachine
+    future: asyncio.Future
+
+
+# Применение пакета: результат или исключение для каждой записи, в порядке записей
+Flush = Callable[[List[Write]], Awaitable[List[Any]]]
+
+
+def write_keys(vm: VirtualMachine) -> Set[str]:
+    """Ключи, по которым записи одного пакета не должны пересекаться"""
+    return {'vm:' + vm.vm_id, *('disk:' + disk.disk_id for disk in vm.disks)}
+
+
+class WriteCoalescer:
+    """Очередь записей ВМ, которая применяет их пакетами не чаще раза в окно"""
+
+    def __init__(self, flush: Flush, window: float, max_batch: int):
+        self.flush = flush
+        self.window = window
+        self.max_batch = max_batch
+        self.pending: List[Write] = []
+        self.keys: Set[str] = set()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        # Пакеты фиксируются по одному в порядке закрытия
+        self.lock = asyncio.Lock()
+        self.tasks: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.writes = 0
+
+    async def submit(self, kind: str, vm: VirtualMachine) -> Any:
+        """Запись ВМ в составе пакета; возвращает ее результат или пробрасывает ее ошибку"""
+        keys = write_keys(vm)
+        if not self.keys.isdisjoint(keys):
+            self._close_batch()
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(Write(kind, vm, future))
+        self.keys |= keys
+        if len(self.pending) >= self.max_batch:
+            self._close_batch()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self._close_batch)
+        # Отмена вызывающего не отменяет запись: она уже в пакете
+        return await asyncio.shield(future)
+
+    def _close_batch(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        batch, self.pending, self.keys = self.pending, [], set()
+        task = asyncio.get_running_loop().create_task(self._apply(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _apply(self, batch: List[Write]):
+        async with self.lock:
+            try:
+                results = await self.flush(batch)
+            except Exception as e:
+                results = [e] * len(batch)
+        self.batches += 1
+        self.writes += len(batch)
+        for write, result in zip(batch, results):
+            if isinstance(result, Exception):
+                write.future.set_exception(result)
+            else:
+                write.future.set_result(result)
+
+    async def close(self):
+        """Применение набранных записей и ожидание всех пакетов"""
+        self._close_batch()
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
@@ -0,0 +1,175 @@
+"""Лента изменений ВМ для подписчиков /events (Server-Sent Events).
+
+Событие кодируется один раз при публикации и раздается всем подписчикам. Публикация синхронная
+и никогда не ждет подписчиков: у каждого подписчика ограниченный буфер, и подписчик, который
+не успевает его разбирать, отключается. Переподключившись с Last-Event-ID, он получает
+пропущенные события из истории, пока они в ней хранятся.
+
+Номера событий одного процесса начинаются с 1 после каждого перезапуска, поэтому id события
+в ленте дополняется эпохой процесса: <эпоха>-<номер>. Last-Event-ID с чужой эпохой не продолжает
+ленту, а дает reset, даже если номер совпал с номером нового события.
+"""
+import asyncio
+import os
+import secrets
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from models import json_dumps
+
+# Число последних событий, из которых можно продолжить ленту после переподключения
+EVENTS_HISTORY_SIZE = int(os.getenv("EVENTS_HISTORY_SIZE", "10000"))
+# Число событий в буфере подписчика, после которого медленный подписчик отключается
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "1000"))
+# Интервал комментариев, поддерживающих соединение без событий, секунды
+EVENTS_KEEPALIVE = float(os.getenv("EVENTS_KEEPALIVE", "15"))
+
+EVENT_TYPES = ('add', 'update', 'connect', 'authorize', 'deauthorize', 'expire')
+
+
+def encode_event(event_id: str, seq: int, event_type: str, data: Dict[str, Any]) -> bytes:
+    """Событие в формате text/event-stream"""
+    return b'id: %s\nevent: %s\ndata: %s\n\n' % (event_id.encode(), event_type.encode(),
+                                                   json_dumps({'seq': seq, **data}))
+
+
+class Subscription:
+    """Подписчик ленты: ограниченный буфер закодированных событий"""
+
+    def __init__(self, types: Optional[Set[str]], queue_size: int):
+        self.types = types
+        self.queue_size = queue_size
+        self.limit = queue_size
+        self.pending: Deque[bytes] = deque()
+        self.ready = asyncio.Event()
+        # Причина завершения ленты: 'overflow' или 'closed'
+        self.ended: Optional[str] = None
+
+    def push(self, event_type: str, payload: bytes):
+        if self.ended is not None or (self.types is not None and event_type not in self.types):
+            return
+        if len(self.pending) >= self.limit:
+            self.end('overflow')
+            return
+        self.pending.append(payload)
+        self.ready.set()
+
+    def end(self, reason: str):
+        if self.ended is None:
+            self.ended = reason
+        self.ready.set()
+
+    async def next_batch(self, timeout: float) -> List[bytes]:
+        """События, накопившиеся с прошлого вызова; пустой список по таймауту или завершении"""
+        if not self.pending and self.ended is None:
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.ready.clear()
+        batch = list(self.pending)
+        self.pending.clear()
+        self.limit = self.queue_size
+        return batch
+
+
+class EventBus:
+    """Публикация событий и история для продолжения ленты.
+
+    Номера событий задает либо сама шина, либо общее хранилище, когда события приходят
+    уведомлениями от всех процессов сервера. Продолжение ищет событие Last-Event-ID по позиции
+    в истории, а не по номеру: порядок доставки одинаков во всех процессах, а номера из
+    последовательности базы могут прийти не по возрастанию.
+
+    epoch по умолчанию свой у каждого экземпляра; пустая эпоха — для номеров из общего хранилища,
+    которые одинаковы во всех процессах и не начинаются заново при перезапуске.
+    """
+
+    def __init__(self, history_size: int = EVENTS_HISTORY_SIZE, queue_size: int = EVENTS_QUEUE_SIZE,
+                 epoch: Optional[str] = None):
+        self.epoch = secrets.token_hex(4) if epoch is None else epoch
+        self.history_size = history_size
+        self.queue_size = queue_size
+        self.history: Deque[Tuple[int, str, bytes]] = deque()
+        # Номер события -> его позиция в общей последовательности публикаций
+        self.positions: Dict[int, int] = {}
+        self.next_position = 0
+        self.last_seq = 0
+        self.subscriptions: Set[Subscription] = set()
+        self.published = 0
+        self.dropped = 0
+
+    def publish(self, event_type: str, data: Dict[str, Any], seq: Optional[int] = None):
+        """Публикация события; без seq номер присваивается по порядку"""
+        if seq is None:
+            seq = self.last_seq + 1
+        self.last_seq = max(self.last_seq, seq)
+        payload = encode_event(self.event_id(seq), seq, event_type, data)
+
+        self.history.append((seq, event_type, payload))
+        self.positions[seq] = self.next_position
+        self.next_position += 1
+        if len(self.history) > self.history_size:
+            old_seq, _, _ = self.history.popleft()
+            self.positions.pop(old_seq, None)
+
+        self.published += 1
+        for subscription in list(self.subscriptions):
+            subscription.push(event_type, payload)
+            if subscription.ended == 'overflow':
+                self.subscriptions.discard(subscription)
+                self.dropped += 1
+
+    def event_id(self, seq: int) -> str:
+        """id события в ленте: номер с эпохой процесса"""
+        return f"{self.epoch}-{seq}" if self.epoch else str(seq)
+
+    def parse_id(self, event_id: str) -> Optional[int]:
+        """Номер события по его id; None, если id выдан с другой эпохой. Некорректный id — ValueError"""
+        epoch, _, seq = event_id.rpartition('-')
+        seq = int(seq)
+        return seq if epoch == self.epoch else None
+
+    def subscribe(self, last_id: Optional[str] = None,
+                  types: Optional[Iterable[str]] = None) -> Tuple[Subscription, bool]:
+        """Новый подписчик с событиями после события last_id из истории.
+
+        Второе значение — False, если продолжить ленту нельзя: события после last_id уже вытеснены
+        из истории, номер неизвестен или id выдан до перезапуска. Тогда клиенту нужно заново
+        загрузить списки. Некорректный last_id — ValueError.
+        """
+        last_seq = self.parse_id(last_id) if last_id is not None else None
+        subscription = Subscription(set(types) if types is not None else None, self.queue_size)
+        resumed = True
+        if last_id is not None:
+            position = self.positions.get(last_seq) if last_seq is not None else None
+            if position is None:
+                resumed = False
+            else:
+                skip = position - (self.next_position - len(self.history)) + 1
+                replay = [(event_type, payload) for index, (_, event_type, payload) in enumerate(self.history)
+                          if index >= skip]
+                # Пропущенные события не считаются в лимит буфера: он ограничивает только отставание от новых
+                subscription.limit += len(replay)
+                for event_type, payload in replay:
+                    subscription.push(event_type, payload)
+        self.subscriptions.add(subscription)
+        return subscription, resumed
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscriptions.discard(subscription)
+
+    def close(self):
+        """Завершение всех подписок при остановке сервера"""
+        for subscription in self.subscriptions:
+            subscription.end('closed')
+        self.subscriptions.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'subscribers': len(self.subscriptions),
+            'last_seq': self.last_seq,
+            'history': len(self.history),
+            'published': self.published,
+            'dropped': self.dropped,
+        }
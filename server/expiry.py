@@ -0,0 +1,55 @@
+"""Планировщик истечения подключений ВМ по таймауту heartbeat.
+
+Куча хранит не больше одной актуальной записи на ВМ. Heartbeat только сдвигает срок в словаре
+за O(1); когда запись с устаревшим сроком доходит до вершины кучи, она переставляется на новый
+срок за O(log n). Поэтому частые heartbeat не раздувают кучу, а выбор истекших ВМ не требует
+обхода всех подключений.
+"""
+import heapq
+from typing import Dict, List, Optional, Tuple
+
+
+class ExpiryHeap:
+    def __init__(self):
+        self.heap: List[Tuple[float, str]] = []
+        # Актуальный срок каждой ВМ
+        self.deadlines: Dict[str, float] = {}
+        # Срок, под которым ВМ лежит в куче; записи с другим сроком устарели и пропускаются
+        self.scheduled: Dict[str, float] = {}
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def touch(self, key: str, deadline: float):
+        """Установка срока истечения"""
+        self.deadlines[key] = deadline
+        scheduled = self.scheduled.get(key)
+        if scheduled is None or deadline < scheduled:
+            self.scheduled[key] = deadline
+            heapq.heappush(self.heap, (deadline, key))
+
+    def remove(self, key: str):
+        self.deadlines.pop(key, None)
+        self.scheduled.pop(key, None)
+
+    def next_deadline(self) -> Optional[float]:
+        """Ближайший срок в куче; он может оказаться устаревшим, тогда pop_due ничего не вернет"""
+        while self.heap and self.scheduled.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now: float) -> List[str]:
+        """Ключи со сроком не позже now; они удаляются из планировщика"""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, key = heapq.heappop(self.heap)
+            if self.scheduled.get(key) != deadline:
+                continue
+            actual = self.deadlines[key]
+            if actual > now:
+                self.scheduled[key] = actual
+                heapq.heappush(self.heap, (actual, key))
+                continue
+            self.remove(key)
+            due.append(key)
+        return due
@@ -0,0 +1,256 @@
+"""Логирование сервера: очередь, JSON-формат, идентификатор запроса и выборка частых сообщений.
+
+Обработчик на корневом логгере только кладет запись в очередь, а форматирование и запись
+в поток выполняет BatchListener в отдельном потоке раз в LOG_FLUSH_INTERVAL, поэтому цикл
+событий не ждет вывода, даже если получатель stderr читает медленно.
+Сообщения форматируются лениво: аргументы подставляются в строку уже в потоке вывода,
+а сообщение отброшенного уровня не форматируется вовсе.
+
+Каждая запись получает request_id текущего запроса из contextvars: HTTP-запрос и запрос
+протокола TCP выполняются в своих задачах, и идентификатор не смешивается между ними.
+
+Частые сообщения об успешных операциях пишутся через SampledLogger: для запроса один раз
+решается, попадет ли он в выборку LOG_SAMPLE_RATE, и его сообщения пишутся все или не пишутся.
+Ошибки и предупреждения не выбираются.
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional, TextIO
+
+from aiohttp.web_log import AccessLogger
+from aiohttp.web_request import BaseRequest
+from aiohttp.web_response import StreamResponse
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Формат вывода: json (по записи JSON на строку) или text
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Доля запросов, частые сообщения которых пишутся в лог: 1 — все, 0 — ни одного
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1"))
+# Интервал между выводами накопившихся записей, секунды
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "0.05"))
+
+# Заголовок, в котором клиент может передать свой идентификатор запроса и в котором сервер его возвращает
+REQUEST_ID_HEADER = 'X-Request-ID'
+# Идентификатор клиента принимается, только если безопасен для записи в лог
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._:-]{1,128}')
+
+# Идентификатор текущего запроса и решение о выборке его частых сообщений
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('request_id', default=None)
+sampled_var: contextvars.ContextVar[Optional[bool]] = contextvars.ContextVar('log_sampled', default=None)
+
+# Атрибуты LogRecord, которые не относятся к полям, переданным через extra
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+listener: Optional['BatchListener'] = None
+
+
+def new_request_id() -> str:
+    return secrets.token_hex(8)
+
+
+def start_request(request_id: Optional[str] = None, sample_rate: float = LOG_SAMPLE_RATE) -> str:
+    """Идентификатор и выборка для запроса, который выполняется в текущей задаче.
+
+    Переданный клиентом идентификатор используется, если подходит под REQUEST_ID_PATTERN,
+    иначе создается новый.
+    """
+    if request_id is None or not REQUEST_ID_PATTERN.fullmatch(request_id):
+        request_id = new_request_id()
+    request_id_var.set(request_id)
+    sampled_var.set(sample_rate >= 1 or random.random() < sample_rate)
+    return request_id
+
+
+class RequestIdFilter(logging.Filter):
+    """Добавляет к записи request_id; выполняется в потоке, создавшем запись, где виден контекст запроса"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не форматирует запись перед постановкой в очередь.
+
+    Стандартный prepare подставляет аргументы в сообщение в вызывающем потоке. Аргументы
+    сообщений сервера — строки и числа, которые не меняются после вызова, поэтому запись
+    можно передать как есть и отформатировать в потоке вывода.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись в одну строку JSON: время, уровень, логгер, сообщение, request_id и поля из extra"""
+
+    def __init__(self):
+        super().__init__()
+        # Время до секунд одинаково у записей одной секунды и форматируется один раз
+        self.second = -1
+        self.second_text = ''
+
+    def timestamp(self, record: logging.LogRecord) -> str:
+        second = int(record.created)
+        if second != self.second:
+            self.second = second
+            self.second_text = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+        return f'{self.second_text}.{int(record.msecs):03d}Z'
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            'ts': self.timestamp(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+        }
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SampledAccessLogger(AccessLogger):
+    """Журнал доступа aiohttp с той же выборкой запросов, что и SampledLogger.
+
+    Журнал пишется в задаче запроса, поэтому решение о выборке берется из ее контекста.
+    """
+
+    def log(self, request: BaseRequest, response: StreamResponse, time: float):
+        if sampled_var.get() is not False:
+            super().log(request, response, time)
+
+
+class SampledLogger:
+    """Логгер частых сообщений: пишет сообщения только запросов из выборки"""
+
+    def __init__(self, logger: logging.Logger, sample_rate: float = LOG_SAMPLE_RATE):
+        self.logger = logger
+        self.sample_rate = sample_rate
+
+    def sampled(self) -> bool:
+        decision = sampled_var.get()
+        if decision is None:
+            # Вне запроса (фоновые задачи) выборка решается для каждого сообщения
+            return self.sample_rate >= 1 or random.random() < self.sample_rate
+        return decision
+
+    def log(self, level: int, msg: str, *args: Any, **kwargs: Any):
+        if self.logger.isEnabledFor(level) and self.sampled():
+            # Место вызова в записи — код, вызвавший SampledLogger, а не сама обертка
+            kwargs['stacklevel'] = kwargs.get('stacklevel', 1) + 2
+            self.logger.log(level, msg, *args, **kwargs)
+
+    def info(self, msg: str, *args: Any, **kwargs: Any):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def debug(self, msg: str, *args: Any, **kwargs: Any):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+
+class BatchListener:
+    """Поток вывода: забирает из очереди все накопившиеся записи и пишет их одним вызовом write.
+
+    QueueListener передает обработчику по одной записи, и StreamHandler сбрасывает поток после
+    каждой строки. Под нагрузкой записи приходят быстрее, чем поток просыпается, поэтому вывод
+    пакетами сокращает и число пробуждений потока, и число системных вызовов.
+    """
+
+    def __init__(self, log_queue: queue.SimpleQueue, formatter: logging.Formatter, stream: TextIO,
+                 interval: float = LOG_FLUSH_INTERVAL):
+        self.queue = log_queue
+        self.formatter = formatter
+        self.stream = stream
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Вывод записей, поставленных до вызова, и остановка потока"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            lines = []
+            for record in batch:
+                if record is None:
+                    continue
+                try:
+                    lines.append(self.formatter.format(record))
+                except Exception:
+                    # Запись, которую не удалось отформатировать, не должна останавливать вывод остальных
+                    lines.append(f"ошибка форматирования записи {record.name}: {record.msg!r}")
+            try:
+                if lines:
+                    self.stream.write('\n'.join(lines) + '\n')
+                    self.stream.flush()
+            except Exception:
+                pass
+            if stopping:
+                return
+            # Записи накапливаются в очереди без пробуждения потока; stop() прерывает ожидание
+            self.stopped.wait(self.interval)
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, stream: Optional[TextIO] = None) -> BatchListener:
+    """Настройка корневого логгера: очередь и поток вывода.
+
+    Вызывается в каждом процессе сервера: поток вывода не переживает fork, и дочерний процесс
+    запускает свой.
+    """
+    global listener
+    if fmt == 'json':
+        formatter: logging.Formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s')
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(RequestIdFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = BatchListener(log_queue, formatter, stream or sys.stderr)
+    listener.start()
+    return listener
+
+
+def stop_logging():
+    """Вывод оставшихся в очереди записей и остановка потока вывода"""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
@@ -0,0 +1,234 @@
+"""Метрики сервера в текстовом формате Prometheus.
+
+Счетчики и гистограммы обновляются на горячем пути без блокировок: сервер однопоточный,
+а дочерние серии с метками создаются один раз и дальше берутся из словаря. Значения,
+которые уже хранятся в других объектах (пул соединений, кеш), читаются только при выдаче /metrics.
+"""
+import bisect
+import time
+from typing import List, Dict, Any, Optional, AsyncIterator, Callable, Iterable, Tuple
+
+# Границы корзин гистограмм задержки, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Границы корзин гистограммы размера ответа, байты
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{escape_label(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Метрика с сериями по значениям меток.
+
+    Если задан callback, значения серий не накапливаются, а запрашиваются в момент выдачи метрик:
+    callback возвращает словарь {значения меток: значение}.
+    """
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 callback: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self.children: Dict[Tuple[str, ...], Any] = {}
+
+    def labels(self, *values: str):
+        """Серия метрики для значений меток; создается при первом обращении"""
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        """Строки метрики: суффикс имени, метки и значение"""
+        if self.callback is not None:
+            values = self.callback().items()
+        else:
+            values = ((labels, child.value) for labels, child in self.children.items())
+        for labels, value in values:
+            yield '', format_labels(self.labelnames, labels), value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{labels} {format_value(value)}')
+        return lines
+
+
+class Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+    kind = 'counter'
+
+    def _new_child(self) -> Value:
+        return Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """Текущее значение"""
+    kind = 'gauge'
+
+    def _new_child(self) -> Value:
+        return Value()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    """Гистограмма с фиксированными корзинами"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self):
+        for values, child in self.children.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+                total += count
+                yield '_bucket', format_labels(self.labelnames, values, f'le="{format_value(bound)}"'), total
+            yield '_sum', format_labels(self.labelnames, values), child.sum
+            yield '_count', format_labels(self.labelnames, values), total
+
+
+class Registry:
+    """Набор метрик, выдаваемых одним ответом"""
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class StorageTimer:
+    """Замер одного обращения к хранилищу: длительность и ошибка"""
+    __slots__ = ('metrics', 'operation', 'started')
+
+    def __init__(self, metrics: 'ServerMetrics', operation: str):
+        self.metrics = metrics
+        self.operation = operation
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe_storage(self.operation, time.perf_counter() - self.started, exc_type is None)
+        return False
+
+
+class ServerMetrics:
+    """Метрики HTTP-запросов, запросов протокола TCP и обращений к хранилищу"""
+
+    def __init__(self):
+        self.registry = Registry()
+        self.http_requests = self.registry.register(Counter(
+            'vm_http_requests_total', 'Число обработанных HTTP-запросов', ('route', 'method', 'status')))
+        self.http_duration = self.registry.register(Histogram(
+            'vm_http_request_duration_seconds', 'Время обработки HTTP-запроса', ('route', 'method')))
+        self.http_in_flight = self.registry.register(Gauge(
+            'vm_http_requests_in_flight', 'Число HTTP-запросов в обработке', ('route',)))
+        self.http_response_size = self.registry.register(Histogram(
+            'vm_http_response_size_bytes', 'Размер тела HTTP-ответа', ('route',), SIZE_BUCKETS))
+        self.storage_duration = self.registry.register(Histogram(
+            'vm_storage_operation_duration_seconds', 'Время обращений к хранилищу', ('operation',)))
+        self.storage_errors = self.registry.register(Counter(
+            'vm_storage_operation_errors_total', 'Число ошибок обращений к хранилищу', ('operation',)))
+        self.protocol_requests = self.registry.register(Counter(
+            'vm_protocol_requests_total', 'Число запросов протокола TCP', ('operation', 'status')))
+        self.protocol_duration = self.registry.register(Histogram(
+            'vm_protocol_request_duration_seconds', 'Время выполнения запроса протокола TCP', ('operation',)))
+
+    def storage_timer(self, operation: str) -> StorageTimer:
+        """Контекстный менеджер для замера обращения к хранилищу"""
+        return StorageTimer(self, operation)
+
+    def observe_storage(self, operation: str, elapsed: float, ok: bool):
+        self.storage_duration.labels(operation).observe(elapsed)
+        if not ok:
+            self.storage_errors.labels(operation).inc()
+
+    def observe_protocol(self, operation: str, status: int, elapsed: float):
+        self.protocol_duration.labels(operation).observe(elapsed)
+        self.protocol_requests.labels(operation, str(status)).inc()
+
+    async def timed_first(self, operation: str, items: AsyncIterator[Any]) -> Optional[Any]:
+        """Первый документ потокового чтения из хранилища; замеряется время до него, то есть время запроса.
+
+        Остальные документы читаются без замеров, чтобы не добавлять работы на каждую строку списка.
+        """
+        with self.storage_timer(operation):
+            return await anext(items, None)
+
+    def render(self) -> str:
+        return self.registry.render()
@@ -0,0 +1,183 @@
+"""Версионные миграции схемы PostgreSQL.
+
+Примененные версии записываются в таблицу schema_migrations. При старте с актуальной схемой
+выполняется один запрос чтения версии и никакого DDL. Недостающие миграции применяются одним
+скриптом в одной транзакции под advisory-блокировкой, поэтому процессы сервера, стартующие
+одновременно, не применяют их дважды.
+
+Скрипты миграций идемпотентны: базы, созданные до появления миграций, уже содержат часть таблиц.
+"""
+import logging
+from typing import List, Tuple
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки на время применения миграций
+MIGRATIONS_LOCK_KEY = 7215001
+
+# Версия, имя и скрипт; новые миграции добавляются только в конец
+MIGRATIONS: List[Tuple[int, str, str]] = [
+    (1, 'initial', """
+        CREATE TABLE IF NOT EXISTS virtual_machines (
+            id SERIAL PRIMARY KEY,
+            vm_id VARCHAR(50) UNIQUE,
+            ram INTEGER,
+            cpu INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS disks (
+            id SERIAL PRIMARY KEY,
+            disk_id VARCHAR(50) UNIQUE,
+            size INTEGER,
+            vm_id INTEGER REFERENCES virtual_machines(id)
+        );
+    """),
+    (2, 'vm_sessions', """
+        CREATE TABLE IF NOT EXISTS vm_sessions (
+            vm_id VARCHAR(50) PRIMARY KEY,
+            seq BIGSERIAL,
+            ram INTEGER,
+            cpu INTEGER,
+            authorized BOOLEAN NOT NULL DEFAULT false
+        );
+        CREATE SEQUENCE IF NOT EXISTS vm_events_seq;
+    """),
+    (3, 'vm_sessions_expires_at', """
+        ALTER TABLE vm_sessions ADD COLUMN IF NOT EXISTS expires_at DOUBLE PRECISION;
+    """),
+    (4, 'indexes_and_cascade', """
+        -- Диски ВМ ищутся по vm_id при выдаче списков ВМ и их дисков
+        CREATE INDEX IF NOT EXISTS disks_vm_id_idx ON disks (vm_id);
+        CREATE INDEX IF NOT EXISTS virtual_machines_ram_idx ON virtual_machines (ram);
+        CREATE INDEX IF NOT EXISTS virtual_machines_cpu_idx ON virtual_machines (cpu);
+        -- Удаление ВМ удаляет и ее диски
+        ALTER TABLE disks
+            DROP CONSTRAINT IF EXISTS disks_vm_id_fkey,
+            ADD CONSTRAINT disks_vm_id_fkey FOREIGN KEY (vm_id) REFERENCES virtual_machines (id) ON DELETE CASCADE;
+    """),
+    (5, 'vm_totals', """
+        ALTER TABLE vm_sessions
+            ADD COLUMN IF NOT EXISTS disks INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS disk_size BIGINT NOT NULL DEFAULT 0;
+
+        -- Итоги по всем ВМ в одной строке, которую поддерживают триггеры уровня оператора:
+        -- пакетная запись обновляет строку один раз на оператор, а не на каждую ВМ или диск
+        CREATE TABLE IF NOT EXISTS vm_totals (
+            id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+            vms BIGINT NOT NULL,
+            ram BIGINT NOT NULL,
+            cpu BIGINT NOT NULL,
+            disks BIGINT NOT NULL,
+            disk_size BIGINT NOT NULL
+        );
+        -- Записи не должны проскочить между начальным подсчетом и созданием триггеров
+        LOCK TABLE virtual_machines, disks IN SHARE ROW EXCLUSIVE MODE;
+        INSERT INTO vm_totals (vms, ram, cpu, disks, disk_size)
+        SELECT
+            (SELECT count(*) FROM virtual_machines),
+            (SELECT coalesce(sum(ram), 0) FROM virtual_machines),
+            (SELECT coalesce(sum(cpu), 0) FROM virtual_machines),
+            (SELECT count(*) FROM disks),
+            (SELECT coalesce(sum(size), 0) FROM disks)
+        ON CONFLICT (id) DO NOTHING;
+
+        CREATE OR REPLACE FUNCTION vm_totals_vms() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                UPDATE vm_totals SET vms = vm_totals.vms + d.n, ram = vm_totals.ram + d.ram, cpu = vm_totals.cpu + d.cpu
+                FROM (SELECT count(*) AS n, coalesce(sum(ram), 0) AS ram, coalesce(sum(cpu), 0) AS cpu
+                      FROM new_rows) d
+                WHERE d.n > 0;
+            END IF;
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                UPDATE vm_totals SET vms = vm_totals.vms - d.n, ram = vm_totals.ram - d.ram, cpu = vm_totals.cpu - d.cpu
+                FROM (SELECT count(*) AS n, coalesce(sum(ram), 0) AS ram, coalesce(sum(cpu), 0) AS cpu
+                      FROM old_rows) d
+                WHERE d.n > 0;
+            END IF;
+            RETURN NULL;
+        END $$;
+
+        CREATE OR REPLACE FUNCTION vm_totals_disks() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                UPDATE vm_totals SET disks = vm_totals.disks + d.n, disk_size = vm_totals.disk_size + d.size
+                FROM (SELECT count(*) AS n, coalesce(sum(size), 0) AS size FROM new_rows) d
+                WHERE d.n > 0;
+            END IF;
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                UPDATE vm_totals SET disks = vm_totals.disks - d.n, disk_size = vm_totals.disk_size - d.size
+                FROM (SELECT count(*) AS n, coalesce(sum(size), 0) AS size FROM old_rows) d
+                WHERE d.n > 0;
+            END IF;
+            RETURN NULL;
+        END $$;
+
+        DROP TRIGGER IF EXISTS vm_totals_vms_insert ON virtual_machines;
+        DROP TRIGGER IF EXISTS vm_totals_vms_update ON virtual_machines;
+        DROP TRIGGER IF EXISTS vm_totals_vms_delete ON virtual_machines;
+        CREATE TRIGGER vm_totals_vms_insert AFTER INSERT ON virtual_machines
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION vm_totals_vms();
+        CREATE TRIGGER vm_totals_vms_update AFTER UPDATE ON virtual_machines
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION vm_totals_vms();
+        CREATE TRIGGER vm_totals_vms_delete AFTER DELETE ON virtual_machines
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION vm_totals_vms();
+
+        DROP TRIGGER IF EXISTS vm_totals_disks_insert ON disks;
+        DROP TRIGGER IF EXISTS vm_totals_disks_update ON disks;
+        DROP TRIGGER IF EXISTS vm_totals_disks_delete ON disks;
+        CREATE TRIGGER vm_totals_disks_insert AFTER INSERT ON disks
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION vm_totals_disks();
+        CREATE TRIGGER vm_totals_disks_update AFTER UPDATE ON disks
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION vm_totals_disks();
+        CREATE TRIGGER vm_totals_disks_delete AFTER DELETE ON disks
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION vm_totals_disks();
+    """),
+    (6, 'query_indexes', """
+        -- Поиск по префиксу vm_id: побайтовое сравнение, не зависящее от правил сортировки базы
+        CREATE INDEX IF NOT EXISTS virtual_machines_vm_id_pattern_idx ON virtual_machines (vm_id text_pattern_ops);
+        -- Поиск ВМ по размеру диска
+        CREATE INDEX IF NOT EXISTS disks_size_idx ON disks (size);
+    """),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def current_version(conn: asyncpg.Connection) -> int:
+    """Последняя примененная версия схемы; 0 для пустой базы и базы без миграций"""
+    try:
+        return await conn.fetchval("SELECT coalesce(max(version), 0) FROM schema_migrations")
+    except asyncpg.UndefinedTableError:
+        return 0
+
+
+async def migrate(conn: asyncpg.Connection) -> List[int]:
+    """Применение недостающих миграций; возвращает примененные версии"""
+    if await current_version(conn) >= LATEST_VERSION:
+        return []
+
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATIONS_LOCK_KEY)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """)
+        # Версия перечитывается под блокировкой: миграции мог применить другой процесс
+        version = await current_version(conn)
+        pending = [migration for migration in MIGRATIONS if migration[0] > version]
+        if not pending:
+            return []
+        script = '\n'.join(
+            f"{sql}\nINSERT INTO schema_migrations (version, name) VALUES ({number}, '{name}');"
+            for number, name, sql in pending
+        )
+        await conn.execute(script)
+
+    applied = [number for number, _, _ in pending]
+    logger.info("Применены миграции схемы: %s", applied)
+    return applied
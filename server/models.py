@@ -0,0 +1,56 @@
+import json
+from typing import Any, Iterable, Tuple
+
+try:
+    import orjson
+except ImportError:  # Необязательная зависимость: ускоряет сериализацию ответов
+    orjson = None
+
+
+class Disk:
+    """Диск ВМ"""
+    __slots__ = ('disk_id', 'size')
+
+    def __init__(self, disk_id: str, size: int):
+        self.disk_id = disk_id
+        self.size = size
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, Disk) and (self.disk_id, self.size) == (other.disk_id, other.size)
+
+    def __repr__(self) -> str:
+        return f"Disk({self.disk_id!r}, {self.size!r})"
+
+
+class VirtualMachine:
+    """ВМ с дисками.
+
+    Без __dict__ и со списком дисков в кортеже: ВМ хранятся в памяти для каждого подключения,
+    а ВМ без дисков не держит даже пустой список.
+    """
+    __slots__ = ('vm_id', 'ram', 'cpu', 'disks')
+
+    def __init__(self, vm_id: str, ram: int, cpu: int, disks: Iterable[Disk] = ()):
+        self.vm_id = vm_id
+        self.ram = ram
+        self.cpu = cpu
+        self.disks: Tuple[Disk, ...] = tuple(disks)
+
+
+class RawJSON(str):
+    """Готовый JSON-текст, который пишется в ответ без повторной сериализации"""
+    __slots__ = ()
+
+
+def json_dumps(obj: Any) -> bytes:
+    """Сериализация в JSON: orjson, если установлен, иначе стандартный json"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+def json_loads(data: bytes) -> Any:
+    """Разбор JSON: orjson, если установлен, иначе стандартный json; ошибка — ValueError"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
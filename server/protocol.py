@@ -0,0 +1,204 @@
+"""Компактный протокол поверх TCP для частых операций агентов ВМ.
+
+Каждое сообщение — кадр: длина тела (4 байта, big-endian) и тело в msgpack или JSON. Запрос —
+массив [id, операция, тело], где тело такое же, как JSON-тело HTTP-маршрута; ответ — массив
+[id, статус, результат] со статусами как у HTTP. Ответ кодируется так же, как запрос: тело JSON
+начинается с '[' и по первому байту отличается от массива msgpack.
+
+Клиент может отправлять запросы, не дожидаясь ответов. Запросы одного соединения выполняются
+по порядку, поэтому подключение и следующая за ним авторизация ВМ не меняются местами. Ответы,
+готовые к моменту записи, отправляются одним вызовом write. Если клиент не читает ответы или
+отправляет больше PROTOCOL_MAX_PIPELINE запросов вперед, чтение из соединения приостанавливается.
+"""
+import asyncio
+import json
+import logging
+import os
+import struct
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+try:
+    import msgpack
+except ImportError:  # Необязательная зависимость: без нее используется JSON
+    msgpack = None
+
+from logs import start_request
+from metrics import ServerMetrics
+from models import json_dumps
+
+logger = logging.getLogger(__name__)
+
+# Максимальный размер тела кадра, байты
+PROTOCOL_MAX_FRAME = int(os.getenv("PROTOCOL_MAX_FRAME", str(1 << 20)))
+# Число принятых и еще не выполненных запросов соединения, после которого чтение приостанавливается
+PROTOCOL_MAX_PIPELINE = int(os.getenv("PROTOCOL_MAX_PIPELINE", "1000"))
+# Максимальное число ответов в одной записи в сокет
+PROTOCOL_WRITE_BATCH = 256
+
+HEADER = struct.Struct('>I')
+
+Handler = Callable[[Any], Awaitable[Any]]
+
+
+class RequestError(Exception):
+    """Ошибка запроса с HTTP-статусом ответа"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class FrameTooLarge(Exception):
+    pass
+
+
+def encode_frame(message: Any, binary: bool) -> bytes:
+    """Кадр с сообщением в msgpack (binary) или JSON"""
+    body = msgpack.packb(message) if binary else json_dumps(message)
+    return HEADER.pack(len(body)) + body
+
+
+def decode_body(body: bytes) -> Tuple[Any, bool]:
+    """Сообщение из тела кадра и признак msgpack"""
+    if body[:1] == b'[':
+        return json.loads(body), False
+    if msgpack is None:
+        raise ValueError("сервер не поддерживает msgpack, используйте JSON")
+    return msgpack.unpackb(body), True
+
+
+class FrameDecoder:
+    """Разбор потока байтов на тела кадров"""
+
+    def __init__(self, max_frame: int = PROTOCOL_MAX_FRAME):
+        self.max_frame = max_frame
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[bytes]:
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            (size,) = HEADER.unpack_from(self.buffer, offset)
+            if size > self.max_frame:
+                raise FrameTooLarge(f"кадр {size} байт больше допустимых {self.max_frame}")
+            end = offset + HEADER.size + size
+            if len(self.buffer) < end:
+                break
+            frames.append(bytes(self.buffer[offset + HEADER.size:end]))
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+
+class VMProtocol(asyncio.Protocol):
+    """Соединение протокола: разбор кадров, выполнение запросов по порядку и пакетная запись ответов"""
+
+    def __init__(self, handlers: Dict[str, Handler], metrics: Optional[ServerMetrics] = None,
+                 max_pipeline: int = PROTOCOL_MAX_PIPELINE, connections: Optional[set] = None):
+        self.handlers = handlers
+        self.metrics = metrics
+        self.max_pipeline = max_pipeline
+        self.connections = connections
+        self.decoder = FrameDecoder()
+        self.pending: Deque[bytes] = deque()
+        self.ready = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.reading_paused = False
+        self.transport: Optional[asyncio.Transport] = None
+        self.worker: Optional[asyncio.Task] = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        self.worker = asyncio.get_running_loop().create_task(self.process())
+        if self.connections is not None:
+            self.connections.add(self)
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if self.worker is not None:
+            self.worker.cancel()
+        if self.connections is not None:
+            self.connections.discard(self)
+
+    def data_received(self, data: bytes):
+        try:
+            frames = self.decoder.feed(data)
+        except FrameTooLarge as e:
+            logger.error("Протокол: %s, соединение закрыто", e)
+            self.transport.close()
+            return
+        if not frames:
+            return
+        self.pending.extend(frames)
+        self.ready.set()
+        if len(self.pending) >= self.max_pipeline and not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    async def process(self):
+        """Выполнение запросов соединения по порядку"""
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.pending:
+                responses = []
+                while self.pending and len(responses) < PROTOCOL_WRITE_BATCH:
+                    responses.append(await self.handle(self.pending.popleft()))
+                # Клиент не читает ответы: следующая запись ждет, пока буфер сокета освободится
+                await self.writable.wait()
+                self.transport.write(b''.join(responses))
+                if self.reading_paused and len(self.pending) < self.max_pipeline // 2:
+                    self.reading_paused = False
+                    self.transport.resume_reading()
+
+    async def handle(self, body: bytes) -> bytes:
+        """Выполнение одного запроса; ошибка запроса возвращается в ответе, соединение не закрывается"""
+        started = time.perf_counter()
+        # Запросы соединения выполняются по одному в задаче process: идентификатор для логов задается на каждый
+        start_request()
+        request_id, operation, binary = None, 'invalid', bool(body[:1] != b'[' and msgpack is not None)
+        try:
+            message, binary = decode_body(body)
+            request_id, name, payload = message
+            handler = self.handlers.get(name) if isinstance(name, str) else None
+            if handler is None:
+                # Метка метрики не зависит от присланных имен: число серий ограничено
+                operation = 'unknown'
+                raise RequestError(404, f"неизвестная операция {name!r}")
+            operation = name
+            status, result = 200, await handler(payload)
+        except RequestError as e:
+            status, result = e.status, str(e)
+        except (ValueError, TypeError, KeyError) as e:
+            status, result = 400, f"некорректный запрос: {e}"
+        except Exception as e:
+            logger.error("Протокол: ошибка операции %s: %s", operation, e)
+            status, result = 500, "внутренняя ошибка сервера"
+        if self.metrics is not None:
+            self.metrics.observe_protocol(operation, status, time.perf_counter() - started)
+        return encode_frame([request_id, status, result], binary)
+
+
+async def serve(handlers: Dict[str, Handler], host: Optional[str], port: int,
+                metrics: Optional[ServerMetrics] = None, reuse_port: bool = False,
+                connections: Optional[set] = None) -> asyncio.AbstractServer:
+    """Запуск TCP-сервера протокола"""
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: VMProtocol(handlers, metrics, connections=connections),
+                                      host, port, reuse_port=reuse_port or None)
+    logger.info("Протокол TCP слушает порт %s", server.sockets[0].getsockname()[1])
+    return server
@@ -0,0 +1,80 @@
+"""Разбор и проверка тел запросов записи ВМ.
+
+Тело проверяется по схеме полей до обращения к менеджеру: отсутствующее поле, неверный тип
+или значение, которое не поместится в столбец базы, дают ValidationError с путем к полю,
+а обработчики отвечают на нее 400. Лишние поля не проверяются и отбрасываются.
+"""
+from typing import Any, Dict
+
+from models import Disk, VirtualMachine, json_loads
+
+# Ограничения столбцов базы: VARCHAR(50) и INTEGER
+MAX_ID_LENGTH = 50
+MAX_INT = 2 ** 31 - 1
+
+
+class ValidationError(ValueError):
+    """Тело запроса не соответствует схеме; текст указывает поле"""
+
+
+def parse_json(body: bytes) -> Any:
+    """Разбор тела запроса в JSON"""
+    if not body:
+        raise ValidationError("пустое тело запроса")
+    try:
+        return json_loads(body)
+    except ValueError as e:
+        raise ValidationError(f"некорректный JSON: {e}")
+
+
+def _object(data: Any, path: str = '') -> Dict[str, Any]:
+    if not isinstance(data, dict):
+        raise ValidationError(f"{path}: ожидается JSON-объект" if path else "ожидается JSON-объект")
+    return data
+
+
+def _field(data: Dict[str, Any], name: str, path: str) -> Any:
+    try:
+        return data[name]
+    except KeyError:
+        raise ValidationError(f"{path}{name}: обязательное поле")
+
+
+def _id(value: Any, path: str) -> str:
+    if not isinstance(value, str) or not value:
+        raise ValidationError(f"{path}: ожидается непустая строка")
+    if len(value) > MAX_ID_LENGTH:
+        raise ValidationError(f"{path}: длиннее {MAX_ID_LENGTH} символов")
+    return value
+
+
+def _int(value: Any, path: str) -> int:
+    # bool — подкласс int, но true вместо числа почти наверняка ошибка клиента
+    if not isinstance(value, int) or isinstance(value, bool) or not 0 <= value <= MAX_INT:
+        raise ValidationError(f"{path}: ожидается целое число от 0 до {MAX_INT}")
+    return value
+
+
+def decode_disk(data: Any, path: str) -> Disk:
+    data = _object(data, path)
+    return Disk(_id(_field(data, 'disk_id', f"{path}."), f"{path}.disk_id"),
+                _int(_field(data, 'size', f"{path}."), f"{path}.size"))
+
+
+def decode_vm(data: Any) -> VirtualMachine:
+    """ВМ из тела /add_vm, /update_vm, /connect_vm или записи /add_vms"""
+    data = _object(data)
+    disks = _field(data, 'disks', '')
+    if not isinstance(disks, list):
+        raise ValidationError("disks: ожидается массив")
+    return VirtualMachine(
+        _id(_field(data, 'vm_id', ''), 'vm_id'),
+        _int(_field(data, 'ram', ''), 'ram'),
+        _int(_field(data, 'cpu', ''), 'cpu'),
+        [decode_disk(disk, f"disks[{index}]") for index, disk in enumerate(disks)],
+    )
+
+
+def decode_vm_id(data: Any) -> str:
+    """vm_id из тела /authorize_vm, /deauthorize_vm или /heartbeat"""
+    return _id(_field(_object(data), 'vm_id', ''), 'vm_id')
@@ -1,70 +1,465 @@
+import asyncio
+import codecs
 import json
 import logging
+import multiprocessing
+import multiprocessing.connection
 import os
-from typing import List, Dict, Any
+import secrets
+import signal
+import tempfile
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple
 
-import asyncpg
-from aiohttp import web
+from aiohttp import StreamReader, web
+
+from coalescer import Write, WriteCoalescer
+from events import EVENT_TYPES, EVENTS_KEEPALIVE, EventBus
+from expiry import ExpiryHeap
+from logs import REQUEST_ID_HEADER, SampledAccessLogger, SampledLogger, setup_logging, start_request, stop_logging
+from stats import ResourceTotals, Usage, vm_usage
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Counter, Gauge, ServerMetrics
+from models import VirtualMachine, RawJSON, json_dumps
+from schema import ValidationError, decode_vm, decode_vm_id, parse_json
+from protocol import Handler, RequestError, serve as serve_protocol
+from storage import (QUERY_SORT_FIELDS, STORAGE_BACKEND, SharedStorage, Storage, VMQuery, create_storage,
+                     join_documents, storage_class)
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# Сообщения об успешных операциях пишутся для доли запросов LOG_SAMPLE_RATE
+sampled_logger = SampledLogger(logger)
+
+# Число процессов сервера; при нескольких процессах они принимают соединения на общем порту (SO_REUSEPORT)
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Состояние подключения и авторизации ВМ хранится в общем хранилище, а не только в памяти процесса
+SHARED_STATE = os.getenv("SHARED_STATE", "1" if WORKERS > 1 else "0") == "1"
+PORT = int(os.getenv("PORT", "8080"))
+# Порт протокола TCP для агентов ВМ; 0 отключает протокол
+PROTOCOL_PORT = int(os.getenv("PROTOCOL_PORT", "0"))
+# Пауза перед перезапуском упавшего процесса, секунды
+WORKER_RESTART_DELAY = 1.0
+
+# Время жизни подключения ВМ без heartbeat, секунды; 0 — подключения не истекают
+CONNECTION_TTL = float(os.getenv("CONNECTION_TTL", "0"))
+# Пауза перед повтором, если истекшие подключения не удалось удалить из общего хранилища, секунды
+EXPIRY_RETRY_DELAY = 1.0
+
+# Окно объединения одновременных записей /add_vm и /update_vm в одну транзакцию, секунды; 0 — без объединения
+WRITE_COALESCE_WINDOW = float(os.getenv("WRITE_COALESCE_WINDOW", "0"))
+# Максимальное число записей в одной транзакции; заполненный пакет применяется, не дожидаясь конца окна
+WRITE_COALESCE_MAX_BATCH = int(os.getenv("WRITE_COALESCE_MAX_BATCH", "500"))
+
+# Максимальный размер страницы при keyset-пагинации списков
+MAX_PAGE_LIMIT = 10000
+# Параметры запроса /query
+QUERY_PARAMS = {
+    'ram', 'ram_min', 'ram_max', 'cpu', 'cpu_min', 'cpu_max', 'disk_size', 'disk_size_min', 'disk_size_max',
+    'prefix', 'state', 'sort', 'limit', 'format',
+}
+# Размер фрагмента, которым потоковый ответ пишется в сокет
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Кеш ответов списков: число записей, общий объем и максимальный размер одного ответа
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "256"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_MAX_ENTRY_BYTES = int(os.getenv("CACHE_MAX_ENTRY_BYTES", str(8 * 1024 * 1024)))
+
+# Число ВМ, записываемых одной транзакцией при пакетной загрузке
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+# Максимальный размер одной записи при пакетной загрузке
+BULK_MAX_RECORD_SIZE = 1024 * 1024
+# Объем результатов пакетной загрузки, после которого они сбрасываются из памяти на диск
+BULK_RESULTS_SPOOL_SIZE = 1024 * 1024
+
+
+def encode_item(item: Any) -> bytes:
+    """Кодирование элемента списка: готовый JSON из базы пишется как есть"""
+    if isinstance(item, RawJSON):
+        return item.encode()
+    return json_dumps(item)
+
+
+class InventoryCache:
+    """Версионированный кеш ответов списков с вытеснением давно не использованных записей.
 
-DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://user:password@db:5432/yourdatabase")
+    Данные делятся на области: 'vms' (ВМ и диски в базе) и 'state' (подключения и авторизации).
+    Запись в область увеличивает ее версию, и все ответы, зависящие от области, становятся
+    устаревшими. Версии входят в ETag, поэтому If-None-Match проверяется без обращения к базе.
+    Ключ записи — кортеж, второй элемент которого содержит области, от которых зависит ответ.
+    """
 
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES,
+                 max_entry_bytes: int = CACHE_MAX_ENTRY_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        # Версии не переживают перезапуск, поэтому ETag дополняется идентификатором процесса
+        self.instance = secrets.token_hex(4)
+        self.versions: Dict[str, int] = {'vms': 0, 'state': 0}
+        self.entries: OrderedDict = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
 
-class VirtualMachine:
-    def __init__(self, vm_id: str, ram: int, cpu: int, disks: List[Dict[str, Any]]):
-        self.vm_id = vm_id
-        self.ram = ram
-        self.cpu = cpu
-        self.disks = disks
+    def invalidate(self, scope: str):
+        """Сброс всех ответов, зависящих от области данных"""
+        self.versions[scope] += 1
+
+    def tag(self, scopes: Tuple[str, ...]) -> str:
+        """Текущая версия набора областей"""
+        return self.instance + '-' + '.'.join(str(self.versions[scope]) for scope in scopes)
+
+    def get(self, key: Tuple, tag: str) -> Optional[Tuple[bytes, str, Dict[str, str]]]:
+        """Актуальный ответ из кеша: тело, тип содержимого и заголовки ответа"""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != tag:
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1], entry[2], entry[3]
+
+    def put(self, key: Tuple, tag: str, body: bytes, content_type: str,
+            headers: Optional[Dict[str, str]] = None):
+        """Сохранение ответа, если он не устарел за время построения и помещается в лимиты.
+
+        headers — заголовки, которые зависят от содержимого ответа (например, X-Next-After)
+        и отправляются вместе с ним при попадании в кеш.
+        """
+        if len(body) > self.max_entry_bytes or len(body) > self.max_bytes:
+            return
+        if self.tag(key[1]) != tag:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (tag, body, content_type, headers or {})
+        self.size += len(body)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: Tuple):
+        _, body, _, _ = self.entries.pop(key)
+        self.size -= len(body)
+
+    def stats(self) -> Dict[str, Any]:
+        """Состояние кеша"""
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'versions': dict(self.versions),
+        }
+
+
+class BodyCapture:
+    """Копия потокового ответа для кеша; при превышении лимита копирование прекращается"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.buffer: Optional[bytearray] = bytearray()
+
+    def write(self, data: bytes):
+        if self.buffer is None:
+            return
+        if len(self.buffer) + len(data) > self.limit:
+            self.buffer = None
+            return
+        self.buffer += data
 
 
 class VMManager:
-    def __init__(self):
+    """Управление ВМ.
+
+    Подключенные и авторизованные ВМ хранятся в памяти процесса. С shared_state они дополнительно
+    записываются в общее хранилище, а словари в памяти становятся зеркалом, которое обновляется
+    уведомлениями от всех процессов сервера.
+
+    С connection_ttl подключение, не продленное heartbeat за это время, истекает: ВМ удаляется
+    из подключенных и авторизованных.
+
+    С write_coalesce_window одновременные добавления и обновления ВМ применяются пакетами
+    одной транзакцией; ответ на запрос отправляется после фиксации его пакета.
+    """
+
+    def __init__(self, storage: Optional[Storage] = None, shared_state: bool = SHARED_STATE,
+                 connection_ttl: float = CONNECTION_TTL, write_coalesce_window: float = WRITE_COALESCE_WINDOW,
+                 write_coalesce_max_batch: int = WRITE_COALESCE_MAX_BATCH):
         self.connected_vms: Dict[str, VirtualMachine] = {}
         self.authorized_vms: set = set()
         self.all_vms: set = set()
+        self.storage = storage if storage is not None else create_storage()
+        if shared_state and not isinstance(self.storage, SharedStorage):
+            raise ValueError(f"Хранилище {self.storage.backend} не поддерживает общее состояние нескольких процессов")
+        self.shared_state = shared_state
+        self.connection_ttl = connection_ttl
+        self.expiry = ExpiryHeap()
+        self.expiry_wakeup = asyncio.Event()
+        self.expiry_task: Optional[asyncio.Task] = None
+        self.expired = 0
+        # Вклад подключенных ВМ в итоги /stats и сами итоги по состояниям
+        self.usage: Dict[str, Usage] = {}
+        self.connected_totals = ResourceTotals()
+        self.authorized_totals = ResourceTotals()
+        self.writes: Optional[WriteCoalescer] = None
+        if write_coalesce_window:
+            self.writes = WriteCoalescer(self._flush_writes, write_coalesce_window, write_coalesce_max_batch)
+        self.cache = InventoryCache()
+        # Номера событий из общего хранилища переживают перезапуск, собственные номера процесса — нет
+        self.events = EventBus(epoch='' if shared_state else None)
+        self.metrics = ServerMetrics()
+        self._register_collectors()
+
+    def _register_collectors(self):
+        """Метрики состояния, которые читаются из менеджера, пула и кеша только при выдаче /metrics"""
+        registry = self.metrics.registry
+        registry.register(Gauge('vm_state_vms', 'Число ВМ по состоянию', ('state',), lambda: {
+            ('connected',): len(self.connected_vms),
+            ('authorized',): len(self.authorized_vms),
+        }))
+        registry.register(Gauge('vm_db_pool_connections', 'Соединения пула с базой данных', ('state',),
+                                lambda: self._pool_stats(('size', 'idle', 'in_use', 'max_size'))))
+        registry.register(Gauge('vm_db_pool_saturation', 'Доля занятых соединений пула', (),
+                                lambda: self._pool_stats(('saturation',))))
+        registry.register(Counter('vm_list_cache_requests_total', 'Обращения к кешу списков', ('result',), lambda: {
+            ('hit',): self.cache.hits,
+            ('miss',): self.cache.misses,
+        }))
+        registry.register(Gauge('vm_list_cache_bytes', 'Объем ответов в кеше списков', (), lambda: {(): self.cache.size}))
+        registry.register(Counter('vm_connections_expired_total', 'Подключения ВМ, истекшие без heartbeat', (),
+                                  lambda: {(): self.expired}))
+        registry.register(Gauge('vm_connections_expiry_scheduled', 'Подключения ВМ с отслеживаемым сроком истечения', (),
+                                lambda: {(): len(self.expiry)}))
+        if self.writes is not None:
+            registry.register(Counter('vm_write_batches_total', 'Пакеты объединенных записей ВМ', (),
+                                      lambda: {(): self.writes.batches}))
+            registry.register(Counter('vm_write_batch_writes_total', 'Записи ВМ, примененные в составе пакетов', (),
+                                      lambda: {(): self.writes.writes}))
+        registry.register(Gauge('vm_events_subscribers', 'Подписчики ленты изменений', (),
+                                lambda: {(): len(self.events.subscriptions)}))
+        registry.register(Counter('vm_events_published_total', 'Опубликованные события ленты изменений', (),
+                                  lambda: {(): self.events.published}))
+        registry.register(Counter('vm_events_dropped_subscribers_total',
+                                  'Подписчики, отключенные из-за переполнения буфера', (),
+                                  lambda: {(): self.events.dropped}))
+
+    def _pool_stats(self, fields: Tuple[str, ...]) -> Dict[Tuple[str, ...], float]:
+        """Значения статистики пула соединений; пусто, пока пула нет"""
+        pool = self.storage.stats().get('pool')
+        if not pool:
+            return {}
+        if len(fields) == 1:
+            return {(): pool[fields[0]]}
+        return {(field,): pool[field] for field in fields}
 
     async def init_db(self):
-        """Инициализация базы данных"""
-        logger.info("Подключение к базе данных")
+        """Инициализация хранилища"""
+        try:
+            await self.storage.init()
+            if self.shared_state:
+                # Подписка до чтения состояния, чтобы не пропустить изменения между ними
+                await self.storage.listen(self.apply_change, self.load_state)
+                await self.load_state()
+            if self.connection_ttl:
+                self.expiry_task = asyncio.get_running_loop().create_task(self.run_expiry())
+            logger.info("Хранилище %s успешно инициализировано", self.storage.backend)
+        except Exception as e:
+            logger.error("Ошибка инициализации базы данных: %s", e)
+
+    async def close_db(self):
+        """Освобождение ресурсов хранилища"""
+        if self.expiry_task is not None:
+            self.expiry_task.cancel()
+            self.expiry_task = None
+        if self.writes is not None:
+            await self.writes.close()
+        await self.storage.close()
+
+    async def load_state(self):
+        """Загрузка подключенных и авторизованных ВМ из общего хранилища"""
+        sessions = await self.storage.load_sessions()
+        self.connected_vms = {session.vm.vm_id: session.vm for session in sessions}
+        self.authorized_vms = {session.vm.vm_id for session in sessions if session.authorized}
+        self.all_vms |= self.connected_vms.keys()
+        self.usage = {session.vm.vm_id: session.usage for session in sessions}
+        self.connected_totals = ResourceTotals.of(self.usage.values())
+        self.authorized_totals = ResourceTotals.of(self.usage[vm_id] for vm_id in self.authorized_vms)
+        if self.connection_ttl:
+            self.expiry = ExpiryHeap()
+            for session in sessions:
+                self._schedule_expiry(session.vm.vm_id, session.expires_at or time.time() + self.connection_ttl)
+        # Изменения ВМ, пропущенные без подписки, тоже могли устареть в кеше
+        self.cache.invalidate('state')
+        self.cache.invalidate('vms')
+        logger.info("Загружено общее состояние: подключено ВМ %s", len(self.connected_vms))
+
+    def apply_change(self, event: Dict[str, Any]):
+        """Применение изменения общего состояния, сделанного любым процессом сервера, и публикация события"""
+        op = event.get('op')
+        if op == 'connect':
+            self._set_connected(VirtualMachine(event['vm_id'], event['ram'], event['cpu'], []),
+                                Usage(event['ram'] or 0, event['cpu'] or 0, event['disks'], event['disk_size']))
+            if self.connection_ttl:
+                # Точный срок знает хранилище; он уточняется, когда этот срок подходит
+                self._schedule_expiry(event['vm_id'], time.time() + self.connection_ttl)
+        elif op == 'expire':
+            self._remove_connected(event['vm_id'])
+        elif op in ('authorize', 'deauthorize'):
+            self._set_authorized(event['vm_id'], op == 'authorize')
+        elif op in ('add', 'update'):
+            self.cache.invalidate('vms')
+        else:
+            return
+        self.events.publish(op, {'vm_id': event['vm_id'], 'ram': event['ram'], 'cpu': event['cpu']}, event['seq'])
+
+    def _publish(self, op: str, vm_id: str, ram: Optional[int], cpu: Optional[int]):
+        """Публикация события об изменении, сделанном этим процессом.
+
+        С общим состоянием события публикует apply_change по уведомлениям хранилища, чтобы все процессы
+        получили одинаковую ленту с общими номерами.
+        """
+        if not self.shared_state:
+            self.events.publish(op, {'vm_id': vm_id, 'ram': ram, 'cpu': cpu})
+
+    def _set_connected(self, vm: VirtualMachine, usage: Usage):
+        current = self.connected_vms.get(vm.vm_id)
+        if current is not None and (current.ram, current.cpu) == (vm.ram, vm.cpu) and self.usage.get(vm.vm_id) == usage:
+            return
+        self.connected_vms[vm.vm_id] = vm
+        self.all_vms.add(vm.vm_id)
+        self._track_usage(vm.vm_id, usage)
+        self.cache.invalidate('state')
+
+    def _remove_connected(self, vm_id: str) -> bool:
+        """Удаление ВМ из подключенных и авторизованных"""
+        self.expiry.remove(vm_id)
+        if self.connected_vms.pop(vm_id, None) is None:
+            return False
+        self._track_usage(vm_id, None)
+        self.authorized_vms.discard(vm_id)
+        self.cache.invalidate('state')
+        return True
+
+    def _schedule_expiry(self, vm_id: str, deadline: float):
+        head = self.expiry.next_deadline()
+        self.expiry.touch(vm_id, deadline)
+        if head is None or deadline < head:
+            self.expiry_wakeup.set()
+
+    async def run_expiry(self):
+        """Фоновое истечение подключений: ожидание до ближайшего срока в куче, без обхода всех подключений"""
+        while True:
+            head = self.expiry.next_deadline()
+            self.expiry_wakeup.clear()
+            try:
+                await asyncio.wait_for(self.expiry_wakeup.wait(), None if head is None else max(0.0, head - time.time()))
+            except asyncio.TimeoutError:
+                pass
+            now = time.time()
+            due = self.expiry.pop_due(now)
+            if due:
+                await self.expire_connections(due, now)
+
+    async def expire_connections(self, vm_ids: List[str], now: float):
+        """Удаление подключений, срок которых истек"""
+        if not self.shared_state:
+            for vm_id in vm_ids:
+                vm = self.connected_vms.get(vm_id)
+                if vm is not None and self._remove_connected(vm_id):
+                    self.expired += 1
+                    self._publish('expire', vm_id, vm.ram, vm.cpu)
+            logger.info("Истекли подключения ВМ: %s", vm_ids)
+            return
+
         try:
-            self.conn = await asyncpg.connect(DATABASE_URL)
-            await self.conn.execute("""
-                CREATE TABLE IF NOT EXISTS virtual_machines (
-                    id SERIAL PRIMARY KEY,
-                    vm_id VARCHAR(50) UNIQUE,
-                    ram INTEGER,
-                    cpu INTEGER
-                );
-                CREATE TABLE IF NOT EXISTS disks (
-                    id SERIAL PRIMARY KEY,
-                    disk_id VARCHAR(50) UNIQUE,
-                    size INTEGER,
-                    vm_id INTEGER REFERENCES virtual_machines(id)
-                );
-            """)
-            logger.info("База данных успешно инициализирована")
+            with self.metrics.storage_timer('expire_sessions'):
+                expired, remaining = await self.storage.expire_sessions(vm_ids, now)
         except Exception as e:
-            logger.error(f"Ошибка инициализации базы данных: {e}")
+            logger.error("Ошибка удаления истекших подключений: %s", e)
+            for vm_id in vm_ids:
+                self._schedule_expiry(vm_id, now + EXPIRY_RETRY_DELAY)
+            return
+        # Подключения удаляются из памяти по уведомлениям, здесь только продленные другими процессами
+        for vm_id, deadline in remaining.items():
+            self._schedule_expiry(vm_id, deadline)
+        self.expired += len(expired)
+        if expired:
+            logger.info("Истекли подключения ВМ: %s", expired)
+
+    async def heartbeat(self, vm_id: str) -> bool:
+        """Продление подключения ВМ; False, если ВМ не подключена"""
+        deadline = time.time() + self.connection_ttl if self.connection_ttl else None
+        if self.shared_state and deadline is not None:
+            try:
+                with self.metrics.storage_timer('touch_session'):
+                    connected = await self.storage.touch_session(vm_id, deadline)
+            except Exception as e:
+                logger.error("Ошибка продления подключения ВМ %s: %s", vm_id, e)
+                raise
+        else:
+            connected = vm_id in self.connected_vms
+        if connected and deadline is not None:
+            self._schedule_expiry(vm_id, deadline)
+        return connected
+
+    def _track_usage(self, vm_id: str, usage: Optional[Usage]):
+        """Замена вклада подключенной ВМ в итоги по состояниям; None исключает ВМ из итогов"""
+        authorized = vm_id in self.authorized_vms
+        previous = self.usage.pop(vm_id, None)
+        if previous is not None:
+            self.connected_totals.add(previous, -1)
+            if authorized:
+                self.authorized_totals.add(previous, -1)
+        if usage is not None:
+            self.usage[vm_id] = usage
+            self.connected_totals.add(usage)
+            if authorized:
+                self.authorized_totals.add(usage)
+
+    def _set_authorized(self, vm_id: str, authorized: bool) -> bool:
+        if authorized == (vm_id in self.authorized_vms):
+            return False
+        if authorized:
+            self.authorized_vms.add(vm_id)
+        else:
+            self.authorized_vms.discard(vm_id)
+        usage = self.usage.get(vm_id)
+        if usage is not None:
+            self.authorized_totals.add(usage, 1 if authorized else -1)
+        self.cache.invalidate('state')
+        return True
+
+    def _publish_authorized(self, op: str, vm_id: str):
+        vm = self.connected_vms.get(vm_id)
+        self._publish(op, vm_id, vm.ram if vm else None, vm.cpu if vm else None)
 
     async def add_vm(self, vm: VirtualMachine):
         """Добавление виртуальной машины в базу данных"""
         try:
-            await self.conn.execute('''
-                INSERT INTO virtual_machines (vm_id, ram, cpu) VALUES ($1, $2, $3)
-                ON CONFLICT (vm_id) DO NOTHING;
-            ''', vm.vm_id, vm.ram, vm.cpu)
-            for disk in vm.disks:
-                await self.conn.execute('''
-                    INSERT INTO disks (disk_id, size, vm_id) VALUES ($1, $2, (SELECT id FROM virtual_machines WHERE vm_id=$3))
-                    ON CONFLICT (disk_id) DO NOTHING;
-                ''', disk['disk_id'], disk['size'], vm.vm_id)
-            logger.info(f"Добавлена ВМ {vm.vm_id} с RAM: {vm.ram}, CPU: {vm.cpu}, дисками: {vm.disks}")
+            if self.writes is not None:
+                await self.writes.submit('add', vm)
+            else:
+                await self.add_vms([vm])
+            sampled_logger.info("Добавлена ВМ %s с RAM: %s, CPU: %s, дисков: %s", vm.vm_id, vm.ram, vm.cpu, len(vm.disks))
         except Exception as e:
-            logger.error(f"Ошибка добавления ВМ: {e}")
+            logger.error("Ошибка добавления ВМ: %s", e)
+
+    async def add_vms(self, vms: List[VirtualMachine]):
+        """Пакетное добавление виртуальных машин одной транзакцией; ошибка откатывает весь пакет"""
+        with self.metrics.storage_timer('add_vms'):
+            added = await self.storage.add_vms(vms)
+        self.cache.invalidate('vms')
+        if added and not self.shared_state:
+            # При повторе vm_id в пакете добавляется первая ВМ
+            by_id: Dict[str, VirtualMachine] = {}
+            for vm in vms:
+                by_id.setdefault(vm.vm_id, vm)
+            for vm_id in added:
+                self._publish('add', vm_id, by_id[vm_id].ram, by_id[vm_id].cpu)
 
     async def update_vm(self, vm: VirtualMachine):
         """Обновление данных авторизованной виртуальной машины"""
@@ -72,207 +467,972 @@ class VMManager:
             if vm.vm_id not in self.authorized_vms:
                 raise Exception("ВМ не авторизована")
 
-            await self.conn.execute('''
-                UPDATE virtual_machines SET ram = $1, cpu = $2 WHERE vm_id = $3;
-            ''', vm.ram, vm.cpu, vm.vm_id)
+            if self.writes is not None:
+                await self.writes.submit('update', vm)
+            else:
+                await self._update_stored(vm)
+            sampled_logger.info("Обновлена ВМ %s с RAM: %s, CPU: %s, дисков: %s", vm.vm_id, vm.ram, vm.cpu, len(vm.disks))
+        except Exception as e:
+            logger.error("Ошибка обновления ВМ: %s", e)
+
+    async def _update_stored(self, vm: VirtualMachine):
+        with self.metrics.storage_timer('update_vm'):
+            await self.storage.update_vm(vm)
+        self.cache.invalidate('vms')
+        self._publish('update', vm.vm_id, vm.ram, vm.cpu)
 
-            for disk in vm.disks:
-                await self.conn.execute('''
-                    INSERT INTO disks (disk_id, size, vm_id) VALUES ($1, $2, (SELECT id FROM virtual_machines WHERE vm_id=$3))
-                    ON CONFLICT (disk_id) DO UPDATE SET size = $2;
-                ''', disk['disk_id'], disk['size'], vm.vm_id)
+    async def _flush_writes(self, batch: List[Write]) -> List[Any]:
+        """Применение пакета записей одной транзакцией.
 
-            logger.info(f"Обновлена ВМ {vm.vm_id} с RAM: {vm.ram}, CPU: {vm.cpu}, дисками: {vm.disks}")
+        Если транзакция пакета не удалась, записи применяются по одной, чтобы ошибка одной записи
+        досталась только ее вызывающему, как без объединения.
+        """
+        adds = [write.vm for write in batch if write.kind == 'add']
+        updates = [write.vm for write in batch if write.kind == 'update']
+        try:
+            with self.metrics.storage_timer('write_vms'):
+                added, updated = await self.storage.write_vms(adds, updates)
         except Exception as e:
-            logger.error(f"Ошибка обновления ВМ: {e}")
+            if len(batch) == 1:
+                raise
+            logger.error("Ошибка пакетной записи %s ВМ, записи применяются по одной: %s", len(batch), e)
+            return [await self._write_one(write) for write in batch]
+
+        self.cache.invalidate('vms')
+        added, updated = set(added), set(updated)
+        results = []
+        for write in batch:
+            vm = write.vm
+            if write.kind == 'add':
+                if vm.vm_id in added:
+                    self._publish('add', vm.vm_id, vm.ram, vm.cpu)
+                results.append(None)
+            elif vm.vm_id in updated:
+                self._publish('update', vm.vm_id, vm.ram, vm.cpu)
+                results.append(None)
+            else:
+                results.append(Exception("ВМ не найдена в базе данных"))
+        return results
 
-    async def get_all_vms(self) -> List[Dict[str, Any]]:
-        """Получение списка всех виртуальных машин"""
+    async def _write_one(self, write: Write) -> Optional[Exception]:
         try:
-            vms = await self.conn.fetch('''
-                SELECT vm.*, COALESCE(json_agg(disk.*) FILTER (WHERE disk.id IS NOT NULL), '[]') AS disks
-                FROM virtual_machines vm
-                LEFT JOIN disks disk ON vm.id = disk.vm_id
-                GROUP BY vm.id
-            ''')
-            logger.info("Получен список всех ВМ")
-            return [dict(vm) for vm in vms]
+            if write.kind == 'add':
+                await self.add_vms([write.vm])
+            else:
+                await self._update_stored(write.vm)
         except Exception as e:
-            logger.error(f"Ошибка получения списка всех ВМ: {e}")
-            return []
+            return e
+        return None
 
-    async def get_connected_vms(self) -> List[Dict[str, Any]]:
-        """Получение списка подключенных виртуальных машин"""
+    async def iter_all_vms(self) -> AsyncIterator[RawJSON]:
+        """Потоковое получение всех виртуальных машин в порядке vm_id"""
         try:
-            vms = []
-            for vm in self.connected_vms.values():
-                disks = await self.conn.fetch('''
-                    SELECT * FROM disks WHERE vm_id = (SELECT id FROM virtual_machines WHERE vm_id = $1)
-                ''', vm.vm_id)
-                vm_info = {
-                    'vm_id': vm.vm_id,
-                    'ram': vm.ram,
-                    'cpu': vm.cpu,
-                    'disks': [dict(disk) for disk in disks]
-                }
-                vms.append(vm_info)
-            logger.info("Получен список подключенных ВМ")
-            return vms
+            items = self.storage.iter_all_vms()
+            doc = await self.metrics.timed_first('iter_all_vms', items)
+            if doc is not None:
+                yield doc
+                async for doc in items:
+                    yield doc
+            sampled_logger.info("Получен список всех ВМ")
         except Exception as e:
-            logger.error(f"Ошибка получения списка подключенных ВМ: {e}")
-            return []
+            logger.error("Ошибка получения списка всех ВМ: %s", e)
+            raise
+
+    async def get_vms_page(self, after: Optional[str], limit: int,
+                           ndjson: bool = False) -> Tuple[str, Optional[str], int]:
+        """Получение страницы ВМ с vm_id больше after одним документом.
 
-    async def get_authorized_vms(self) -> List[Dict[str, Any]]:
-        """Получение списка авторизованных виртуальных машин"""
+        Возвращает текст документа (JSON-массив или NDJSON), vm_id последней ВМ и число ВМ.
+        """
+        with self.metrics.storage_timer('get_vms_page'):
+            page = await self.storage.get_vms_page(after, limit, ndjson)
+        sampled_logger.info("Получена страница списка всех ВМ")
+        return page
+
+    async def iter_connected_vms(self, authorized_only: bool = False) -> AsyncIterator[RawJSON]:
+        """Потоковое получение подключенных виртуальных машин вместе с дисками.
+
+        RAM и CPU берутся из данных подключения, диски — из хранилища одним запросом на весь список.
+        """
+        vms = [vm for vm in self.connected_vms.values()
+               if not authorized_only or vm.vm_id in self.authorized_vms]
+        if not vms:
+            return
         try:
-            vms = []
-            for vm in self.connected_vms.values():
-                if vm.vm_id in self.authorized_vms:
-                    disks = await self.conn.fetch('''
-                        SELECT * FROM disks WHERE vm_id = (SELECT id FROM virtual_machines WHERE vm_id = $1)
-                    ''', vm.vm_id)
-                    vm_info = {
-                        'vm_id': vm.vm_id,
-                        'ram': vm.ram,
-                        'cpu': vm.cpu,
-                        'disks': [dict(disk) for disk in disks]
-                    }
-                    vms.append(vm_info)
-            logger.info("Получен список авторизованных ВМ")
-            return vms
+            items = self.storage.iter_vm_documents(vms)
+            doc = await self.metrics.timed_first('iter_vm_documents', items)
+            if doc is not None:
+                yield doc
+                async for doc in items:
+                    yield doc
+            sampled_logger.info("Получен список подключенных ВМ" if not authorized_only else "Получен список авторизованных ВМ")
         except Exception as e:
-            logger.error(f"Ошибка получения списка авторизованных ВМ: {e}")
-            return []
+            logger.error("Ошибка получения списка подключенных ВМ: %s", e)
+            raise
+
+    def iter_authorized_vms(self) -> AsyncIterator[RawJSON]:
+        """Потоковое получение авторизованных виртуальных машин вместе с дисками"""
+        return self.iter_connected_vms(authorized_only=True)
 
-    async def get_all_disks(self) -> List[asyncpg.Record]:
-        """Получение списка всех жестких дисков"""
+    async def iter_all_disks(self) -> AsyncIterator[RawJSON]:
+        """Потоковое получение всех жестких дисков в порядке disk_id"""
         try:
-            disks = await self.conn.fetch('''
-                SELECT disks.*, virtual_machines.vm_id FROM disks
-                JOIN virtual_machines ON disks.vm_id = virtual_machines.id
-            ''')
-            logger.info("Получен список всех дисков")
-            return disks
+            items = self.storage.iter_all_disks()
+            doc = await self.metrics.timed_first('iter_all_disks', items)
+            if doc is not None:
+                yield doc
+                async for doc in items:
+                    yield doc
+            sampled_logger.info("Получен список всех дисков")
         except Exception as e:
-            logger.error(f"Ошибка получения списка всех дисков: {e}")
-            return []
+            logger.error("Ошибка получения списка всех дисков: %s", e)
+            raise
+
+    async def get_disks_page(self, after: Optional[str], limit: int,
+                             ndjson: bool = False) -> Tuple[str, Optional[str], int]:
+        """Получение страницы дисков с disk_id больше after одним документом"""
+        with self.metrics.storage_timer('get_disks_page'):
+            page = await self.storage.get_disks_page(after, limit, ndjson)
+        sampled_logger.info("Получена страница списка всех дисков")
+        return page
 
     async def connect_vm(self, vm: VirtualMachine):
         """Подключение виртуальной машины"""
+        deadline = time.time() + self.connection_ttl if self.connection_ttl else None
+        if self.shared_state:
+            try:
+                with self.metrics.storage_timer('save_session'):
+                    await self.storage.save_session(vm, deadline)
+            except Exception as e:
+                logger.error("Ошибка подключения ВМ %s: %s", vm.vm_id, e)
+                raise
         self.connected_vms[vm.vm_id] = vm
         self.all_vms.add(vm.vm_id)
-        logger.info(f"ВМ {vm.vm_id} подключена")
+        self._track_usage(vm.vm_id, vm_usage(vm))
+        self.cache.invalidate('state')
+        if deadline is not None:
+            self._schedule_expiry(vm.vm_id, deadline)
+        self._publish('connect', vm.vm_id, vm.ram, vm.cpu)
+        sampled_logger.info("ВМ %s подключена", vm.vm_id)
 
     async def authorize_vm(self, vm_id: str):
         """Авторизация виртуальной машины"""
-        if vm_id in self.connected_vms:
-            self.authorized_vms.add(vm_id)
-            logger.info(f"ВМ {vm_id} авторизована")
+        if self.shared_state:
+            # Проверка подключения и авторизация выполняются в общем хранилище атомарно
+            connected = await self._store_authorized(vm_id, True)
+        else:
+            connected = vm_id in self.connected_vms
+        if connected:
+            if self._set_authorized(vm_id, True):
+                self._publish_authorized('authorize', vm_id)
+            sampled_logger.info("ВМ %s авторизована", vm_id)
         else:
-            logger.error(f"ВМ {vm_id} не найдена среди подключенных")
+            logger.error("ВМ %s не найдена среди подключенных", vm_id)
 
     async def deauthorize_vm(self, vm_id: str):
         """Деавторизация виртуальной машины"""
-        self.authorized_vms.discard(vm_id)
-        logger.info(f"ВМ {vm_id} деавторизована")
+        if self.shared_state:
+            await self._store_authorized(vm_id, False)
+        if self._set_authorized(vm_id, False):
+            self._publish_authorized('deauthorize', vm_id)
+        sampled_logger.info("ВМ %s деавторизована", vm_id)
+
+    async def query_vms(self, query: VMQuery, state: Optional[str] = None,
+                        ndjson: bool = False) -> Tuple[str, int]:
+        """Поиск ВМ по фильтрам; state ограничивает поиск подключенными или авторизованными ВМ"""
+        if state is not None:
+            vm_ids = self.authorized_vms if state == 'authorized' else self.connected_vms.keys()
+            if query.prefix:
+                vm_ids = [vm_id for vm_id in vm_ids if vm_id.startswith(query.prefix)]
+            if not vm_ids:
+                return join_documents([], ndjson), 0
+            query = query._replace(vm_ids=list(vm_ids))
+        try:
+            with self.metrics.storage_timer('query_vms'):
+                return await self.storage.query_vms(query, ndjson)
+        except Exception as e:
+            logger.error("Ошибка поиска ВМ: %s", e)
+            raise
+
+    async def get_stats(self) -> Dict[str, Dict[str, int]]:
+        """Итоги по ресурсам: по всем ВМ из хранилища, по подключенным и авторизованным из памяти"""
+        try:
+            with self.metrics.storage_timer('get_totals'):
+                totals = await self.storage.get_totals()
+        except Exception as e:
+            logger.error("Ошибка получения итогов по ВМ: %s", e)
+            raise
+        return {
+            'all': totals,
+            'connected': self.connected_totals.as_dict(),
+            'authorized': self.authorized_totals.as_dict(),
+        }
+
+    async def _store_authorized(self, vm_id: str, authorized: bool) -> bool:
+        try:
+            with self.metrics.storage_timer('set_authorized'):
+                return await self.storage.set_authorized(vm_id, authorized)
+        except Exception as e:
+            logger.error("Ошибка %s ВМ %s: %s", 'авторизации' if authorized else 'деавторизации', vm_id, e)
+            raise
+
+
+def wants_ndjson(request: web.Request) -> bool:
+    """Клиент запросил ответ в формате NDJSON"""
+    return request.query.get('format') == 'ndjson' or 'application/x-ndjson' in request.headers.get('Accept', '')
+
+
+async def stream_json_list(request: web.Request, items: AsyncIterator[Any],
+                           headers: Optional[Dict[str, str]] = None,
+                           capture: Optional[BodyCapture] = None) -> web.StreamResponse:
+    """Потоковая отдача списка JSON-массивом или NDJSON без накопления всех элементов в памяти"""
+    ndjson = wants_ndjson(request)
+    # Первый элемент читается до отправки заголовков: ошибка запроса к базе вернет 500, а не пустой список.
+    # Ошибка посреди потока обрывает соединение, и клиент не примет неполный ответ за полный.
+    try:
+        first_item = await items.__anext__()
+        empty = False
+    except StopAsyncIteration:
+        first_item = None
+        empty = True
+    response = web.StreamResponse(headers=headers)
+    response.content_type = 'application/x-ndjson' if ndjson else 'application/json'
+    response.charset = 'utf-8'
+    await response.prepare(request)
+
+    async def write(data: bytes):
+        if capture is not None:
+            capture.write(data)
+        await response.write(data)
+
+    separator = b'\n' if ndjson else b', '
+    buffer = bytearray() if ndjson else bytearray(b'[')
+    if not empty:
+        buffer += encode_item(first_item)
+        async for item in items:
+            buffer += separator
+            buffer += encode_item(item)
+            if len(buffer) >= STREAM_CHUNK_SIZE:
+                await write(bytes(buffer))
+                buffer.clear()
+        if ndjson:
+            buffer += b'\n'
+    if not ndjson:
+        buffer += b']'
+    await write(bytes(buffer))
+    await response.write_eof()
+    return response
+
+
+def page_params(request: web.Request) -> Tuple[Optional[str], Optional[int]]:
+    """Разбор параметров keyset-пагинации after и limit"""
+    after = request.query.get('after')
+    limit = request.query.get('limit')
+    if limit is None:
+        if after is not None:
+            # Весь список отдается потоком без пагинации: after без limit был бы молча проигнорирован
+            raise web.HTTPBadRequest(text="Параметр after требует параметра limit")
+        return None, None
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise web.HTTPBadRequest(text="Параметр limit должен быть целым числом")
+    if not 1 <= limit <= MAX_PAGE_LIMIT:
+        raise web.HTTPBadRequest(text=f"Параметр limit должен быть от 1 до {MAX_PAGE_LIMIT}")
+    return after, limit
+
+
+def etag_matches(request: web.Request, etag: str) -> bool:
+    """Проверка заголовка If-None-Match"""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    candidates = [candidate.strip() for candidate in header.split(',')]
+    return '*' in candidates or etag in candidates or 'W/' + etag in candidates
+
+
+async def cached_list_response(request: web.Request, scopes: Tuple[str, ...], render) -> web.StreamResponse:
+    """Отдача списка через кеш ответов с поддержкой ETag и If-None-Match.
+
+    render(request, headers, capture) строит ответ; если за время построения данные не менялись
+    и тело поместилось в лимит, оно сохраняется в кеш вместе с заголовками, которые добавил render.
+    """
+    cache = request.app['manager'].cache
+    ndjson = wants_ndjson(request)
+    key = (request.path, scopes, request.query_string, ndjson)
+    tag = cache.tag(scopes)
+    etag = f'"{tag}{"-n" if ndjson else ""}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if etag_matches(request, etag):
+        return web.Response(status=304, headers=headers)
+
+    cached = cache.get(key, tag)
+    if cached is not None:
+        body, content_type, extra = cached
+        return web.Response(body=body, headers={**headers, **extra}, content_type=content_type, charset='utf-8')
+
+    capture = BodyCapture(cache.max_entry_bytes)
+    base = dict(headers)
+    response = await render(request, headers, capture)
+    if capture.buffer is not None:
+        extra = {name: value for name, value in headers.items() if name not in base}
+        cache.put(key, tag, bytes(capture.buffer), response.content_type, extra)
+    return response
+
+
+def int_param(request: web.Request, name: str) -> Optional[int]:
+    value = request.query.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"Параметр {name} должен быть целым числом")
+
+
+def query_params(request: web.Request) -> Tuple[VMQuery, Optional[str]]:
+    """Разбор параметров /query: фильтры, сортировка, лимит и состояние ВМ"""
+    unknown = set(request.query) - QUERY_PARAMS
+    if unknown:
+        raise web.HTTPBadRequest(text=f"Неизвестные параметры: {', '.join(sorted(unknown))}")
+
+    filters: Dict[str, Any] = {}
+    for field in ('ram', 'cpu', 'disk_size'):
+        exact = int_param(request, field)
+        low = int_param(request, f'{field}_min')
+        high = int_param(request, f'{field}_max')
+        if exact is not None and (low is not None or high is not None):
+            raise web.HTTPBadRequest(text=f"Параметр {field} нельзя сочетать с {field}_min и {field}_max")
+        filters[f'{field}_min'] = exact if exact is not None else low
+        filters[f'{field}_max'] = exact if exact is not None else high
+    filters['prefix'] = request.query.get('prefix') or None
+
+    sort = request.query.get('sort', 'vm_id')
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort not in QUERY_SORT_FIELDS:
+        raise web.HTTPBadRequest(text=f"Параметр sort должен быть одним из: {', '.join(QUERY_SORT_FIELDS)}")
+
+    limit = int_param(request, 'limit')
+    if limit is not None:
+        if not 1 <= limit <= MAX_PAGE_LIMIT:
+            raise web.HTTPBadRequest(text=f"Параметр limit должен быть от 1 до {MAX_PAGE_LIMIT}")
+        filters['limit'] = limit
+
+    state = request.query.get('state')
+    if state is not None and state not in ('connected', 'authorized'):
+        raise web.HTTPBadRequest(text="Параметр state должен быть connected или authorized")
+    return VMQuery(sort=sort, descending=descending, **filters), state
+
+
+async def paged_response(request: web.Request, get_page, iter_items) -> web.StreamResponse:
+    """Отдача списка: страница одним документом из базы или весь список потоком"""
+    after, limit = page_params(request)
+
+    async def render(request: web.Request, headers: Dict[str, str], capture: BodyCapture) -> web.StreamResponse:
+        if limit is None:
+            return await stream_json_list(request, iter_items(), headers, capture)
+
+        ndjson = wants_ndjson(request)
+        body, last_key, total = await get_page(after, limit, ndjson)
+        if total == limit:
+            headers['X-Next-After'] = last_key
+        body = body.encode()
+        capture.write(body)
+        return web.Response(body=body, headers=headers,
+                            content_type='application/x-ndjson' if ndjson else 'application/json', charset='utf-8')
+
+    return await cached_list_response(request, ('vms',), render)
+
+
+async def request_body(request: web.Request, decode):
+    """Тело запроса, разобранное и проверенное схемой; ошибка — ответ 400 с указанием поля"""
+    try:
+        return decode(parse_json(await request.read()))
+    except ValidationError as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+
+def parse_ndjson_line(line: bytes) -> Any:
+    """Запись NDJSON, ValueError для некорректной записи или None для пустой строки"""
+    if len(line) > BULK_MAX_RECORD_SIZE:
+        return ValueError("слишком длинная запись")
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return ValueError(f"некорректный JSON: {e}")
+
+
+async def iter_ndjson(stream: StreamReader) -> AsyncIterator[Any]:
+    """Построчный разбор тела в формате NDJSON.
+
+    Некорректная строка отдается как исключение, чтобы ошибка попала в результат только этой записи.
+    Строка длиннее BULK_MAX_RECORD_SIZE не накапливается в памяти: она пропускается до конца
+    и отдается как ошибка. Пустое тело — ноль записей.
+    """
+    buffer = bytearray()
+    # Хвост слишком длинной строки отбрасывается до следующего перевода строки
+    skipping = False
+    while True:
+        chunk = await stream.read(STREAM_CHUNK_SIZE)
+        buffer += chunk
+        position = 0
+        while (newline := buffer.find(b'\n', position)) >= 0:
+            line = bytes(buffer[position:newline])
+            position = newline + 1
+            if skipping:
+                skipping = False
+                continue
+            record = parse_ndjson_line(line)
+            if record is not None:
+                yield record
+        del buffer[:position]
+        if not chunk:
+            if buffer and not skipping:
+                record = parse_ndjson_line(bytes(buffer))
+                if record is not None:
+                    yield record
+            return
+        if len(buffer) > BULK_MAX_RECORD_SIZE:
+            if not skipping:
+                skipping = True
+                yield ValueError("слишком длинная запись")
+            buffer.clear()
+
+
+async def iter_json_array(stream: StreamReader) -> AsyncIterator[Any]:
+    """Инкрементальный разбор JSON-массива: элементы отдаются по мере чтения тела.
+
+    Между элементами ровно одна запятая, после закрывающей скобки допускаются только пробелы;
+    нарушение дает ошибку «некорректный JSON-массив» после уже прочитанных элементов.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    # Ожидаемый токен: open — '[', first — элемент или ']', item — элемент,
+    # separator — ',' или ']', end — только пробелы до конца тела
+    expected = 'open'
+    eof = False
+    while True:
+        position = 0
+        length = len(buffer)
+        while position < length:
+            while position < length and buffer[position] in ' \t\r\n':
+                position += 1
+            if position == length:
+                break
+            char = buffer[position]
+            if expected == 'open':
+                if char != '[':
+                    raise ValueError("тело запроса должно быть JSON-массивом")
+                expected = 'first'
+                position += 1
+                continue
+            if expected == 'end':
+                raise ValueError("некорректный JSON-массив")
+            if expected == 'separator':
+                if char == ',':
+                    expected = 'item'
+                elif char == ']':
+                    expected = 'end'
+                else:
+                    raise ValueError("некорректный JSON-массив")
+                position += 1
+                continue
+            if char == ']' and expected == 'first':
+                expected = 'end'
+                position += 1
+                continue
+            if char in ',]':
+                raise ValueError("некорректный JSON-массив")
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if eof:
+                    raise ValueError("некорректный JSON-массив")
+                break
+            # Число в конце буфера может быть прочитано не полностью
+            if end == length and not eof:
+                break
+            yield item
+            expected = 'separator'
+            position = end
+        buffer = buffer[position:]
+        if eof:
+            if expected == 'end':
+                return
+            raise ValueError("незавершенный JSON-массив")
+        if len(buffer) > BULK_MAX_RECORD_SIZE:
+            raise ValueError("слишком длинная запись")
+        chunk = await stream.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            eof = True
+            buffer += text_decoder.decode(b'', final=True)
+        else:
+            buffer += text_decoder.decode(chunk)
+
+
+async def handle_add_vms(request: web.Request) -> web.StreamResponse:
+    """Обработчик для пакетного добавления виртуальных машин.
+
+    Принимает JSON-массив или поток NDJSON (application/x-ndjson), пишет ВМ порциями
+    по BULK_CHUNK_SIZE в отдельных транзакциях и возвращает результат по каждой записи.
+    С параметром connect=1 добавленные ВМ сразу подключаются.
+    """
+    manager = request.app['manager']
+    ndjson = request.content_type == 'application/x-ndjson'
+    connect = request.query.get('connect') in ('1', 'true')
+    records = iter_ndjson(request.content) if ndjson else iter_json_array(request.content)
+
+    # Результаты копятся вне памяти процесса, пока тело запроса не прочитано целиком
+    results = tempfile.SpooledTemporaryFile(max_size=BULK_RESULTS_SPOOL_SIZE)
+    counts = {'ok': 0, 'error': 0}
+
+    def record_result(index: int, vm_id: Any, error: Optional[str] = None):
+        result = {'index': index, 'vm_id': vm_id, 'status': 'error' if error else 'ok'}
+        if error:
+            result['error'] = error
+        counts[result['status']] += 1
+        results.write(json_dumps(result) + b'\n')
+
+    async def flush(chunk: List[Any]):
+        # Результаты пишутся в порядке записей, ошибки разбора остаются на своих местах
+        vms = [vm for _, vm, _ in chunk if vm is not None]
+        db_error = None
+        if vms:
+            try:
+                await manager.add_vms(vms)
+            except Exception as e:
+                logger.error("Ошибка пакетного добавления ВМ: %s", e)
+                db_error = f"ошибка записи в базу данных: {e}"
+        for index, vm, error in chunk:
+            if vm is None:
+                record_result(index, error[0], error[1])
+            elif db_error:
+                record_result(index, vm.vm_id, db_error)
+            elif connect:
+                # ВМ уже добавлена; ошибка подключения относится только к этой записи
+                try:
+                    await manager.connect_vm(vm)
+                except Exception as e:
+                    record_result(index, vm.vm_id, f"ВМ добавлена, ошибка подключения: {e}")
+                else:
+                    record_result(index, vm.vm_id)
+            else:
+                record_result(index, vm.vm_id)
+
+    chunk = []
+    index = 0
+    try:
+        async for record in records:
+            if isinstance(record, Exception):
+                chunk.append((index, None, (None, str(record))))
+            else:
+                try:
+                    chunk.append((index, decode_vm(record), None))
+                except ValueError as e:
+                    vm_id = record.get('vm_id') if isinstance(record, dict) else None
+                    chunk.append((index, None, (vm_id, str(e))))
+            index += 1
+            if len(chunk) >= BULK_CHUNK_SIZE:
+                await flush(chunk)
+                chunk = []
+    except ValueError as e:
+        chunk.append((index, None, (None, str(e))))
+    if chunk:
+        await flush(chunk)
+    logger.info("Пакетная загрузка ВМ: успешно %s, с ошибками %s", counts['ok'], counts['error'])
+
+    response = web.StreamResponse(headers={'X-Bulk-Ok': str(counts['ok']), 'X-Bulk-Errors': str(counts['error'])})
+    response.content_type = 'application/x-ndjson' if ndjson else 'application/json'
+    response.charset = 'utf-8'
+    await response.prepare(request)
+    with results:
+        results.seek(0)
+        if ndjson:
+            while data := results.read(STREAM_CHUNK_SIZE):
+                await response.write(data)
+        else:
+            buffer = bytearray(b'[')
+            first = True
+            for line in results:
+                if not first:
+                    buffer += b', '
+                first = False
+                buffer += line.rstrip(b'\n')
+                if len(buffer) >= STREAM_CHUNK_SIZE:
+                    await response.write(bytes(buffer))
+                    buffer.clear()
+            buffer += b']'
+            await response.write(bytes(buffer))
+    await response.write_eof()
+    return response
 
 
 async def handle_add_vm(request: web.Request) -> web.Response:
     """Обработчик для добавления виртуальной машины"""
-    data = await request.json()
-    vm = VirtualMachine(data['vm_id'], data['ram'], data['cpu'], data['disks'])
+    vm = await request_body(request, decode_vm)
     await request.app['manager'].add_vm(vm)
     return web.Response(text="ВМ добавлена")
 
 
 async def handle_update_vm(request: web.Request) -> web.Response:
     """Обработчик для обновления данных виртуальной машины"""
-    data = await request.json()
-    vm = VirtualMachine(data['vm_id'], data['ram'], data['cpu'], data['disks'])
+    vm = await request_body(request, decode_vm)
     await request.app['manager'].update_vm(vm)
     return web.Response(text="ВМ обновлена")
 
 
-async def handle_get_all_vms(request: web.Request) -> web.Response:
+async def handle_get_all_vms(request: web.Request) -> web.StreamResponse:
     """Обработчик для получения списка всех виртуальных машин"""
-    vms = await request.app['manager'].get_all_vms()
-    # Преобразование строковых представлений дисков в JSON объекты
-    for vm in vms:
-        if isinstance(vm['disks'], str):
-            vm['disks'] = json.loads(vm['disks'])
-    return web.json_response(vms)
+    manager = request.app['manager']
+    return await paged_response(request, manager.get_vms_page, manager.iter_all_vms)
 
 
-async def handle_get_connected_vms(request: web.Request) -> web.Response:
+async def handle_get_connected_vms(request: web.Request) -> web.StreamResponse:
     """Обработчик для получения списка подключенных виртуальных машин"""
-    vms = await request.app['manager'].get_connected_vms()
-    return web.json_response(vms)
+    async def render(request, headers, capture):
+        return await stream_json_list(request, request.app['manager'].iter_connected_vms(), headers, capture)
+
+    return await cached_list_response(request, ('vms', 'state'), render)
 
 
-async def handle_get_authorized_vms(request: web.Request) -> web.Response:
+async def handle_get_authorized_vms(request: web.Request) -> web.StreamResponse:
     """Обработчик для получения списка авторизованных виртуальных машин"""
-    vms = await request.app['manager'].get_authorized_vms()
-    return web.json_response(vms)
+    async def render(request, headers, capture):
+        return await stream_json_list(request, request.app['manager'].iter_authorized_vms(), headers, capture)
+
+    return await cached_list_response(request, ('vms', 'state'), render)
+
 
+async def handle_query_vms(request: web.Request) -> web.StreamResponse:
+    """Обработчик поиска виртуальных машин по фильтрам"""
+    query, state = query_params(request)
 
-async def handle_get_all_disks(request: web.Request) -> web.Response:
+    async def render(request: web.Request, headers: Dict[str, str], capture: BodyCapture) -> web.StreamResponse:
+        ndjson = wants_ndjson(request)
+        body, _ = await request.app['manager'].query_vms(query, state, ndjson)
+        body = body.encode()
+        capture.write(body)
+        return web.Response(body=body, headers=headers,
+                            content_type='application/x-ndjson' if ndjson else 'application/json', charset='utf-8')
+
+    return await cached_list_response(request, ('vms', 'state') if state else ('vms',), render)
+
+
+async def handle_get_all_disks(request: web.Request) -> web.StreamResponse:
     """Обработчик для получения списка всех дисков"""
-    disks = await request.app['manager'].get_all_disks()
-    return web.json_response([dict(disk) for disk in disks])
+    manager = request.app['manager']
+    return await paged_response(request, manager.get_disks_page, manager.iter_all_disks)
 
 
 async def handle_connect_vm(request: web.Request) -> web.Response:
     """Обработчик для подключения виртуальной машины"""
-    data = await request.json()
-    vm = VirtualMachine(data['vm_id'], data['ram'], data['cpu'], data['disks'])
+    vm = await request_body(request, decode_vm)
     await request.app['manager'].connect_vm(vm)
     return web.Response(text="ВМ подключена")
 
 
+async def handle_heartbeat(request: web.Request) -> web.Response:
+    """Обработчик heartbeat: продление подключения виртуальной машины"""
+    vm_id = await request_body(request, decode_vm_id)
+    if not await request.app['manager'].heartbeat(vm_id):
+        raise web.HTTPNotFound(text=f"ВМ {vm_id} не найдена среди подключенных")
+    return web.Response(text="Подключение продлено")
+
+
 async def handle_authorize_vm(request: web.Request) -> web.Response:
     """Обработчик для авторизации виртуальной машины"""
-    data = await request.json()
-    vm_id = data['vm_id']
+    vm_id = await request_body(request, decode_vm_id)
     await request.app['manager'].authorize_vm(vm_id)
     return web.Response(text="ВМ авторизована")
 
 
 async def handle_deauthorize_vm(request: web.Request) -> web.Response:
     """Обработчик для деавторизации виртуальной машины"""
-    data = await request.json()
-    vm_id = data['vm_id']
+    vm_id = await request_body(request, decode_vm_id)
     await request.app['manager'].deauthorize_vm(vm_id)
     return web.Response(text="ВМ деавторизована")
 
 
+async def handle_stats(request: web.Request) -> web.Response:
+    """Обработчик получения итогов по ресурсам ВМ"""
+    stats = await request.app['manager'].get_stats()
+    return web.Response(body=json_dumps(stats), content_type='application/json')
+
+
 async def handle_health_check(request: web.Request) -> web.Response:
     """Обработчик для проверки состояния сервера"""
+    if request.query.get('verbose'):
+        manager = request.app['manager']
+        return web.json_response({'status': 'OK', 'storage': manager.storage.stats(), 'cache': manager.cache.stats()})
     return web.Response(text="OK")
 
 
-async def init_app() -> web.Application:
-    """Инициализация приложения"""
-    app = web.Application()
-    manager = VMManager()
+async def handle_events(request: web.Request) -> web.StreamResponse:
+    """Обработчик ленты изменений ВМ в формате Server-Sent Events.
+
+    Продолжение ленты — заголовок Last-Event-ID или параметр after, фильтр по типам — параметр types.
+    Если продолжить нельзя, первым приходит событие reset: клиенту нужно заново загрузить списки.
+    """
+    last_id = request.headers.get('Last-Event-ID') or request.query.get('after') or None
+    types = request.query.get('types')
+    if types is not None:
+        types = types.split(',')
+        if not set(types) <= set(EVENT_TYPES):
+            raise web.HTTPBadRequest(text=f"Типы событий: {', '.join(EVENT_TYPES)}")
+
+    events = request.app['manager'].events
+    try:
+        subscription, resumed = events.subscribe(last_id, types)
+    except ValueError:
+        raise web.HTTPBadRequest(text="Некорректный Last-Event-ID")
+    try:
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        })
+        await response.prepare(request)
+        greeting = b'retry: 1000\n\n'
+        if not resumed:
+            greeting += b'event: reset\ndata: %s\n\n' % json_dumps({'seq': events.last_seq,
+                                                                  'id': events.event_id(events.last_seq)})
+        await response.write(greeting)
+
+        while True:
+            batch = await subscription.next_batch(EVENTS_KEEPALIVE)
+            if batch:
+                await response.write(b''.join(batch))
+            if subscription.ended is not None:
+                break
+            if not batch:
+                await response.write(b': keepalive\n\n')
+        if subscription.ended == 'overflow':
+            logger.warning("Подписчик ленты изменений отключен: не успевает получать события")
+        return response
+    finally:
+        events.unsubscribe(subscription)
+
+
+async def close_events(app: web.Application):
+    """Завершение лент изменений при остановке, чтобы не ждать отключения подписчиков"""
+    app['manager'].events.close()
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """Обработчик для выдачи метрик в текстовом формате Prometheus"""
+    return web.Response(text=request.app['manager'].metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+
+@web.middleware
+async def request_id_middleware(request: web.Request, handler) -> web.StreamResponse:
+    """Идентификатор запроса для логов: из заголовка X-Request-ID или новый"""
+    request['request_id'] = start_request(request.headers.get(REQUEST_ID_HEADER))
+    return await handler(request)
+
+
+async def add_request_id_header(request: web.Request, response: web.StreamResponse):
+    """Возврат идентификатора запроса клиенту, в том числе в ответах с ошибкой и потоковых ответах"""
+    request_id = request.get('request_id')
+    if request_id is not None:
+        response.headers[REQUEST_ID_HEADER] = request_id
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler) -> web.StreamResponse:
+    """Число запросов, задержка, запросы в обработке и размер ответа по маршрутам"""
+    metrics = request.app['manager'].metrics
+    resource = request.match_info.route.resource
+    # Шаблон маршрута, а не фактический путь: число серий не зависит от запросов
+    route = resource.canonical if resource is not None else 'unmatched'
+    in_flight = metrics.http_in_flight.labels(route)
+    in_flight.inc()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        size = response.body_length if response.prepared else response.content_length
+        metrics.http_response_size.labels(route).observe(size or 0)
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        in_flight.dec()
+        metrics.http_duration.labels(route, request.method).observe(time.perf_counter() - started)
+        metrics.http_requests.labels(route, request.method, str(status)).inc()
+
+
+def protocol_handlers(manager: VMManager) -> Dict[str, Handler]:
+    """Операции протокола TCP: те же методы менеджера и ответы, что у HTTP-маршрутов"""
+    async def add_vm(body: Any) -> str:
+        await manager.add_vm(decode_vm(body))
+        return "ВМ добавлена"
+
+    async def update_vm(body: Any) -> str:
+        await manager.update_vm(decode_vm(body))
+        return "ВМ обновлена"
+
+    async def connect_vm(body: Any) -> str:
+        await manager.connect_vm(decode_vm(body))
+        return "ВМ подключена"
+
+    async def heartbeat(body: Any) -> str:
+        vm_id = decode_vm_id(body)
+        if not await manager.heartbeat(vm_id):
+            raise RequestError(404, f"ВМ {vm_id} не найдена среди подключенных")
+        return "Подключение продлено"
+
+    async def authorize_vm(body: Any) -> str:
+        await manager.authorize_vm(decode_vm_id(body))
+        return "ВМ авторизована"
+
+    async def deauthorize_vm(body: Any) -> str:
+        await manager.deauthorize_vm(decode_vm_id(body))
+        return "ВМ деавторизована"
+
+    async def stats(body: Any) -> Dict[str, Dict[str, int]]:
+        return await manager.get_stats()
+
+    async def health(body: Any) -> str:
+        return "OK"
+
+    return {
+        'add_vm': add_vm,
+        'update_vm': update_vm,
+        'connect_vm': connect_vm,
+        'heartbeat': heartbeat,
+        'authorize_vm': authorize_vm,
+        'deauthorize_vm': deauthorize_vm,
+        'stats': stats,
+        'health': health,
+    }
+
+
+async def start_protocol(app: web.Application):
+    """Запуск TCP-сервера протокола рядом с HTTP-сервером"""
+    manager = app['manager']
+    connections = app['protocol_connections'] = set()
+    manager.metrics.registry.register(Gauge('vm_protocol_connections', 'Открытые соединения протокола TCP', (),
+                                            lambda: {(): len(connections)}))
+    app['protocol_server'] = await serve_protocol(protocol_handlers(manager), None, app['protocol_port'],
+                                                  manager.metrics, reuse_port=WORKERS > 1, connections=connections)
+
+
+async def stop_protocol(app: web.Application):
+    """Остановка приема соединений протокола и закрытие открытых"""
+    server = app['protocol_server']
+    server.close()
+    for connection in list(app['protocol_connections']):
+        connection.close()
+    await server.wait_closed()
+
+
+async def close_manager(app: web.Application):
+    """Освобождение ресурсов менеджера при остановке приложения"""
+    await app['manager'].close_db()
+
+
+async def init_app(manager: Optional[VMManager] = None, protocol_port: int = PROTOCOL_PORT) -> web.Application:
+    """Инициализация приложения; с protocol_port вместе с ним запускается протокол TCP"""
+    app = web.Application(middlewares=[request_id_middleware, metrics_middleware])
+    app.on_response_prepare.append(add_request_id_header)
+    manager = manager or VMManager()
     await manager.init_db()
     app['manager'] = manager
+    if protocol_port:
+        app['protocol_port'] = protocol_port
+        app.on_startup.append(start_protocol)
+        app.on_shutdown.append(stop_protocol)
+    app.on_shutdown.append(close_events)
+    app.on_cleanup.append(close_manager)
 
     app.add_routes([
         web.post('/add_vm', handle_add_vm),
+        web.post('/add_vms', handle_add_vms),
         web.post('/update_vm', handle_update_vm),
         web.post('/connect_vm', handle_connect_vm),
+        web.post('/heartbeat', handle_heartbeat),
         web.post('/authorize_vm', handle_authorize_vm),
         web.post('/deauthorize_vm', handle_deauthorize_vm),
         web.get('/get_all_vms', handle_get_all_vms),
         web.get('/get_connected_vms', handle_get_connected_vms),
         web.get('/get_authorized_vms', handle_get_authorized_vms),
         web.get('/get_all_disks', handle_get_all_disks),
-        web.get('/health', handle_health_check)
+        web.get('/query', handle_query_vms),
+        web.get('/events', handle_events),
+        web.get('/stats', handle_stats),
+        web.get('/health', handle_health_check),
+        web.get('/metrics', handle_metrics)
     ])
 
     return app
 
 
+def run_worker():
+    """Процесс сервера; при нескольких процессах порт открывается с SO_REUSEPORT"""
+    # Обработчики сигналов супервизора не наследуются: процесс завершается по сигналу сам
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Поток вывода логов не наследуется при fork: процесс запускает свой
+    setup_logging()
+    try:
+        web.run_app(init_app(), port=PORT, reuse_port=WORKERS > 1, access_log_class=SampledAccessLogger)
+    finally:
+        stop_logging()
+
+
+def run_workers(count: int):
+    """Prefork-супервизор: запускает процессы сервера и перезапускает упавшие до получения сигнала остановки"""
+    # Проверка до запуска процессов: хранилище без общего состояния не подходит для нескольких процессов
+    if not issubclass(storage_class(STORAGE_BACKEND), SharedStorage):
+        raise ValueError(f"Хранилище {STORAGE_BACKEND} не поддерживает общее состояние нескольких процессов")
+
+    processes: Dict[int, multiprocessing.Process] = {}
+    stopping = False
+
+    def start(number: int):
+        process = multiprocessing.Process(target=run_worker, name=f"worker-{number}")
+        process.start()
+        processes[number] = process
+        logger.info("Запущен процесс %s, pid %s", process.name, process.pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            process.terminate()
+
+    for number in range(count):
+        start(number)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while processes:
+        multiprocessing.connection.wait([process.sentinel for process in processes.values()])
+        for number, process in list(processes.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del processes[number]
+            if not stopping:
+                logger.error("Процесс %s завершился с кодом %s, перезапуск", process.name, process.exitcode)
+                time.sleep(WORKER_RESTART_DELAY)
+                start(number)
+
+
 if __name__ == '__main__':
+    setup_logging()
     logger.info("Запуск сервера")
-    web.run_app(init_app(), port=8080)
+    try:
+        if WORKERS > 1:
+            run_workers(WORKERS)
+        else:
+            web.run_app(init_app(), port=PORT, access_log_class=SampledAccessLogger)
+    finally:
+        stop_logging()
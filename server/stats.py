@@ -0,0 +1,55 @@
+"""Итоги по ресурсам ВМ для /stats.
+
+Итоги не пересчитываются при чтении: каждое изменение ВМ или ее состояния прибавляет или вычитает
+вклад одной ВМ, поэтому чтение итогов не зависит от числа ВМ.
+"""
+from typing import Dict, Iterable, NamedTuple
+
+from models import VirtualMachine
+
+
+class Usage(NamedTuple):
+    """Вклад одной ВМ в итоги"""
+    ram: int
+    cpu: int
+    disks: int
+    disk_size: int
+
+
+def vm_usage(vm: VirtualMachine) -> Usage:
+    return Usage(vm.ram or 0, vm.cpu or 0, len(vm.disks), sum(disk.size or 0 for disk in vm.disks))
+
+
+class ResourceTotals:
+    """Число ВМ и суммы их RAM, CPU, числа и размера дисков"""
+    __slots__ = ('vms', 'ram', 'cpu', 'disks', 'disk_size')
+
+    def __init__(self):
+        self.vms = 0
+        self.ram = 0
+        self.cpu = 0
+        self.disks = 0
+        self.disk_size = 0
+
+    def add(self, usage: Usage, sign: int = 1):
+        """Учет ВМ; sign=-1 исключает ее из итогов"""
+        self.vms += sign
+        self.ram += sign * usage.ram
+        self.cpu += sign * usage.cpu
+        self.disks += sign * usage.disks
+        self.disk_size += sign * usage.disk_size
+
+    def add_disks(self, count: int, size: int):
+        self.disks += count
+        self.disk_size += size
+
+    def as_dict(self) -> Dict[str, int]:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def of(cls, usages: Iterable[Usage]) -> 'ResourceTotals':
+        """Итоги, посчитанные заново по всем ВМ; для загрузки состояния"""
+        totals = cls()
+        for usage in usages:
+            totals.add(usage)
+        return totals
@@ -0,0 +1,811 @@
+import abc
+import asyncio
+import bisect
+import json
+import logging
+import os
+from typing import List, Dict, Any, Optional, AsyncIterator, Callable, NamedTuple, Tuple, Type
+
+import asyncpg
+
+from migrations import migrate
+from models import VirtualMachine, RawJSON, json_dumps
+from stats import ResourceTotals, Usage, vm_usage
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres")
+
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://user:password@db:5432/yourdatabase")
+
+# Настройки пула соединений с базой данных
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "5"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+# Пересоздание соединения после N запросов или простоя дольше N секунд
+DB_POOL_MAX_QUERIES = int(os.getenv("DB_POOL_MAX_QUERIES", "50000"))
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", "300"))
+
+# Число строк, которые курсор читает из базы за одно обращение при потоковой выдаче списков
+LIST_PREFETCH = int(os.getenv("LIST_PREFETCH", "500"))
+
+# Канал LISTEN/NOTIFY, по которому процессы сервера узнают об изменениях общего состояния
+CHANGES_CHANNEL = 'vm_changes'
+# Уведомление об изменении ВМ v с операцией $2; номер изменения общий для всех процессов
+CHANGE_EVENT_SQL = """
+    json_build_object('op', $2::text, 'seq', nextval('vm_events_seq'), 'vm_id', v.vm_id, 'ram', v.ram, 'cpu', v.cpu)::text
+"""
+# Пауза между попытками восстановить соединение для уведомлений, секунды
+LISTEN_RECONNECT_DELAY = 1.0
+
+# Документы ВМ и диска собираются в базе в том же виде, в каком их отдает API
+VM_DOCUMENT_SQL = """
+    json_build_object(
+        'id', page.id,
+        'vm_id', page.vm_id,
+        'ram', page.ram,
+        'cpu', page.cpu,
+        'disks', COALESCE(json_agg(disk.*) FILTER (WHERE disk.id IS NOT NULL), '[]')
+    )::text
+"""
+DISK_DOCUMENT_SQL = """
+    json_build_object(
+        'id', disks.id,
+        'disk_id', disks.disk_id,
+        'size', disks.size,
+        'vm_id', virtual_machines.vm_id
+    )::text
+"""
+
+
+def page_document_sql(ndjson: bool, key: str) -> str:
+    """Агрегат, склеивающий документы страницы в JSON-массив или NDJSON"""
+    if ndjson:
+        return f"COALESCE(string_agg(doc || E'\\n', '' ORDER BY {key}), '')"
+    return f"'[' || COALESCE(string_agg(doc, ', ' ORDER BY {key}), '') || ']'"
+
+
+def join_documents(docs: List[str], ndjson: bool) -> str:
+    """Склейка документов страницы в JSON-массив или NDJSON"""
+    if ndjson:
+        return ''.join(doc + '\n' for doc in docs)
+    return '[' + ', '.join(docs) + ']'
+
+
+# Поля, по которым можно сортировать результат /query
+QUERY_SORT_FIELDS = ('vm_id', 'ram', 'cpu')
+
+
+class VMQuery(NamedTuple):
+    """Фильтры, сортировка и лимит запроса ВМ; None — без ограничения"""
+    ram_min: Optional[int] = None
+    ram_max: Optional[int] = None
+    cpu_min: Optional[int] = None
+    cpu_max: Optional[int] = None
+    # У ВМ есть диск с размером в этих пределах
+    disk_size_min: Optional[int] = None
+    disk_size_max: Optional[int] = None
+    prefix: Optional[str] = None
+    # Только ВМ из этого набора, например подключенные
+    vm_ids: Optional[List[str]] = None
+    sort: str = 'vm_id'
+    descending: bool = False
+    limit: int = 100
+
+
+def prefix_upper_bound(prefix: str) -> Optional[str]:
+    """Наименьшая строка больше всех строк с этим префиксом при побайтовом сравнении UTF-8"""
+    while prefix:
+        code = ord(prefix[-1]) + 1
+        if 0xD800 <= code <= 0xDFFF:
+            code = 0xE000
+        if code <= 0x10FFFF:
+            return prefix[:-1] + chr(code)
+        prefix = prefix[:-1]
+    return None
+
+
+class Session(NamedTuple):
+    """Подключение ВМ в общем состоянии"""
+    vm: VirtualMachine
+    authorized: bool
+    # Срок истечения подключения (Unix time) или None
+    expires_at: Optional[float]
+    # Вклад ВМ в итоги /stats по данным подключения
+    usage: Usage
+
+
+class Storage(abc.ABC):
+    """Хранилище ВМ и дисков, от которого зависит VMManager.
+
+    Методы чтения списков отдают готовые JSON-документы (RawJSON) в формате ответов API.
+    Ошибки не перехватываются: их обработка и логирование остаются за VMManager.
+    """
+    backend = ''
+
+    async def init(self):
+        """Подготовка хранилища к работе"""
+
+    async def close(self):
+        """Освобождение ресурсов хранилища"""
+
+    def stats(self) -> Dict[str, Any]:
+        """Состояние хранилища"""
+        return {'status': 'ok', 'backend': self.backend}
+
+    @abc.abstractmethod
+    async def add_vms(self, vms: List[VirtualMachine]) -> List[str]:
+        """Добавление ВМ и их дисков; существующие ВМ и диски не изменяются. Возвращает vm_id добавленных ВМ"""
+
+    @abc.abstractmethod
+    async def update_vm(self, vm: VirtualMachine):
+        """Обновление RAM и CPU ВМ и размеров ее дисков, новые диски добавляются"""
+
+    @abc.abstractmethod
+    async def write_vms(self, adds: List[VirtualMachine], updates: List[VirtualMachine]) -> Tuple[List[str], List[str]]:
+        """Пакет добавлений и обновлений ВМ одной транзакцией: сначала добавления, затем обновления.
+
+        Возвращает vm_id добавленных и обновленных ВМ; обновление ВМ, которой нет в хранилище,
+        пропускается, не прерывая пакет.
+        """
+
+    @abc.abstractmethod
+    def iter_all_vms(self) -> AsyncIterator[RawJSON]:
+        """Все ВМ с дисками в порядке vm_id"""
+
+    @abc.abstractmethod
+    async def get_vms_page(self, after: Optional[str], limit: int,
+                           ndjson: bool = False) -> Tuple[str, Optional[str], int]:
+        """Страница ВМ с vm_id больше after: текст документа, vm_id последней ВМ и число ВМ"""
+
+    @abc.abstractmethod
+    def iter_vm_documents(self, vms: List[VirtualMachine]) -> AsyncIterator[RawJSON]:
+        """Документы переданных ВМ с дисками из хранилища в порядке списка; RAM и CPU берутся из самих ВМ"""
+
+    @abc.abstractmethod
+    async def query_vms(self, query: VMQuery, ndjson: bool = False) -> Tuple[str, int]:
+        """ВМ, подходящие под фильтры запроса: текст документа и число ВМ"""
+
+    @abc.abstractmethod
+    def iter_all_disks(self) -> AsyncIterator[RawJSON]:
+        """Все диски в порядке disk_id"""
+
+    @abc.abstractmethod
+    async def get_disks_page(self, after: Optional[str], limit: int,
+                             ndjson: bool = False) -> Tuple[str, Optional[str], int]:
+        """Страница дисков с disk_id больше after: текст документа, disk_id последнего диска и число дисков"""
+
+    @abc.abstractmethod
+    async def get_totals(self) -> Dict[str, int]:
+        """Итоги по всем ВМ: число ВМ и дисков, суммы RAM, CPU и размеров дисков"""
+
+
+class SharedStorage(Storage):
+    """Хранилище с общим для нескольких процессов сервера состоянием подключения и авторизации ВМ.
+
+    Уведомляет процессы об изменениях этого состояния. Нужно для shared_state в VMManager
+    и для запуска нескольких процессов (WORKERS > 1).
+    """
+
+    @abc.abstractmethod
+    async def load_sessions(self) -> List[Session]:
+        """Подключения ВМ в порядке первого подключения"""
+
+    @abc.abstractmethod
+    async def save_session(self, vm: VirtualMachine, expires_at: Optional[float] = None):
+        """Запись подключения ВМ в общее состояние; expires_at — срок истечения (Unix time) или None"""
+
+    @abc.abstractmethod
+    async def touch_session(self, vm_id: str, expires_at: float) -> bool:
+        """Продление подключения ВМ по heartbeat; False, если ВМ не подключена"""
+
+    @abc.abstractmethod
+    async def expire_sessions(self, vm_ids: List[str], now: float) -> Tuple[List[str], Dict[str, float]]:
+        """Удаление подключений из vm_ids со сроком не позже now.
+
+        Возвращает vm_id удаленных подключений и новые сроки подключений, продленных другими процессами.
+        """
+
+    @abc.abstractmethod
+    async def set_authorized(self, vm_id: str, authorized: bool) -> bool:
+        """Изменение признака авторизации подключенной ВМ; False, если ВМ не подключена"""
+
+    @abc.abstractmethod
+    async def listen(self, on_event: Callable[[Dict[str, Any]], None], on_reset: Callable[[], Any]):
+        """Подписка на изменения из всех процессов, включая текущий.
+
+        on_event вызывается для каждого изменения с полями op (add, update, connect, authorize,
+        deauthorize), seq — номером изменения, общим для всех процессов, — и данными ВМ;
+        on_reset — после восстановления потерянной подписки, когда часть изменений могла быть пропущена.
+        """
+
+
+class PostgresStorage(SharedStorage):
+    """Хранилище в PostgreSQL с пулом соединений asyncpg.
+
+    Общее состояние процессов хранится в таблице vm_sessions, об изменениях процессы узнают
+    через LISTEN/NOTIFY. Пока подписка не запрошена, уведомления не отправляются.
+    """
+    backend = 'postgres'
+
+    def __init__(self,
+                 dsn: str = DATABASE_URL,
+                 min_size: int = DB_POOL_MIN_SIZE,
+                 max_size: int = DB_POOL_MAX_SIZE,
+                 acquire_timeout: float = DB_POOL_ACQUIRE_TIMEOUT,
+                 statement_cache_size: int = DB_STATEMENT_CACHE_SIZE,
+                 max_queries: int = DB_POOL_MAX_QUERIES,
+                 max_inactive_lifetime: float = DB_POOL_MAX_INACTIVE_LIFETIME):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.statement_cache_size = statement_cache_size
+        self.max_queries = max_queries
+        self.max_inactive_lifetime = max_inactive_lifetime
+        self.pool: Optional[asyncpg.Pool] = None
+        self.notify_changes = False
+        self.listener: Optional[asyncpg.Connection] = None
+        self.listener_task: Optional[asyncio.Task] = None
+
+    def _acquire(self):
+        """Получение соединения из пула на время одной операции"""
+        if self.pool is None:
+            raise RuntimeError("Пул соединений с базой данных не инициализирован")
+        return self.pool.acquire(timeout=self.acquire_timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        """Состояние пула соединений"""
+        if self.pool is None:
+            return {'status': 'unavailable', 'backend': self.backend}
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        in_use = size - idle
+        return {
+            'status': 'ok',
+            'backend': self.backend,
+            'pool': {
+                'min_size': self.pool.get_min_size(),
+                'max_size': self.pool.get_max_size(),
+                'size': size,
+                'idle': idle,
+                'in_use': in_use,
+                'saturation': round(in_use / self.pool.get_max_size(), 3),
+            },
+        }
+
+    async def init(self):
+        """Создание пула соединений и применение миграций схемы"""
+        logger.info("Подключение к базе данных")
+        self.pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            max_queries=self.max_queries,
+            max_inactive_connection_lifetime=self.max_inactive_lifetime,
+            statement_cache_size=self.statement_cache_size,
+        )
+        async with self._acquire() as conn:
+            await migrate(conn)
+
+    async def close(self):
+        """Закрытие пула соединений с базой данных"""
+        if self.listener_task is not None:
+            self.listener_task.cancel()
+            self.listener_task = None
+        if self.listener is not None:
+            # Соединение убирается до закрытия, чтобы его закрытие не запустило переподключение
+            listener, self.listener = self.listener, None
+            await listener.close()
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+            logger.info("Пул соединений с базой данных закрыт")
+
+    async def add_vms(self, vms: List[VirtualMachine]) -> List[str]:
+        """Пакетное добавление виртуальных машин одной транзакцией.
+
+        ВМ и их диски записываются двумя многострочными запросами, первичные ключи ВМ
+        разрешаются в базе одним соединением таблиц. Ошибка откатывает весь пакет.
+        """
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                return await self._insert_vms(conn, vms)
+
+    async def update_vm(self, vm: VirtualMachine):
+        """Обновление ВМ и всех ее дисков одной транзакцией"""
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                if not await self._update_vms(conn, [vm]):
+                    raise Exception("ВМ не найдена в базе данных")
+
+    async def write_vms(self, adds: List[VirtualMachine], updates: List[VirtualMachine]) -> Tuple[List[str], List[str]]:
+        """Пакет добавлений и обновлений одной транзакцией: не больше двух многострочных запросов на каждый вид записи"""
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                added = await self._insert_vms(conn, adds) if adds else []
+                updated = await self._update_vms(conn, updates) if updates else []
+        return added, updated
+
+    async def _insert_vms(self, conn: asyncpg.Connection, vms: List[VirtualMachine]) -> List[str]:
+        disks = [(disk.disk_id, disk.size, vm.vm_id) for vm in vms for disk in vm.disks]
+        added = await conn.fetch('''
+            INSERT INTO virtual_machines (vm_id, ram, cpu)
+            SELECT * FROM unnest($1::varchar[], $2::integer[], $3::integer[])
+            ON CONFLICT (vm_id) DO NOTHING
+            RETURNING vm_id, ram, cpu;
+        ''', [vm.vm_id for vm in vms], [vm.ram for vm in vms], [vm.cpu for vm in vms])
+        if disks:
+            await conn.execute('''
+                INSERT INTO disks (disk_id, size, vm_id)
+                SELECT d.disk_id, d.size, vm.id
+                FROM unnest($1::varchar[], $2::integer[], $3::varchar[]) AS d(disk_id, size, vm_id)
+                JOIN virtual_machines vm ON vm.vm_id = d.vm_id
+                ON CONFLICT (disk_id) DO NOTHING;
+            ''', [disk[0] for disk in disks], [disk[1] for disk in disks], [disk[2] for disk in disks])
+        await self._notify_vms_changed(conn, 'add', added)
+        return [row['vm_id'] for row in added]
+
+    async def _update_vms(self, conn: asyncpg.Connection, vms: List[VirtualMachine]) -> List[str]:
+        """Обновление ВМ и их дисков; возвращает vm_id найденных ВМ"""
+        # При повторе vm_id или disk_id в одном запросе побеждает последнее значение
+        updated = await conn.fetch('''
+            UPDATE virtual_machines vm SET ram = u.ram, cpu = u.cpu
+            FROM (
+                SELECT DISTINCT ON (u.vm_id) u.vm_id, u.ram, u.cpu
+                FROM unnest($1::varchar[], $2::integer[], $3::integer[]) WITH ORDINALITY AS u(vm_id, ram, cpu, ord)
+                ORDER BY u.vm_id, u.ord DESC
+            ) u
+            WHERE vm.vm_id = u.vm_id
+            RETURNING vm.vm_id, vm.ram, vm.cpu;
+        ''', [vm.vm_id for vm in vms], [vm.ram for vm in vms], [vm.cpu for vm in vms])
+        disks = [(disk.disk_id, disk.size, vm.vm_id) for vm in vms for disk in vm.disks]
+        if updated and disks:
+            # Диски ВМ, которой нет в базе, отбрасывает соединение с virtual_machines
+            await conn.execute('''
+                INSERT INTO disks (disk_id, size, vm_id)
+                SELECT DISTINCT ON (d.disk_id) d.disk_id, d.size, vm.id
+                FROM unnest($1::varchar[], $2::integer[], $3::varchar[]) WITH ORDINALITY AS d(disk_id, size, vm_id, ord)
+                JOIN virtual_machines vm ON vm.vm_id = d.vm_id
+                ORDER BY d.disk_id, d.ord DESC
+                ON CONFLICT (disk_id) DO UPDATE SET size = EXCLUDED.size;
+            ''', [disk[0] for disk in disks], [disk[1] for disk in disks], [disk[2] for disk in disks])
+        await self._notify_vms_changed(conn, 'update', updated)
+        return [row['vm_id'] for row in updated]
+
+    async def _notify_vms_changed(self, conn: asyncpg.Connection, op: str, vms: List[Any]):
+        """Уведомления процессов об изменении ВМ или ее подключения, по одному на ВМ; доставляются после фиксации транзакции"""
+        if self.notify_changes and vms:
+            await conn.execute(f'''
+                SELECT pg_notify($1, {CHANGE_EVENT_SQL})
+                FROM unnest($3::varchar[], $4::integer[], $5::integer[]) AS v(vm_id, ram, cpu)
+            ''', CHANGES_CHANNEL, op, [vm['vm_id'] for vm in vms], [vm['ram'] for vm in vms], [vm['cpu'] for vm in vms])
+
+    async def iter_all_vms(self) -> AsyncIterator[RawJSON]:
+        """Потоковое чтение всех ВМ серверным курсором; JSON каждой ВМ собирается в базе"""
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                async for row in conn.cursor(f'''
+                    SELECT {VM_DOCUMENT_SQL} AS doc
+                    FROM virtual_machines page
+                    LEFT JOIN disks disk ON page.id = disk.vm_id
+                    GROUP BY page.id
+                    ORDER BY page.vm_id
+                ''', prefetch=LIST_PREFETCH):
+                    yield RawJSON(row['doc'])
+
+    async def get_vms_page(self, after: Optional[str], limit: int,
+                           ndjson: bool = False) -> Tuple[str, Optional[str], int]:
+        """Страница ВМ одним документом, собранным в базе"""
+        async with self._acquire() as conn:
+            row = await conn.fetchrow(f'''
+                WITH page AS (
+                    SELECT * FROM virtual_machines
+                    WHERE $1::varchar IS NULL OR vm_id > $1
+                    ORDER BY vm_id
+                    LIMIT $2
+                ), docs AS (
+                    SELECT page.vm_id, {VM_DOCUMENT_SQL} AS doc
+                    FROM page
+                    LEFT JOIN disks disk ON page.id = disk.vm_id
+                    GROUP BY page.id, page.vm_id, page.ram, page.cpu
+                )
+                SELECT {page_document_sql(ndjson, 'vm_id')} AS body, max(vm_id) AS last_key, count(*) AS total
+                FROM docs
+            ''', after, limit)
+        return row['body'], row['last_key'], row['total']
+
+    async def query_vms(self, query: VMQuery, ndjson: bool = False) -> Tuple[str, int]:
+        """Фильтры и сортировка выполняются в базе по индексам, документы собираются там же.
+
+        В запрос попадают только заданные условия, поэтому у каждого набора фильтров свой план
+        подготовленного запроса, а не общий план с проверками на NULL, который не использует индексы.
+        """
+        args: List[Any] = []
+
+        def arg(value: Any) -> str:
+            args.append(value)
+            return f'${len(args)}'
+
+        conditions = []
+        if query.vm_ids is not None:
+            conditions.append(f'vm.vm_id = ANY({arg(query.vm_ids)}::varchar[])')
+        if query.prefix:
+            # Диапазон вместо LIKE: так префикс использует индекс text_pattern_ops и в общем плане
+            conditions.append(f'vm.vm_id ~>=~ {arg(query.prefix)}')
+            upper = prefix_upper_bound(query.prefix)
+            if upper is not None:
+                conditions.append(f'vm.vm_id ~<~ {arg(upper)}')
+        for column, low, high in (('ram', query.ram_min, query.ram_max), ('cpu', query.cpu_min, query.cpu_max)):
+            if low is not None:
+                conditions.append(f'vm.{column} >= {arg(low)}')
+            if high is not None:
+                conditions.append(f'vm.{column} <= {arg(high)}')
+        disk_conditions = []
+        if query.disk_size_min is not None:
+            disk_conditions.append(f'd.size >= {arg(query.disk_size_min)}')
+        if query.disk_size_max is not None:
+            disk_conditions.append(f'd.size <= {arg(query.disk_size_max)}')
+        if disk_conditions:
+            conditions.append(f'EXISTS (SELECT 1 FROM disks d WHERE d.vm_id = vm.id AND {" AND ".join(disk_conditions)})')
+
+        # При равных значениях поля сортировки порядок задает vm_id
+        order_keys = [f"{query.sort}{' DESC' if query.descending else ''}"]
+        if query.sort != 'vm_id':
+            order_keys.append('vm_id')
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        async with self._acquire() as conn:
+            row = await conn.fetchrow(f'''
+                WITH page AS (
+                    SELECT vm.* FROM virtual_machines vm
+                    {where}
+                    ORDER BY {', '.join('vm.' + key for key in order_keys)}
+                    LIMIT {arg(query.limit)}
+                ), docs AS (
+                    SELECT page.vm_id, page.ram, page.cpu, {VM_DOCUMENT_SQL} AS doc
+                    FROM page
+                    LEFT JOIN disks disk ON page.id = disk.vm_id
+                    GROUP BY page.id, page.vm_id, page.ram, page.cpu
+                )
+                SELECT {page_document_sql(ndjson, ', '.join(order_keys))} AS body, count(*) AS total
+                FROM docs
+            ''', *args)
+        return row['body'], row['total']
+
+    async def iter_vm_documents(self, vms: List[VirtualMachine]) -> AsyncIterator[RawJSON]:
+        """Диски всех переданных ВМ выбираются одним запросом, документы идут в порядке списка"""
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                async for row in conn.cursor('''
+                    SELECT json_build_object(
+                        'vm_id', ids.vm_id,
+                        'ram', ids.ram,
+                        'cpu', ids.cpu,
+                        'disks', COALESCE(json_agg(disk.*) FILTER (WHERE disk.id IS NOT NULL), '[]')
+                    )::text AS doc
+                    FROM unnest($1::varchar[], $2::integer[], $3::integer[])
+                        WITH ORDINALITY AS ids(vm_id, ram, cpu, ord)
+                    LEFT JOIN virtual_machines vm ON vm.vm_id = ids.vm_id
+                    LEFT JOIN disks disk ON disk.vm_id = vm.id
+                    GROUP BY ids.vm_id, ids.ram, ids.cpu, ids.ord
+                    ORDER BY ids.ord
+                ''', [vm.vm_id for vm in vms], [vm.ram for vm in vms], [vm.cpu for vm in vms],
+                        prefetch=LIST_PREFETCH):
+                    yield RawJSON(row['doc'])
+
+    async def iter_all_disks(self) -> AsyncIterator[RawJSON]:
+        """Потоковое чтение всех дисков серверным курсором"""
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                async for row in conn.cursor(f'''
+                    SELECT {DISK_DOCUMENT_SQL} AS doc FROM disks
+                    JOIN virtual_machines ON disks.vm_id = virtual_machines.id
+                    ORDER BY disks.disk_id
+                ''', prefetch=LIST_PREFETCH):
+                    yield RawJSON(row['doc'])
+
+    async def get_disks_page(self, after: Optional[str], limit: int,
+                             ndjson: bool = False) -> Tuple[str, Optional[str], int]:
+        """Страница дисков одним документом, собранным в базе"""
+        async with self._acquire() as conn:
+            row = await conn.fetchrow(f'''
+                WITH docs AS (
+                    SELECT disks.disk_id, {DISK_DOCUMENT_SQL} AS doc FROM disks
+                    JOIN virtual_machines ON disks.vm_id = virtual_machines.id
+                    WHERE $1::varchar IS NULL OR disks.disk_id > $1
+                    ORDER BY disks.disk_id
+                    LIMIT $2
+                )
+                SELECT {page_document_sql(ndjson, 'disk_id')} AS body, max(disk_id) AS last_key, count(*) AS total
+                FROM docs
+            ''', after, limit)
+        return row['body'], row['last_key'], row['total']
+
+    async def get_totals(self) -> Dict[str, int]:
+        """Чтение одной строки итогов, которую поддерживают триггеры"""
+        async with self._acquire() as conn:
+            row = await conn.fetchrow("SELECT vms, ram, cpu, disks, disk_size FROM vm_totals")
+        return dict(row)
+
+    async def load_sessions(self) -> List[Session]:
+        async with self._acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT vm_id, ram, cpu, authorized, expires_at, disks, disk_size FROM vm_sessions ORDER BY seq
+            ''')
+        return [Session(VirtualMachine(row['vm_id'], row['ram'], row['cpu'], []), row['authorized'], row['expires_at'],
+                        Usage(row['ram'] or 0, row['cpu'] or 0, row['disks'], row['disk_size']))
+                for row in rows]
+
+    async def save_session(self, vm: VirtualMachine, expires_at: Optional[float] = None):
+        """Запись подключения и уведомление процессов одним запросом; в уведомлении и диски ВМ для итогов"""
+        usage = vm_usage(vm)
+        async with self._acquire() as conn:
+            await conn.execute(f'''
+                WITH v AS (
+                    INSERT INTO vm_sessions (vm_id, ram, cpu, expires_at, disks, disk_size)
+                    VALUES ($3, $4, $5, $6, $7, $8)
+                    ON CONFLICT (vm_id) DO UPDATE
+                    SET ram = EXCLUDED.ram, cpu = EXCLUDED.cpu, expires_at = EXCLUDED.expires_at,
+                        disks = EXCLUDED.disks, disk_size = EXCLUDED.disk_size
+                    RETURNING vm_id, ram, cpu, disks, disk_size
+                )
+                SELECT pg_notify($1, (({CHANGE_EVENT_SQL})::jsonb
+                                      || jsonb_build_object('disks', v.disks, 'disk_size', v.disk_size))::text)
+                FROM v
+            ''', CHANGES_CHANNEL, 'connect', vm.vm_id, vm.ram, vm.cpu, expires_at, usage.disks, usage.disk_size)
+
+    async def touch_session(self, vm_id: str, expires_at: float) -> bool:
+        """Продление без уведомления: процессы узнают новый срок, только когда истекает старый"""
+        async with self._acquire() as conn:
+            return await conn.fetchval(
+                "UPDATE vm_sessions SET expires_at = $2 WHERE vm_id = $1 RETURNING true", vm_id, expires_at
+            ) is not None
+
+    async def expire_sessions(self, vm_ids: List[str], now: float) -> Tuple[List[str], Dict[str, float]]:
+        """Удаление истекших подключений и уведомление процессов одной транзакцией"""
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                expired = await conn.fetch('''
+                    DELETE FROM vm_sessions
+                    WHERE vm_id = ANY($1::varchar[]) AND expires_at <= $2
+                    RETURNING vm_id, ram, cpu
+                ''', vm_ids, now)
+                await self._notify_vms_changed(conn, 'expire', expired)
+                remaining = await conn.fetch('''
+                    SELECT vm_id, expires_at FROM vm_sessions WHERE vm_id = ANY($1::varchar[]) AND expires_at > $2
+                ''', vm_ids, now)
+        return [row['vm_id'] for row in expired], {row['vm_id']: row['expires_at'] for row in remaining}
+
+    async def set_authorized(self, vm_id: str, authorized: bool) -> bool:
+        """Изменение признака авторизации одним запросом; уведомление отправляется, только если признак изменился"""
+        async with self._acquire() as conn:
+            row = await conn.fetchrow(f'''
+                WITH current AS (
+                    SELECT vm_id FROM vm_sessions WHERE vm_id = $3
+                ), v AS (
+                    UPDATE vm_sessions SET authorized = $4
+                    WHERE vm_id = $3 AND authorized <> $4
+                    RETURNING vm_id, ram, cpu
+                )
+                SELECT EXISTS (SELECT 1 FROM current) AS found,
+                       (SELECT count(pg_notify($1, {CHANGE_EVENT_SQL})) FROM v) AS notified
+            ''', CHANGES_CHANNEL, 'authorize' if authorized else 'deauthorize', vm_id, authorized)
+        return row['found']
+
+    async def listen(self, on_event: Callable[[Dict[str, Any]], None], on_reset: Callable[[], Any]):
+        """Подписка на канал уведомлений отдельным соединением вне пула"""
+        self.notify_changes = True
+
+        def handle(conn, pid, channel, payload):
+            on_event(json.loads(payload))
+
+        async def reconnect():
+            while True:
+                await asyncio.sleep(LISTEN_RECONNECT_DELAY)
+                try:
+                    await subscribe()
+                    await on_reset()
+                    logger.info("Подписка на изменения общего состояния восстановлена")
+                    return
+                except Exception as e:
+                    logger.error("Ошибка восстановления подписки на изменения: %s", e)
+
+        def on_termination(conn):
+            if self.listener is conn:
+                logger.error("Соединение для уведомлений об изменениях потеряно")
+                self.listener = None
+                self.listener_task = asyncio.get_running_loop().create_task(reconnect())
+
+        async def subscribe():
+            conn = await asyncpg.connect(self.dsn)
+            await conn.add_listener(CHANGES_CHANNEL, handle)
+            conn.add_termination_listener(on_termination)
+            self.listener = conn
+
+        await subscribe()
+
+
+class MemoryStorage(Storage):
+    """Хранилище в памяти процесса для тестов и замеров накладных расходов сервера без базы.
+
+    Повторяет семантику PostgresStorage: суррогатные ключи id, ON CONFLICT DO NOTHING при добавлении,
+    порядок списков по vm_id и disk_id. Строки индексируются словарями по ключам, а для
+    keyset-пагинации поддерживаются отсортированные списки ключей.
+    """
+    backend = 'memory'
+
+    def __init__(self):
+        self.vms: Dict[str, Dict[str, Any]] = {}
+        self.vm_ids_by_pk: Dict[int, str] = {}
+        self.disks: Dict[str, Dict[str, Any]] = {}
+        # Диски ВМ по первичному ключу ВМ, в порядке добавления
+        self.disks_by_vm: Dict[int, Dict[str, Dict[str, Any]]] = {}
+        self.vm_keys: List[str] = []
+        self.disk_keys: List[str] = []
+        self.next_vm_pk = 1
+        self.next_disk_pk = 1
+        self.totals = ResourceTotals()
+
+    def stats(self) -> Dict[str, Any]:
+        return {'status': 'ok', 'backend': self.backend, 'vms': len(self.vms), 'disks': len(self.disks)}
+
+    def _insert_disk(self, disk_id: str, size: int, vm_pk: int):
+        row = {'id': self.next_disk_pk, 'disk_id': disk_id, 'size': size, 'vm_id': vm_pk}
+        self.next_disk_pk += 1
+        self.disks[disk_id] = row
+        self.disks_by_vm.setdefault(vm_pk, {})[disk_id] = row
+        bisect.insort(self.disk_keys, disk_id)
+        self.totals.add_disks(1, size or 0)
+
+    async def add_vms(self, vms: List[VirtualMachine]) -> List[str]:
+        added = []
+        for vm in vms:
+            if vm.vm_id not in self.vms:
+                self.vms[vm.vm_id] = {'id': self.next_vm_pk, 'vm_id': vm.vm_id, 'ram': vm.ram, 'cpu': vm.cpu}
+                self.vm_ids_by_pk[self.next_vm_pk] = vm.vm_id
+                self.next_vm_pk += 1
+                bisect.insort(self.vm_keys, vm.vm_id)
+                self.totals.add(Usage(vm.ram or 0, vm.cpu or 0, 0, 0))
+                added.append(vm.vm_id)
+        for vm in vms:
+            vm_pk = self.vms[vm.vm_id]['id']
+            for disk in vm.disks:
+                if disk.disk_id not in self.disks:
+                    self._insert_disk(disk.disk_id, disk.size, vm_pk)
+        return added
+
+    async def update_vm(self, vm: VirtualMachine):
+        row = self.vms.get(vm.vm_id)
+        if row is None:
+            raise Exception("ВМ не найдена в базе данных")
+        self.totals.ram += (vm.ram or 0) - (row['ram'] or 0)
+        self.totals.cpu += (vm.cpu or 0) - (row['cpu'] or 0)
+        row['ram'] = vm.ram
+        row['cpu'] = vm.cpu
+        for disk in vm.disks:
+            existing = self.disks.get(disk.disk_id)
+            if existing is None:
+                self._insert_disk(disk.disk_id, disk.size, row['id'])
+            else:
+                self.totals.add_disks(0, (disk.size or 0) - (existing['size'] or 0))
+                existing['size'] = disk.size
+
+    async def write_vms(self, adds: List[VirtualMachine], updates: List[VirtualMachine]) -> Tuple[List[str], List[str]]:
+        added = await self.add_vms(adds)
+        updated = []
+        for vm in updates:
+            if vm.vm_id in self.vms:
+                await self.update_vm(vm)
+                updated.append(vm.vm_id)
+        return added, updated
+
+    def _vm_document(self, row: Dict[str, Any]) -> RawJSON:
+        disks = list(self.disks_by_vm.get(row['id'], {}).values())
+        return RawJSON(json_dumps({**row, 'disks': disks}).decode())
+
+    def _disk_document(self, row: Dict[str, Any]) -> RawJSON:
+        return RawJSON(json_dumps({**row, 'vm_id': self.vm_ids_by_pk[row['vm_id']]}).decode())
+
+    def _keys_after(self, keys: List[str], after: Optional[str]):
+        """Ключи строго больше after; устойчиво к вставкам во время обхода"""
+        position = 0 if after is None else bisect.bisect_right(keys, after)
+        while position < len(keys):
+            key = keys[position]
+            yield key
+            position = bisect.bisect_right(keys, key)
+
+    async def get_totals(self) -> Dict[str, int]:
+        return self.totals.as_dict()
+
+    async def iter_all_vms(self) -> AsyncIterator[RawJSON]:
+        for vm_id in self._keys_after(self.vm_keys, None):
+            yield self._vm_document(self.vms[vm_id])
+
+    async def get_vms_page(self, after: Optional[str], limit: int,
+                           ndjson: bool = False) -> Tuple[str, Optional[str], int]:
+        keys = []
+        for vm_id in self._keys_after(self.vm_keys, after):
+            keys.append(vm_id)
+            if len(keys) == limit:
+                break
+        docs = [self._vm_document(self.vms[vm_id]) for vm_id in keys]
+        return join_documents(docs, ndjson), keys[-1] if keys else None, len(keys)
+
+    def _query_matches(self, row: Dict[str, Any], query: VMQuery) -> bool:
+        for value, low, high in ((row['ram'], query.ram_min, query.ram_max),
+                                 (row['cpu'], query.cpu_min, query.cpu_max)):
+            if (low is not None or high is not None) and value is None:
+                return False
+            if (low is not None and value < low) or (high is not None and value > high):
+                return False
+        if query.disk_size_min is not None or query.disk_size_max is not None:
+            return any(
+                disk['size'] is not None
+                and (query.disk_size_min is None or disk['size'] >= query.disk_size_min)
+                and (query.disk_size_max is None or disk['size'] <= query.disk_size_max)
+                for disk in self.disks_by_vm.get(row['id'], {}).values()
+            )
+        return True
+
+    async def query_vms(self, query: VMQuery, ndjson: bool = False) -> Tuple[str, int]:
+        """Префикс выбирается бинарным поиском по отсортированным vm_id, остальные фильтры — проходом по кандидатам"""
+        if query.prefix:
+            start = bisect.bisect_left(self.vm_keys, query.prefix)
+            upper = prefix_upper_bound(query.prefix)
+            end = bisect.bisect_left(self.vm_keys, upper) if upper is not None else len(self.vm_keys)
+            candidates = self.vm_keys[start:end]
+            if query.vm_ids is not None:
+                allowed = set(query.vm_ids)
+                candidates = [vm_id for vm_id in candidates if vm_id in allowed]
+        elif query.vm_ids is not None:
+            candidates = [vm_id for vm_id in set(query.vm_ids) if vm_id in self.vms]
+        else:
+            candidates = self.vm_keys
+        rows = [self.vms[vm_id] for vm_id in candidates if self._query_matches(self.vms[vm_id], query)]
+        # Порядок как в базе: по vm_id при равенстве, NULL последними по возрастанию
+        rows.sort(key=lambda row: row['vm_id'])
+        if query.sort == 'vm_id':
+            rows.sort(key=lambda row: row['vm_id'], reverse=query.descending)
+        else:
+            rows.sort(key=lambda row: (row[query.sort] is None, row[query.sort] or 0), reverse=query.descending)
+        docs = [self._vm_document(row) for row in rows[:query.limit]]
+        return join_documents(docs, ndjson), len(docs)
+
+    async def iter_vm_documents(self, vms: List[VirtualMachine]) -> AsyncIterator[RawJSON]:
+        for vm in vms:
+            row = self.vms.get(vm.vm_id)
+            disks = list(self.disks_by_vm.get(row['id'], {}).values()) if row else []
+            yield RawJSON(json_dumps({'vm_id': vm.vm_id, 'ram': vm.ram, 'cpu': vm.cpu, 'disks': disks}).decode())
+
+    async def iter_all_disks(self) -> AsyncIterator[RawJSON]:
+        for disk_id in self._keys_after(self.disk_keys, None):
+            yield self._disk_document(self.disks[disk_id])
+
+    async def get_disks_page(self, after: Optional[str], limit: int,
+                             ndjson: bool = False) -> Tuple[str, Optional[str], int]:
+        keys = []
+        for disk_id in self._keys_after(self.disk_keys, after):
+            keys.append(disk_id)
+            if len(keys) == limit:
+                break
+        docs = [self._disk_document(self.disks[disk_id]) for disk_id in keys]
+        return join_documents(docs, ndjson), keys[-1] if keys else None, len(keys)
+
+
+STORAGE_CLASSES: Dict[str, Type[Storage]] = {
+    'postgres': PostgresStorage,
+    'memory': MemoryStorage,
+}
+
+
+def storage_class(backend: str = STORAGE_BACKEND) -> Type[Storage]:
+    """Класс хранилища по имени: postgres или memory"""
+    if backend not in STORAGE_CLASSES:
+        raise ValueError(f"Неизвестное хранилище: {backend}")
+    return STORAGE_CLASSES[backend]
+
+
+def create_storage(backend: str = STORAGE_BACKEND) -> Storage:
+    """Создание хранилища по имени: postgres или memory"""
+    return storage_class(backend)()
@@ -0,0 +1,5 @@
+import os
+
+# По умолчанию тесты работают с хранилищем в памяти и не требуют PostgreSQL.
+# Для прогона на реальной базе: STORAGE_BACKEND=postgres DATABASE_URL=... pytest
+os.environ.setdefault("STORAGE_BACKEND", "memory")
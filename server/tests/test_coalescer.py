@@ -0,0 +1,85 @@
+import asyncio
+
+from coalescer import WriteCoalescer
+from models import Disk, VirtualMachine
+
+
+def vm(vm_id: str, *disk_ids: str) -> VirtualMachine:
+    return VirtualMachine(vm_id, 1024, 2, [Disk(disk_id, 10) for disk_id in disk_ids])
+
+
+class RecordingFlush:
+    """Применение пакетов, которое запоминает их состав и отклоняет обновления ВМ из failing"""
+
+    def __init__(self, failing=()):
+        self.batches = []
+        self.failing = set(failing)
+
+    async def __call__(self, batch):
+        self.batches.append([(write.kind, write.vm.vm_id) for write in batch])
+        await asyncio.sleep(0)
+        return [ValueError(write.vm.vm_id) if write.vm.vm_id in self.failing else write.vm.vm_id for write in batch]
+
+
+async def test_concurrent_writes_share_one_batch_with_own_results():
+    flush = RecordingFlush(failing={'vm-2'})
+    writes = WriteCoalescer(flush, window=0.01, max_batch=100)
+
+    results = await asyncio.gather(
+        writes.submit('add', vm('vm-1', 'disk-1')),
+        writes.submit('update', vm('vm-2')),
+        writes.submit('add', vm('vm-3', 'disk-3')),
+        return_exceptions=True,
+    )
+
+    assert flush.batches == [[('add', 'vm-1'), ('update', 'vm-2'), ('add', 'vm-3')]]
+    assert results[0] == 'vm-1' and results[2] == 'vm-3'
+    assert isinstance(results[1], ValueError)
+    assert (writes.batches, writes.writes) == (1, 3)
+
+
+async def test_full_batch_does_not_wait_for_window():
+    flush = RecordingFlush()
+    writes = WriteCoalescer(flush, window=60, max_batch=2)
+
+    results = await asyncio.wait_for(asyncio.gather(writes.submit('add', vm('vm-1')), writes.submit('add', vm('vm-2'))), 1)
+    assert results == ['vm-1', 'vm-2']
+
+
+async def test_overlapping_writes_go_to_ordered_batches():
+    flush = RecordingFlush()
+    writes = WriteCoalescer(flush, window=0.01, max_batch=100)
+
+    await asyncio.gather(
+        writes.submit('add', vm('vm-1', 'disk-1')),
+        writes.submit('add', vm('vm-2', 'disk-2')),
+        # Та же ВМ или диск другой ВМ из набираемого пакета начинают следующий пакет
+        writes.submit('update', vm('vm-1', 'disk-1')),
+        writes.submit('update', vm('vm-3', 'disk-1')),
+    )
+
+    assert flush.batches == [
+        [('add', 'vm-1'), ('add', 'vm-2')],
+        [('update', 'vm-1')],
+        [('update', 'vm-3')],
+    ]
+
+
+async def test_failed_flush_fails_whole_batch():
+    async def flush(batch):
+        raise ConnectionError("нет соединения")
+
+    writes = WriteCoalescer(flush, window=0.01, max_batch=100)
+    results = await asyncio.gather(writes.submit('add', vm('vm-1')), writes.submit('add', vm('vm-2')),
+                                   return_exceptions=True)
+    assert all(isinstance(result, ConnectionError) for result in results)
+
+
+async def test_close_applies_pending_writes():
+    flush = RecordingFlush()
+    writes = WriteCoalescer(flush, window=60, max_batch=100)
+    pending = asyncio.ensure_future(writes.submit('add', vm('vm-1')))
+    await asyncio.sleep(0)
+
+    await writes.close()
+    assert await pending == 'vm-1'
@@ -0,0 +1,70 @@
+import pytest
+
+from events import EventBus
+
+
+async def test_slow_subscriber_is_dropped_without_blocking_publisher():
+    bus = EventBus(history_size=10, queue_size=2)
+    slow, _ = bus.subscribe()
+    fast, _ = bus.subscribe()
+
+    bus.publish('connect', {'vm_id': 'vm-1'})
+    bus.publish('connect', {'vm_id': 'vm-2'})
+    assert len(await fast.next_batch(0)) == 2
+    bus.publish('connect', {'vm_id': 'vm-3'})
+
+    assert slow.ended == 'overflow'
+    assert len(await slow.next_batch(0)) == 2
+    assert fast.ended is None
+    assert bus.subscriptions == {fast}
+    assert bus.dropped == 1
+
+    # Отключенный подписчик продолжает ленту из истории
+    resumed, ok = bus.subscribe(bus.event_id(2))
+    assert ok
+    assert await resumed.next_batch(0) == [bus.history[-1][2]]
+
+
+async def test_resume_from_evicted_event_requires_reset():
+    bus = EventBus(history_size=2, queue_size=10)
+    for n in range(3):
+        bus.publish('add', {'vm_id': f'vm-{n}'})
+
+    _, ok = bus.subscribe(bus.event_id(1))
+    assert not ok
+    subscription, ok = bus.subscribe(bus.event_id(2))
+    assert ok
+    assert len(await subscription.next_batch(0)) == 1
+
+
+async def test_resume_uses_delivery_order_for_shared_sequence():
+    bus = EventBus(epoch='')
+    bus.publish('connect', {'vm_id': 'vm-1'}, seq=11)
+    bus.publish('connect', {'vm_id': 'vm-2'}, seq=10)
+    bus.publish('connect', {'vm_id': 'vm-3'}, seq=12)
+
+    subscription, _ = bus.subscribe('11')
+    batch = await subscription.next_batch(0)
+    assert [payload.split(b'\n')[0] for payload in batch] == [b'id: 10', b'id: 12']
+
+
+async def test_resume_after_restart_requires_reset():
+    before = EventBus()
+    for n in range(3):
+        before.publish('add', {'vm_id': f'vm-{n}'})
+    last_id = before.event_id(2)
+    assert last_id == f"{before.epoch}-2"
+
+    # Новый процесс снова нумерует события с 1: номер из прошлой эпохи совпадает с новым событием
+    after = EventBus()
+    for n in range(3):
+        after.publish('add', {'vm_id': f'vm-new-{n}'})
+    subscription, ok = after.subscribe(last_id)
+    assert not ok
+    assert await subscription.next_batch(0) == []
+
+    _, ok = after.subscribe(after.event_id(2))
+    assert ok
+    for bad in ('', 'epoch-', 'abc'):
+        with pytest.raises(ValueError):
+            after.subscribe(bad)
@@ -0,0 +1,40 @@
+from expiry import ExpiryHeap
+
+
+def test_pop_due_returns_expired_in_deadline_order():
+    heap = ExpiryHeap()
+    heap.touch('vm-2', 20)
+    heap.touch('vm-1', 10)
+    heap.touch('vm-3', 30)
+
+    assert heap.next_deadline() == 10
+    assert heap.pop_due(25) == ['vm-1', 'vm-2']
+    assert len(heap) == 1
+    assert heap.next_deadline() == 30
+
+
+def test_extended_deadline_is_rescheduled_without_growing_heap():
+    heap = ExpiryHeap()
+    heap.touch('vm-1', 10)
+    for deadline in range(11, 111):
+        heap.touch('vm-1', deadline)
+    # Продление не добавляет записей в кучу
+    assert len(heap.heap) == 1
+
+    assert heap.pop_due(50) == []
+    assert heap.next_deadline() == 110
+    assert heap.pop_due(110) == ['vm-1']
+    assert len(heap) == 0
+
+
+def test_earlier_deadline_and_remove():
+    heap = ExpiryHeap()
+    heap.touch('vm-1', 50)
+    heap.touch('vm-1', 5)
+    assert heap.next_deadline() == 5
+
+    heap.touch('vm-2', 1)
+    heap.remove('vm-2')
+    assert heap.next_deadline() == 5
+    assert heap.pop_due(100) == ['vm-1']
+    assert heap.next_deadline() is None
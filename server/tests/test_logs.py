@@ -0,0 +1,116 @@
+import contextvars
+import io
+import json
+import logging
+import sys
+
+import pytest
+
+import logs
+from logs import JsonFormatter, SampledLogger, setup_logging, start_request, stop_logging
+from server import init_app
+
+
+@pytest.fixture
+def log_output():
+    """Логи через очередь в буфер; после теста возвращаются обработчики pytest"""
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    output = io.StringIO()
+    setup_logging('INFO', 'json', output)
+
+    def lines():
+        # Остановка потока вывода дописывает записи, оставшиеся в очереди
+        stop_logging()
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    yield lines
+    stop_logging()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def test_json_formatter():
+    try:
+        raise ValueError("сбой")
+    except ValueError:
+        record = logging.LogRecord('server', logging.ERROR, __file__, 1, "ВМ %s: %s", ('vm-1', 'ошибка'),
+                                   sys.exc_info())
+    record.request_id = 'req-1'
+    record.vm_count = 3
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert entry['level'] == 'ERROR'
+    assert entry['logger'] == 'server'
+    assert entry['message'] == "ВМ vm-1: ошибка"
+    assert entry['request_id'] == 'req-1'
+    assert entry['vm_count'] == 3
+    assert 'ValueError: сбой' in entry['exc']
+
+
+class ListHandler(logging.Handler):
+    def __init__(self, records: list):
+        super().__init__()
+        self.records = records
+
+    def emit(self, record: logging.LogRecord):
+        self.records.append(record)
+
+
+def test_sampled_logger_follows_request_decision():
+    records = []
+    logger = logging.getLogger('test_logs.sampled')
+    logger.handlers = [ListHandler(records)]
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    sampled = SampledLogger(logger, sample_rate=0.5)
+
+    def request(rate: float):
+        start_request(sample_rate=rate)
+        sampled.info("ВМ %s подключена", 'vm-1')
+        sampled.info("ВМ %s авторизована", 'vm-1')
+        logger.error("ВМ %s не найдена среди подключенных", 'vm-2')
+
+    contextvars.copy_context().run(request, 0)
+    # Запрос вне выборки: частые сообщения отброшены, ошибка записана
+    assert [record.getMessage() for record in records] == ["ВМ vm-2 не найдена среди подключенных"]
+
+    records.clear()
+    contextvars.copy_context().run(request, 1)
+    assert len(records) == 3
+    # Место вызова — код запроса, а не обертка SampledLogger
+    assert {record.funcName for record in records} == {'request'}
+
+
+def test_start_request_validates_client_id():
+    assert contextvars.copy_context().run(start_request, 'agent-42.retry:1') == 'agent-42.retry:1'
+    for bad in ('', 'id с пробелом', 'x' * 129):
+        generated = contextvars.copy_context().run(start_request, bad)
+        assert generated != bad and len(generated) == 16
+
+
+async def test_request_id_in_header_and_logs(aiohttp_client, log_output):
+    client = await aiohttp_client(await init_app())
+    vm_data = {"vm_id": "vm-log", "ram": 1024, "cpu": 2, "disks": [{"disk_id": "vm-log-disk", "size": 500}]}
+
+    resp = await client.post('/connect_vm', json=vm_data, headers={logs.REQUEST_ID_HEADER: 'agent-42'})
+    assert resp.status == 200
+    assert resp.headers[logs.REQUEST_ID_HEADER] == 'agent-42'
+
+    resp = await client.post('/authorize_vm', json={"vm_id": "vm-missing"})
+    generated = resp.headers[logs.REQUEST_ID_HEADER]
+    assert generated != 'agent-42'
+
+    # Ответ с ошибкой проверки тоже возвращает идентификатор
+    resp = await client.post('/add_vm', data=b'{')
+    assert resp.status == 400
+    assert resp.headers[logs.REQUEST_ID_HEADER]
+
+    await client.close()
+    entries = {entry['message']: entry for entry in log_output()}
+    assert entries["ВМ vm-log подключена"]['request_id'] == 'agent-42'
+    assert entries["ВМ vm-missing не найдена среди подключенных"]['request_id'] == generated
+    assert entries["ВМ vm-missing не найдена среди подключенных"]['level'] == 'ERROR'
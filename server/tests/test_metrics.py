@@ -0,0 +1,29 @@
+from metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('latency_seconds', 'Задержка', ('route',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.labels('/a').observe(value)
+
+    lines = histogram.render()
+    assert 'latency_seconds_bucket{route="/a",le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{route="/a",le="1"} 3' in lines
+    assert 'latency_seconds_bucket{route="/a",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{route="/a"} 3.65' in lines
+    assert 'latency_seconds_count{route="/a"} 4' in lines
+
+
+def test_registry_render_with_callbacks_and_escaping():
+    registry = Registry()
+    counter = registry.register(Counter('requests_total', 'Запросы', ('path',)))
+    counter.labels('/a"b').inc()
+    counter.labels('/a"b').inc(2)
+    registry.register(Gauge('pool_connections', 'Соединения', ('state',), lambda: {('idle',): 3}))
+    registry.register(Gauge('pool_saturation', 'Загрузка', (), lambda: {}))
+
+    text = registry.render()
+    assert '# TYPE requests_total counter\n' in text
+    assert 'requests_total{path="/a\\"b"} 3\n' in text
+    assert 'pool_connections{state="idle"} 3\n' in text
+    assert '# TYPE pool_saturation gauge\n' in text
@@ -0,0 +1,111 @@
+import json
+import os
+import uuid
+
+import asyncpg
+import pytest
+
+from migrations import LATEST_VERSION, MIGRATIONS, current_version, migrate
+from storage import DATABASE_URL
+
+pytestmark = pytest.mark.skipif(os.environ.get("STORAGE_BACKEND") != "postgres", reason="нужен PostgreSQL")
+
+
+@pytest.fixture
+async def conn():
+    """Соединение с отдельной пустой схемой, чтобы миграции применялись с нуля"""
+    conn = await asyncpg.connect(DATABASE_URL)
+    schema = f"test_migrations_{uuid.uuid4().hex}"
+    await conn.execute(f"CREATE SCHEMA {schema}; SET search_path TO {schema}")
+    try:
+        yield conn
+    finally:
+        await conn.execute(f"DROP SCHEMA {schema} CASCADE")
+        await conn.close()
+
+
+def index_names(plan) -> set:
+    """Индексы, которые использует план EXPLAIN (FORMAT JSON)"""
+    names = set()
+    if 'Index Name' in plan:
+        names.add(plan['Index Name'])
+    for child in plan.get('Plans', []):
+        names |= index_names(child)
+    return names
+
+
+async def explain_indexes(conn, query: str, *args) -> set:
+    # На тестовых таблицах из нескольких строк планировщик предпочел бы полный просмотр
+    async with conn.transaction():
+        await conn.execute("SET LOCAL enable_seqscan = off")
+        plan = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args)
+    return index_names(json.loads(plan)[0]['Plan'])
+
+
+async def test_migrations_upgrade_existing_schema_and_skip_warm_start(conn):
+    # Схема, созданная до появления миграций
+    await conn.execute(MIGRATIONS[0][2])
+    assert await current_version(conn) == 0
+
+    assert await migrate(conn) == [number for number, _, _ in MIGRATIONS]
+    assert await current_version(conn) == LATEST_VERSION
+    assert await migrate(conn) == []
+
+
+async def test_deleting_vm_deletes_its_disks(conn):
+    await migrate(conn)
+    vm_pk = await conn.fetchval("INSERT INTO virtual_machines (vm_id, ram, cpu) VALUES ('vm-1', 1024, 2) RETURNING id")
+    await conn.execute("INSERT INTO disks (disk_id, size, vm_id) VALUES ('disk-1', 10, $1)", vm_pk)
+
+    await conn.execute("DELETE FROM virtual_machines WHERE id = $1", vm_pk)
+    assert await conn.fetchval("SELECT count(*) FROM disks") == 0
+
+
+async def test_hot_queries_use_indexes(conn):
+    await migrate(conn)
+    await conn.execute("ANALYZE virtual_machines; ANALYZE disks")
+
+    assert 'disks_vm_id_idx' in await explain_indexes(conn, "SELECT * FROM disks WHERE vm_id = $1", 1)
+    assert 'disks_vm_id_idx' in await explain_indexes(conn, """
+        SELECT page.id, count(disk.id) FROM virtual_machines page
+        LEFT JOIN disks disk ON page.id = disk.vm_id
+        WHERE page.vm_id > $1
+        GROUP BY page.id
+    """, '')
+    assert 'virtual_machines_ram_idx' in await explain_indexes(
+        conn, "SELECT * FROM virtual_machines WHERE ram >= $1", 1024)
+    assert 'virtual_machines_cpu_idx' in await explain_indexes(
+        conn, "SELECT * FROM virtual_machines WHERE cpu = $1", 2)
+    assert 'virtual_machines_vm_id_pattern_idx' in await explain_indexes(
+        conn, "SELECT * FROM virtual_machines WHERE vm_id ~>=~ $1 AND vm_id ~<~ $2", 'vm-', 'vm.')
+    assert 'disks_size_idx' in await explain_indexes(conn, "SELECT * FROM disks WHERE size >= $1", 1000)
+
+
+async def test_totals_follow_writes(conn):
+    async def totals():
+        return dict(await conn.fetchrow("SELECT vms, ram, cpu, disks, disk_size FROM vm_totals"))
+
+    async def aggregate():
+        return dict(await conn.fetchrow('''
+            SELECT (SELECT count(*) FROM virtual_machines) AS vms,
+                   (SELECT coalesce(sum(ram), 0) FROM virtual_machines) AS ram,
+                   (SELECT coalesce(sum(cpu), 0) FROM virtual_machines) AS cpu,
+                   (SELECT count(*) FROM disks) AS disks,
+                   (SELECT coalesce(sum(size), 0) FROM disks) AS disk_size
+        '''))
+
+    # Итоги по данным, записанным до миграции, считаются при ее применении
+    await conn.execute(MIGRATIONS[0][2])
+    await conn.execute("INSERT INTO virtual_machines (vm_id, ram, cpu) VALUES ('vm-0', 256, 1)")
+    await migrate(conn)
+    assert await totals() == await aggregate()
+
+    await conn.execute("""
+        INSERT INTO virtual_machines (vm_id, ram, cpu) VALUES ('vm-1', 1024, 2), ('vm-2', 2048, 4);
+        INSERT INTO disks (disk_id, size, vm_id) SELECT 'disk-' || id, 100, id FROM virtual_machines;
+        INSERT INTO disks (disk_id, size, vm_id) SELECT 'disk-' || id, 500, id FROM virtual_machines
+        ON CONFLICT (disk_id) DO UPDATE SET size = EXCLUDED.size;
+        UPDATE virtual_machines SET ram = ram * 2 WHERE vm_id = 'vm-1';
+        DELETE FROM virtual_machines WHERE vm_id = 'vm-2';
+    """)
+    assert await totals() == await aggregate() == {"vms": 2, "ram": 2304, "cpu": 3, "disks": 2, "disk_size": 1000}
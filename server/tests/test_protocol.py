@@ -0,0 +1,95 @@
+import asyncio
+import json
+
+import msgpack
+import pytest
+
+from protocol import HEADER, FrameDecoder, FrameTooLarge, decode_body, encode_frame, serve
+from server import VMManager, protocol_handlers
+from storage import MemoryStorage
+
+
+@pytest.fixture
+async def protocol_server():
+    manager = VMManager(MemoryStorage(), shared_state=False)
+    await manager.init_db()
+    connections = set()
+    server = await serve(protocol_handlers(manager), '127.0.0.1', 0, manager.metrics, connections=connections)
+    yield manager, server.sockets[0].getsockname()[1]
+    server.close()
+    for connection in list(connections):
+        connection.close()
+    await server.wait_closed()
+    await manager.close_db()
+
+
+async def read_response(reader: asyncio.StreamReader):
+    (size,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return decode_body(await reader.readexactly(size))
+
+
+def vm_data(vm_id: str):
+    return {"vm_id": vm_id, "ram": 1024, "cpu": 2, "disks": [{"disk_id": f"{vm_id}-disk", "size": 500}]}
+
+
+def test_frame_decoder_splits_stream():
+    decoder = FrameDecoder(max_frame=32)
+    stream = encode_frame([1, 'health', None], False) + encode_frame([2, 'health', None], True)
+    assert decoder.feed(stream[:3]) == []
+    frames = decoder.feed(stream[3:-1]) + decoder.feed(stream[-1:])
+    assert [decode_body(frame) for frame in frames] == [([1, 'health', None], False), ([2, 'health', None], True)]
+
+    with pytest.raises(FrameTooLarge):
+        decoder.feed(HEADER.pack(33))
+
+
+async def test_pipelined_requests_run_in_order(protocol_server):
+    manager, port = protocol_server
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    # Все запросы отправляются одной записью, не дожидаясь ответов
+    writer.write(b''.join(encode_frame(message, True) for message in [
+        [1, 'add_vm', vm_data('vm-tcp')],
+        [2, 'connect_vm', vm_data('vm-tcp')],
+        [3, 'authorize_vm', {'vm_id': 'vm-tcp'}],
+        [4, 'heartbeat', {'vm_id': 'vm-missing'}],
+        [5, 'stats', None],
+    ]))
+    responses = [await read_response(reader) for _ in range(5)]
+    writer.close()
+
+    assert [response for response, _ in responses[:4]] == [
+        [1, 200, "ВМ добавлена"],
+        [2, 200, "ВМ подключена"],
+        [3, 200, "ВМ авторизована"],
+        [4, 404, "ВМ vm-missing не найдена среди подключенных"],
+    ]
+    assert all(binary for _, binary in responses)
+    assert responses[4][0][2]['authorized']['vms'] == 1
+    assert manager.authorized_vms == {'vm-tcp'}
+    assert manager.metrics.protocol_requests.labels('connect_vm', '200').value == 1
+
+
+async def test_json_requests_and_errors_keep_connection(protocol_server):
+    manager, port = protocol_server
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(encode_frame([1, 'connect_vm', {'vm_id': 'vm-bad'}], False))
+    writer.write(HEADER.pack(9) + b'[not json')
+    writer.write(encode_frame([3, 'drop_tables', None], False))
+    writer.write(HEADER.pack(len(json.dumps([4, 'health', None]))) + json.dumps([4, 'health', None]).encode())
+
+    responses = [await read_response(reader) for _ in range(4)]
+    writer.close()
+
+    assert [(message[0], message[1]) for message, _ in responses] == [(1, 400), (None, 400), (3, 404), (4, 200)]
+    assert not any(binary for _, binary in responses)
+    assert responses[3][0][2] == "OK"
+    assert 'vm-bad' not in manager.connected_vms
+    assert manager.metrics.protocol_requests.labels('unknown', '404').value == 1
+
+
+async def test_oversized_frame_closes_connection(protocol_server):
+    _, port = protocol_server
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(HEADER.pack(1 << 30) + msgpack.packb([1, 'health', None]))
+    assert await reader.read() == b''
+    writer.close()
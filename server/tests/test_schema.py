@@ -0,0 +1,46 @@
+import re
+
+import pytest
+
+from models import Disk, VirtualMachine
+from schema import MAX_INT, ValidationError, decode_vm, decode_vm_id, parse_json
+
+
+def test_decode_vm():
+    vm = decode_vm({"vm_id": "vm-1", "ram": 1024, "cpu": 2, "extra": True,
+                    "disks": [{"disk_id": "disk-1", "size": 500, "id": 7}]})
+    assert isinstance(vm, VirtualMachine)
+    assert (vm.vm_id, vm.ram, vm.cpu, vm.disks) == ("vm-1", 1024, 2, (Disk("disk-1", 500),))
+    # Без __dict__: лишние поля не хранятся
+    assert not hasattr(vm, '__dict__') and not hasattr(vm.disks[0], '__dict__')
+    assert decode_vm({"vm_id": "vm-2", "ram": 0, "cpu": MAX_INT, "disks": []}).disks == ()
+
+
+@pytest.mark.parametrize("data, message", [
+    ([], "ожидается JSON-объект"),
+    ({"ram": 1, "cpu": 1, "disks": []}, "vm_id: обязательное поле"),
+    ({"vm_id": "", "ram": 1, "cpu": 1, "disks": []}, "vm_id: ожидается непустая строка"),
+    ({"vm_id": "v" * 51, "ram": 1, "cpu": 1, "disks": []}, "vm_id: длиннее 50 символов"),
+    ({"vm_id": "vm", "ram": "1024", "cpu": 1, "disks": []}, "ram: ожидается целое число"),
+    ({"vm_id": "vm", "ram": 1, "cpu": True, "disks": []}, "cpu: ожидается целое число"),
+    ({"vm_id": "vm", "ram": MAX_INT + 1, "cpu": 1, "disks": []}, "ram: ожидается целое число"),
+    ({"vm_id": "vm", "ram": 1, "cpu": -1, "disks": []}, "cpu: ожидается целое число"),
+    ({"vm_id": "vm", "ram": 1, "cpu": 1}, "disks: обязательное поле"),
+    ({"vm_id": "vm", "ram": 1, "cpu": 1, "disks": {}}, "disks: ожидается массив"),
+    ({"vm_id": "vm", "ram": 1, "cpu": 1, "disks": [{"disk_id": "d", "size": 1}, "d"]}, "disks[1]: ожидается JSON-объект"),
+    ({"vm_id": "vm", "ram": 1, "cpu": 1, "disks": [{"disk_id": "d"}]}, "disks[0].size: обязательное поле"),
+    ({"vm_id": "vm", "ram": 1, "cpu": 1, "disks": [{"disk_id": 5, "size": 1}]}, "disks[0].disk_id: ожидается непустая строка"),
+])
+def test_decode_vm_errors(data, message):
+    with pytest.raises(ValidationError, match=re.escape(message)):
+        decode_vm(data)
+
+
+def test_decode_vm_id_and_parse_json():
+    assert decode_vm_id(parse_json(b'{"vm_id": "vm-1"}')) == "vm-1"
+    with pytest.raises(ValidationError, match="vm_id: обязательное поле"):
+        decode_vm_id({})
+    with pytest.raises(ValidationError, match="некорректный JSON"):
+        parse_json(b'{"vm_id": ')
+    with pytest.raises(ValidationError, match="пустое тело"):
+        parse_json(b'')
@@ -1,7 +1,11 @@
 import pytest
 import asyncio
+import json
+import os
+import uuid
 from aiohttp import web
-from server import init_app, VMManager, VirtualMachine
+from server import init_app, VMManager, VirtualMachine, InventoryCache
+from storage import MemoryStorage
 
 @pytest.fixture
 async def client(aiohttp_client):
@@ -144,3 +148,506 @@ async def test_deauthorize_vm(client):
     assert resp.status == 200
     text = await resp.text()
     assert text == "ВМ деавторизована"
+
+async def test_health_check_verbose(client):
+    resp = await client.get('/health', params={'verbose': '1'})
+    assert resp.status == 200
+    json_resp = await resp.json()
+    assert json_resp['status'] == "OK"
+    assert json_resp['storage']['status'] == 'ok'
+    assert json_resp['storage']['backend'] in ('postgres', 'memory')
+
+async def test_add_and_update_vm_with_many_disks(client):
+    disks = [{"disk_id": f"disk-many-{n}", "size": 100} for n in range(20)]
+    vm_data = {"vm_id": "vm-many-disks", "ram": 1024, "cpu": 2, "disks": disks}
+    await client.post('/add_vm', json=vm_data)
+    await client.post('/connect_vm', json=vm_data)
+    await client.post('/authorize_vm', json={"vm_id": "vm-many-disks"})
+
+    updated_disks = [{"disk_id": disk["disk_id"], "size": 200} for disk in disks]
+    resp = await client.post('/update_vm', json={**vm_data, "disks": updated_disks})
+    assert resp.status == 200
+
+    resp = await client.get('/get_all_disks')
+    sizes = {disk['disk_id']: disk['size'] for disk in await resp.json() if disk['vm_id'] == "vm-many-disks"}
+    assert sizes == {disk["disk_id"]: 200 for disk in disks}
+
+async def test_get_connected_vms_includes_disks(client):
+    vm_data = {
+        "vm_id": "vm-with-disks",
+        "ram": 1024,
+        "cpu": 2,
+        "disks": [{"disk_id": "disk-a", "size": 100}, {"disk_id": "disk-b", "size": 200}]
+    }
+    unknown_vm = {"vm_id": "vm-not-in-db", "ram": 512, "cpu": 1, "disks": []}
+    await client.post('/add_vm', json=vm_data)
+    await client.post('/connect_vm', json=vm_data)
+    await client.post('/connect_vm', json=unknown_vm)
+    resp = await client.get('/get_connected_vms')
+    assert resp.status == 200
+    vms = {vm['vm_id']: vm for vm in await resp.json()}
+    assert sorted(disk['disk_id'] for disk in vms["vm-with-disks"]['disks']) == ["disk-a", "disk-b"]
+    assert vms["vm-not-in-db"]['disks'] == []
+
+async def test_add_vms_json_array(client):
+    vms = [
+        {"vm_id": f"vm-bulk-{n}", "ram": 1024, "cpu": 2, "disks": [{"disk_id": f"disk-bulk-{n}", "size": 100}]}
+        for n in range(5)
+    ]
+    resp = await client.post('/add_vms', json=vms + [{"vm_id": "vm-bulk-bad"}], params={'connect': '1'})
+    assert resp.status == 200
+    results = await resp.json()
+    assert [result['status'] for result in results] == ['ok'] * 5 + ['error']
+    assert results[-1]['vm_id'] == "vm-bulk-bad"
+
+    resp = await client.get('/get_connected_vms')
+    connected = {vm['vm_id'] for vm in await resp.json()}
+    assert {vm['vm_id'] for vm in vms} <= connected
+
+async def test_add_vms_ndjson(client):
+    lines = [
+        '{"vm_id": "vm-ndjson-1", "ram": 512, "cpu": 1, "disks": []}',
+        'not json',
+        '{"vm_id": "vm-ndjson-2", "ram": 512, "cpu": 1, "disks": [{"disk_id": "disk-ndjson-2", "size": 10}]}',
+    ]
+    resp = await client.post('/add_vms', data='\n'.join(lines) + '\n',
+                             headers={'Content-Type': 'application/x-ndjson'})
+    assert resp.status == 200
+    results = [json.loads(line) for line in (await resp.text()).splitlines()]
+    assert [result['status'] for result in results] == ['ok', 'error', 'ok']
+    assert resp.headers['X-Bulk-Errors'] == '1'
+
+async def test_add_vms_ndjson_long_and_empty(client):
+    prefix = f"vm-ndjson-{uuid.uuid4().hex[:8]}"
+    long_line = json.dumps({"vm_id": f"{prefix}-long", "ram": 1, "cpu": 1, "disks": [], "pad": "x" * (2 * 1024 * 1024)})
+    body = '\n'.join([
+        json.dumps({"vm_id": f"{prefix}-1", "ram": 512, "cpu": 1, "disks": []}),
+        long_line,
+        json.dumps({"vm_id": f"{prefix}-2", "ram": 512, "cpu": 1, "disks": []}),
+    ])
+    resp = await client.post('/add_vms', data=body, headers={'Content-Type': 'application/x-ndjson'})
+    assert resp.status == 200
+    results = [json.loads(line) for line in (await resp.text()).splitlines()]
+    assert [result['status'] for result in results] == ['ok', 'error', 'ok']
+    assert results[1]['error'] == "слишком длинная запись"
+    assert results[2]['vm_id'] == f"{prefix}-2"
+
+    resp = await client.post('/add_vms', data=b'', headers={'Content-Type': 'application/x-ndjson'})
+    assert resp.status == 200
+    assert await resp.text() == ''
+    assert resp.headers['X-Bulk-Ok'] == '0' and resp.headers['X-Bulk-Errors'] == '0'
+
+async def test_add_vms_rejects_malformed_array(client):
+    prefix = f"vm-array-{uuid.uuid4().hex[:8]}"
+    vm = json.dumps({"vm_id": f"{prefix}-0", "ram": 512, "cpu": 1, "disks": []})
+    for body in (f'[{vm} {vm}]', f'[,,{vm}]', f'[{vm},]', f'[{vm}] trailing', '[,]'):
+        resp = await client.post('/add_vms', data=body, headers={'Content-Type': 'application/json'})
+        assert resp.status == 200
+        results = await resp.json()
+        assert results[-1] == {'index': len(results) - 1, 'vm_id': None, 'status': 'error',
+                               'error': "некорректный JSON-массив"}, body
+
+    resp = await client.post('/add_vms', data=f' [ {vm} , {vm} ] \n', headers={'Content-Type': 'application/json'})
+    assert [result['status'] for result in await resp.json()] == ['ok', 'ok']
+    resp = await client.post('/add_vms', data='[]', headers={'Content-Type': 'application/json'})
+    assert await resp.json() == []
+
+async def test_add_vms_connect_error_is_per_record(client, monkeypatch):
+    manager = client.server.app['manager']
+    prefix = f"vm-bulk-connect-{uuid.uuid4().hex[:8]}"
+    vms = [{"vm_id": f"{prefix}-{n}", "ram": 512, "cpu": 1, "disks": []} for n in range(3)]
+    connect_vm = manager.connect_vm
+
+    async def failing_connect(vm):
+        if vm.vm_id == f"{prefix}-1":
+            raise Exception("база недоступна")
+        await connect_vm(vm)
+
+    monkeypatch.setattr(manager, 'connect_vm', failing_connect)
+    resp = await client.post('/add_vms', json=vms, params={'connect': '1'})
+    assert resp.status == 200
+    results = await resp.json()
+    assert [result['status'] for result in results] == ['ok', 'error', 'ok']
+    assert "база недоступна" in results[1]['error']
+    assert {f"{prefix}-0", f"{prefix}-2"} <= set(manager.connected_vms)
+
+async def test_get_all_vms_pagination(client):
+    vms = [{"vm_id": f"vm-page-{n}", "ram": 1024, "cpu": 2, "disks": []} for n in range(3)]
+    await client.post('/add_vms', json=vms)
+
+    resp = await client.get('/get_all_vms', params={'after': 'vm-page-', 'limit': '2'})
+    assert resp.status == 200
+    page = await resp.json()
+    assert [vm['vm_id'] for vm in page] == ["vm-page-0", "vm-page-1"]
+    assert resp.headers['X-Next-After'] == "vm-page-1"
+
+    resp = await client.get('/get_all_vms', params={'after': resp.headers['X-Next-After'], 'limit': '1'})
+    assert [vm['vm_id'] for vm in await resp.json()] == ["vm-page-2"]
+
+    resp = await client.get('/get_all_vms', params={'limit': '0'})
+    assert resp.status == 400
+
+    for path in ('/get_all_vms', '/get_all_disks'):
+        resp = await client.get(path, params={'after': 'vm-page-0'})
+        assert resp.status == 400
+        assert await resp.text() == "Параметр after требует параметра limit"
+
+async def test_cached_page_keeps_next_after(client):
+    prefix = f"vm-cached-page-{uuid.uuid4().hex[:8]}"
+    vms = [{"vm_id": f"{prefix}-{n}", "ram": 1024, "cpu": 2, "disks": [{"disk_id": f"{prefix}-disk-{n}", "size": 1}]}
+           for n in range(3)]
+    await client.post('/add_vms', json=vms)
+    cache = client.server.app['manager'].cache
+
+    for path, after, expected in (('/get_all_vms', prefix, f"{prefix}-1"),
+                                  ('/get_all_disks', f"{prefix}-disk", f"{prefix}-disk-1")):
+        first = await client.get(path, params={'after': after, 'limit': '2'})
+        hits = cache.hits
+        second = await client.get(path, params={'after': after, 'limit': '2'})
+        # Повторный запрос той же страницы отдается из кеша вместе с заголовком следующей страницы
+        assert cache.hits == hits + 1
+        assert first.headers['X-Next-After'] == second.headers['X-Next-After'] == expected
+        assert await first.read() == await second.read()
+
+async def test_get_all_disks_ndjson(client):
+    vm_data = {"vm_id": "vm-ndjson-disks", "ram": 1024, "cpu": 2, "disks": [{"disk_id": "disk-ndjson-x", "size": 5}]}
+    await client.post('/add_vm', json=vm_data)
+    resp = await client.get('/get_all_disks', params={'format': 'ndjson'})
+    assert resp.status == 200
+    assert resp.headers['Content-Type'].startswith('application/x-ndjson')
+    disks = [json.loads(line) for line in (await resp.text()).splitlines()]
+    assert {"id", "disk_id", "size", "vm_id"} <= set(disks[0])
+    assert any(disk['disk_id'] == "disk-ndjson-x" and disk['vm_id'] == "vm-ndjson-disks" for disk in disks)
+
+async def test_list_etag_and_not_modified(client):
+    resp = await client.get('/get_all_vms')
+    assert resp.status == 200
+    etag = resp.headers['ETag']
+
+    resp = await client.get('/get_all_vms', headers={'If-None-Match': etag})
+    assert resp.status == 304
+
+    vm_data = {"vm_id": "vm-etag", "ram": 1024, "cpu": 2, "disks": []}
+    await client.post('/add_vm', json=vm_data)
+    resp = await client.get('/get_all_vms', headers={'If-None-Match': etag})
+    assert resp.status == 200
+    assert resp.headers['ETag'] != etag
+    assert "vm-etag" in {vm['vm_id'] for vm in await resp.json()}
+
+async def test_connected_vms_cache_invalidated_on_connect(client):
+    resp = await client.get('/get_connected_vms')
+    assert await resp.json() == []
+    etag = resp.headers['ETag']
+
+    vm_data = {"vm_id": "vm-cache", "ram": 1024, "cpu": 2, "disks": []}
+    await client.post('/connect_vm', json=vm_data)
+    resp = await client.get('/get_connected_vms', headers={'If-None-Match': etag})
+    assert resp.status == 200
+    assert [vm['vm_id'] for vm in await resp.json()] == ["vm-cache"]
+
+    resp = await client.get('/get_authorized_vms')
+    assert await resp.json() == []
+    await client.post('/authorize_vm', json={"vm_id": "vm-cache"})
+    resp = await client.get('/get_authorized_vms')
+    assert [vm['vm_id'] for vm in await resp.json()] == ["vm-cache"]
+
+def test_inventory_cache_eviction_and_invalidation():
+    cache = InventoryCache(max_entries=2, max_bytes=1024, max_entry_bytes=512)
+    scopes = ('vms',)
+    tag = cache.tag(scopes)
+    for n in range(3):
+        cache.put((f'/list-{n}', scopes), tag, b'x' * 10, 'application/json')
+    assert cache.get(('/list-0', scopes), tag) is None
+    assert cache.get(('/list-2', scopes), tag) == (b'x' * 10, 'application/json', {})
+
+    cache.put(('/big', scopes), tag, b'x' * 600, 'application/json')
+    assert cache.get(('/big', scopes), tag) is None
+
+    cache.invalidate('vms')
+    assert cache.get(('/list-2', scopes), cache.tag(scopes)) is None
+
+async def test_metrics(client):
+    vm_data = {"vm_id": "vm-metrics", "ram": 1024, "cpu": 2, "disks": [{"disk_id": "disk-metrics", "size": 500}]}
+    await (await client.post('/add_vm', json=vm_data)).read()
+    await (await client.get('/get_all_vms')).read()
+    await (await client.get('/no_such_route')).read()
+
+    resp = await client.get('/metrics')
+    assert resp.status == 200
+    assert resp.headers['Content-Type'].startswith('text/plain')
+    text = await resp.text()
+    assert 'vm_http_requests_total{route="/add_vm",method="POST",status="200"} 1' in text
+    assert 'vm_http_requests_total{route="unmatched",method="GET",status="404"} 1' in text
+    assert 'vm_http_request_duration_seconds_count{route="/get_all_vms",method="GET"} 1' in text
+    assert 'vm_http_requests_in_flight{route="/metrics"} 1' in text
+    assert 'vm_storage_operation_duration_seconds_count{operation="add_vms"} 1' in text
+    assert 'vm_storage_operation_duration_seconds_count{operation="iter_all_vms"} 1' in text
+    assert 'vm_list_cache_requests_total{result="miss"} 1' in text
+
+async def test_query_vms(client):
+    prefix = f"vm-query-{uuid.uuid4().hex}-"
+    vms = [{"vm_id": f"{prefix}{n}", "ram": ram, "cpu": cpu, "disks": [{"disk_id": f"{prefix}{n}-d", "size": size}]}
+           for n, (ram, cpu, size) in enumerate([(1024, 2, 10), (4096, 8, 500), (8192, 8, 50), (2048, 4, 1000)])]
+    await client.post('/add_vms', json=vms)
+    for vm in vms[1:3]:
+        await client.post('/connect_vm', json=vm)
+    await client.post('/authorize_vm', json={"vm_id": f"{prefix}2"})
+
+    async def query(**params):
+        resp = await client.get('/query', params={'prefix': prefix, **params})
+        assert resp.status == 200
+        return [vm['vm_id'][len(prefix):] for vm in await resp.json()]
+
+    assert await query() == ['0', '1', '2', '3']
+    assert await query(ram_min=2048, cpu=8) == ['1', '2']
+    assert await query(disk_size_min=100, sort='-ram') == ['1', '3']
+    assert await query(sort='-cpu', limit=3) == ['1', '2', '3']
+    assert await query(state='connected', ram_max=4096) == ['1']
+    assert await query(state='authorized') == ['2']
+
+    resp = await client.get('/query', params={'prefix': f"{prefix}3", 'format': 'ndjson'})
+    assert [json.loads(line)['disks'][0]['size'] for line in (await resp.text()).splitlines()] == [1000]
+
+    for params in ({'ram': 'x'}, {'sort': 'disks'}, {'state': 'lost'}, {'limit': '0'}, {'ram_above': '1'}):
+        assert (await client.get('/query', params=params)).status == 400
+
+    # Точное значение и диапазон того же поля противоречат друг другу
+    for params in ({'ram': '1024', 'ram_min': '2048'}, {'cpu': '2', 'cpu_max': '1'},
+                   {'disk_size': '10', 'disk_size_min': '1', 'disk_size_max': '100'}):
+        resp = await client.get('/query', params=params)
+        assert resp.status == 400
+        field = next(iter(params))
+        assert await resp.text() == f"Параметр {field} нельзя сочетать с {field}_min и {field}_max"
+
+async def test_stats_follow_changes(client):
+    async def stats():
+        return await (await client.get('/stats')).json()
+
+    vm_id = f"vm-stats-{uuid.uuid4().hex}"
+    before = await stats()
+    vm_data = {"vm_id": vm_id, "ram": 1024, "cpu": 2,
+               "disks": [{"disk_id": f"{vm_id}-1", "size": 100}, {"disk_id": f"{vm_id}-2", "size": 50}]}
+    await client.post('/add_vm', json=vm_data)
+    await client.post('/connect_vm', json=vm_data)
+    await client.post('/authorize_vm', json={"vm_id": vm_id})
+    await client.post('/update_vm', json={**vm_data, "ram": 4096, "disks": [{"disk_id": f"{vm_id}-1", "size": 300}]})
+
+    after = await stats()
+    # Итоги по всем ВМ считаются от общего хранилища, поэтому сравнивается прирост
+    delta = {field: after['all'][field] - before['all'][field] for field in after['all']}
+    assert delta == {"vms": 1, "ram": 4096, "cpu": 2, "disks": 2, "disk_size": 350}
+    connected = {"vms": 1, "ram": 1024, "cpu": 2, "disks": 2, "disk_size": 150}
+    assert after['connected'] == connected
+    assert after['authorized'] == connected
+
+    await client.post('/deauthorize_vm', json={"vm_id": vm_id})
+    after = await stats()
+    assert after['connected'] == connected
+    assert after['authorized'] == {"vms": 0, "ram": 0, "cpu": 0, "disks": 0, "disk_size": 0}
+
+async def test_coalesced_writes(aiohttp_client):
+    manager = VMManager(write_coalesce_window=0.01)
+    client = await aiohttp_client(await init_app(manager))
+    prefix = f"vm-batch-{uuid.uuid4().hex}"
+    vms = [{"vm_id": f"{prefix}-{n}", "ram": 1024, "cpu": 2, "disks": [{"disk_id": f"{prefix}-{n}-disk", "size": 100}]}
+           for n in range(20)]
+    events, _ = manager.events.subscribe(types=['add', 'update'])
+
+    await asyncio.gather(*(client.post('/add_vm', json=vm) for vm in vms))
+    for vm in vms:
+        await client.post('/connect_vm', json=vm)
+        await client.post('/authorize_vm', json={"vm_id": vm['vm_id']})
+    # ВМ, которой нет в базе, не мешает обновлению остальных ВМ своего пакета
+    missing = {"vm_id": f"{prefix}-missing", "ram": 1, "cpu": 1, "disks": []}
+    await client.post('/connect_vm', json=missing)
+    await client.post('/authorize_vm', json={"vm_id": missing['vm_id']})
+    updates = [{**vm, "ram": 4096, "disks": [{**disk, "size": 500} for disk in vm['disks']]} for vm in vms + [missing]]
+    responses = await asyncio.gather(*(client.post('/update_vm', json=update) for update in updates))
+    assert all(response.status == 200 for response in responses)
+
+    resp = await client.get('/query', params={'prefix': prefix, 'limit': 100})
+    stored = await resp.json()
+    assert [vm['vm_id'] for vm in stored] == sorted(vm['vm_id'] for vm in vms)
+    assert all(vm['ram'] == 4096 and vm['disks'][0]['size'] == 500 for vm in stored)
+    assert manager.writes.writes == 41
+    assert manager.writes.batches < manager.writes.writes
+    if not manager.shared_state:
+        batch = await events.next_batch(0)
+        assert sum(b'event: add' in event for event in batch) == 20
+        assert sum(b'event: update' in event for event in batch) == 20
+
+async def test_invalid_bodies_return_400(client):
+    cases = [
+        ('/add_vm', b'{"vm_id": "vm-bad", "ram": 1024', "некорректный JSON"),
+        ('/add_vm', b'{"vm_id": "vm-bad", "ram": 1024, "cpu": 2}', "disks: обязательное поле"),
+        ('/connect_vm', b'{"vm_id": "vm-bad", "ram": "big", "cpu": 2, "disks": []}', "ram: ожидается целое число"),
+        ('/update_vm', b'{"vm_id": "vm-bad", "ram": 1, "cpu": 2, "disks": [{"size": 1}]}', "disks[0].disk_id: обязательное поле"),
+        ('/authorize_vm', b'[]', "ожидается JSON-объект"),
+        ('/heartbeat', b'{}', "vm_id: обязательное поле"),
+    ]
+    for path, body, message in cases:
+        resp = await client.post(path, data=body, headers={'Content-Type': 'application/json'})
+        assert resp.status == 400, path
+        assert message in await resp.text()
+    resp = await client.get('/get_connected_vms')
+    assert all(vm['vm_id'] != "vm-bad" for vm in await resp.json())
+
+def test_shared_state_requires_shared_storage():
+    with pytest.raises(ValueError, match="общее состояние"):
+        VMManager(MemoryStorage(), shared_state=True)
+
+def test_run_workers_rejects_memory_storage(monkeypatch):
+    import multiprocessing
+    import server
+
+    def fork(*args, **kwargs):
+        raise AssertionError("процесс запущен до проверки хранилища")
+
+    monkeypatch.setattr(server, 'STORAGE_BACKEND', 'memory')
+    monkeypatch.setattr(multiprocessing, 'Process', fork)
+    with pytest.raises(ValueError, match="общее состояние"):
+        server.run_workers(2)
+
+async def wait_for(condition, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "состояние не синхронизировано"
+        await asyncio.sleep(0.01)
+
+async def test_connection_expires_without_heartbeat(aiohttp_client):
+    manager = VMManager(MemoryStorage(), connection_ttl=0.2)
+    client = await aiohttp_client(await init_app(manager))
+    vm_id = f"vm-ttl-{uuid.uuid4().hex}"
+    vm_data = {"vm_id": vm_id, "ram": 1024, "cpu": 2, "disks": []}
+    await client.post('/add_vm', json=vm_data)
+    await client.post('/connect_vm', json=vm_data)
+    await client.post('/authorize_vm', json={"vm_id": vm_id})
+    events, _ = manager.events.subscribe(types=['expire'])
+
+    # Heartbeat продлевает подключение дольше исходного срока
+    for _ in range(4):
+        await asyncio.sleep(0.1)
+        assert (await client.post('/heartbeat', json={"vm_id": vm_id})).status == 200
+    assert vm_id in manager.authorized_vms
+
+    await wait_for(lambda: vm_id not in manager.connected_vms)
+    assert vm_id not in manager.authorized_vms
+    assert manager.expired == 1
+    assert b'event: expire' in (await events.next_batch(0))[0]
+    assert (await client.post('/heartbeat', json={"vm_id": vm_id})).status == 404
+    assert 'vm_connections_expired_total 1' in await (await client.get('/metrics')).text()
+
+@pytest.mark.skipif(os.environ.get("STORAGE_BACKEND") != "postgres", reason="нужен PostgreSQL")
+async def test_shared_state_between_workers():
+    first = VMManager(shared_state=True)
+    second = VMManager(shared_state=True)
+    await first.init_db()
+    await second.init_db()
+    first_events, _ = first.events.subscribe()
+    second_events, _ = second.events.subscribe()
+    try:
+        await first.connect_vm(VirtualMachine("vm-shared", 1024, 2, []))
+        await first.authorize_vm("vm-shared")
+        await wait_for(lambda: "vm-shared" in second.authorized_vms)
+        assert second.connected_vms["vm-shared"].ram == 1024
+        assert second.authorized_totals.as_dict() == first.authorized_totals.as_dict()
+
+        # Оба процесса получают одинаковую ленту с общими номерами событий
+        await wait_for(lambda: len(first_events.pending) == 2 and len(second_events.pending) == 2)
+        assert list(first_events.pending) == list(second_events.pending)
+        assert b'event: authorize' in first_events.pending[1]
+
+        tag = first.cache.tag(('state',))
+        await second.deauthorize_vm("vm-shared")
+        await wait_for(lambda: "vm-shared" not in first.authorized_vms)
+        assert first.cache.tag(('state',)) != tag
+
+        await second.authorize_vm("vm-unknown")
+        assert "vm-unknown" not in second.authorized_vms
+    finally:
+        async with first.storage._acquire() as conn:
+            await conn.execute("DELETE FROM vm_sessions WHERE vm_id = 'vm-shared'")
+        await first.close_db()
+        await second.close_db()
+
+async def read_event(resp):
+    """Следующее событие ленты: тип, id и данные"""
+    event = {}
+    while True:
+        line = (await asyncio.wait_for(resp.content.readline(), 2)).decode().rstrip('\n')
+        if not line:
+            if 'event' in event:
+                return event
+            continue
+        field, _, value = line.partition(': ')
+        if field in ('id', 'event', 'data'):
+            event[field] = json.loads(value) if field == 'data' else value
+
+async def test_events_stream_and_resume(client):
+    # Уникальный id: событие add публикуется только для ВМ, которой еще нет в хранилище
+    vm_id = f"vm-events-{uuid.uuid4().hex}"
+    vm_data = {"vm_id": vm_id, "ram": 1024, "cpu": 2, "disks": []}
+    resp = await client.get('/events')
+    assert resp.headers['Content-Type'] == 'text/event-stream'
+
+    await client.post('/add_vm', json=vm_data)
+    await client.post('/connect_vm', json=vm_data)
+    await client.post('/authorize_vm', json={"vm_id": vm_id})
+    await client.post('/authorize_vm', json={"vm_id": vm_id})
+    await client.post('/deauthorize_vm', json={"vm_id": vm_id})
+
+    events = [await read_event(resp) for _ in range(4)]
+    assert [event['event'] for event in events] == ['add', 'connect', 'authorize', 'deauthorize']
+    epoch = client.server.app['manager'].events.epoch
+    assert [event['id'] for event in events] == [f"{epoch}-{seq}" for seq in (1, 2, 3, 4)]
+    assert events[1]['data'] == {"seq": 2, "vm_id": vm_id, "ram": 1024, "cpu": 2}
+    resp.close()
+
+    resumed = await client.get('/events', headers={'Last-Event-ID': events[1]['id']})
+    assert [(await read_event(resumed))['event'] for _ in range(2)] == ['authorize', 'deauthorize']
+    resumed.close()
+
+    filtered = await client.get('/events', params={'after': events[0]['id'], 'types': 'authorize'})
+    assert (await read_event(filtered))['id'] == events[2]['id']
+    filtered.close()
+
+    lost = await client.get('/events', headers={'Last-Event-ID': f"{epoch}-999"})
+    assert (await read_event(lost))['event'] == 'reset'
+    lost.close()
+
+    # id до перезапуска сервера: номер совпадает, но эпоха другая
+    restarted = await client.get('/events', headers={'Last-Event-ID': 'old-2'})
+    reset = await read_event(restarted)
+    assert reset['event'] == 'reset'
+    assert reset['data'] == {"seq": 4, "id": f"{epoch}-4"}
+    restarted.close()
+
+    assert (await client.get('/events', headers={'Last-Event-ID': 'x-y'})).status == 400
+
+    assert (await client.get('/events?types=unknown')).status == 400
+
+@pytest.mark.skipif(os.environ.get("STORAGE_BACKEND") != "postgres", reason="нужен PostgreSQL")
+async def test_shared_expiry_between_workers():
+    first = VMManager(shared_state=True, connection_ttl=0.3)
+    second = VMManager(shared_state=True, connection_ttl=0.3)
+    await first.init_db()
+    await second.init_db()
+    vm_id = f"vm-shared-ttl-{uuid.uuid4().hex}"
+    try:
+        await first.connect_vm(VirtualMachine(vm_id, 1024, 2, []))
+        await wait_for(lambda: vm_id in second.connected_vms)
+
+        # Heartbeat через второй процесс продлевает срок и для первого
+        for _ in range(4):
+            await asyncio.sleep(0.15)
+            assert await second.heartbeat(vm_id)
+        assert vm_id in first.connected_vms
+
+        await wait_for(lambda: vm_id not in first.connected_vms and vm_id not in second.connected_vms)
+        assert first.expired + second.expired == 1
+        assert not await first.heartbeat(vm_id)
+    finally:
+        async with first.storage._acquire() as conn:
+            await conn.execute("DELETE FROM vm_sessions WHERE vm_id = $1", vm_id)
+        await first.close_db()
+        await second.close_db()
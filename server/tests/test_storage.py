@@ -0,0 +1,100 @@
+import json
+
+import pytest
+
+from models import Disk, VirtualMachine
+from storage import MemoryStorage, PostgresStorage, SharedStorage, Storage, VMQuery, create_storage, prefix_upper_bound
+
+
+async def test_memory_storage_add_does_not_overwrite():
+    storage = MemoryStorage()
+    await storage.add_vms([VirtualMachine("vm-1", 1024, 2, [Disk("disk-1", 500)])])
+    await storage.add_vms([VirtualMachine("vm-1", 4096, 8, [Disk("disk-1", 900)])])
+
+    vms = [json.loads(doc) async for doc in storage.iter_all_vms()]
+    assert vms == [{"id": 1, "vm_id": "vm-1", "ram": 1024, "cpu": 2,
+                    "disks": [{"id": 1, "disk_id": "disk-1", "size": 500, "vm_id": 1}]}]
+
+
+async def test_memory_storage_update_vm():
+    storage = MemoryStorage()
+    await storage.add_vms([VirtualMachine("vm-1", 1024, 2, [Disk("disk-1", 500)])])
+    await storage.update_vm(VirtualMachine("vm-1", 2048, 4, [Disk("disk-1", 1000),
+                                                             Disk("disk-2", 10)]))
+
+    disks = [json.loads(doc) async for doc in storage.iter_all_disks()]
+    assert [(disk['disk_id'], disk['size'], disk['vm_id']) for disk in disks] == [
+        ("disk-1", 1000, "vm-1"), ("disk-2", 10, "vm-1")]
+
+    with pytest.raises(Exception, match="не найдена"):
+        await storage.update_vm(VirtualMachine("vm-missing", 1, 1, []))
+
+
+async def test_memory_storage_pages():
+    storage = MemoryStorage()
+    await storage.add_vms([VirtualMachine(f"vm-{n}", 1024, 2, []) for n in (3, 1, 2)])
+
+    body, last_key, total = await storage.get_vms_page(None, 2)
+    assert [vm['vm_id'] for vm in json.loads(body)] == ["vm-1", "vm-2"]
+    assert (last_key, total) == ("vm-2", 2)
+
+    body, last_key, total = await storage.get_vms_page(last_key, 2, ndjson=True)
+    assert [json.loads(line)['vm_id'] for line in body.splitlines()] == ["vm-3"]
+    assert (last_key, total) == ("vm-3", 1)
+
+
+def test_create_storage_rejects_unknown_backend():
+    assert isinstance(create_storage('memory'), MemoryStorage)
+    with pytest.raises(ValueError):
+        create_storage('mongodb')
+
+
+def test_storage_interfaces():
+    with pytest.raises(TypeError):
+        Storage()
+
+    class PartialStorage(Storage):
+        async def get_totals(self):
+            return {}
+
+    # Хранилище без всех основных операций не создается, а не падает при первом вызове
+    with pytest.raises(TypeError):
+        PartialStorage()
+    assert issubclass(PostgresStorage, SharedStorage)
+    assert not isinstance(MemoryStorage(), SharedStorage)
+
+
+async def test_memory_storage_totals():
+    storage = MemoryStorage()
+    await storage.add_vms([VirtualMachine("vm-1", 1024, 2, [Disk("disk-1", 500)]),
+                           VirtualMachine("vm-2", 512, 1, [])])
+    await storage.add_vms([VirtualMachine("vm-1", 4096, 8, [Disk("disk-1", 900)])])
+    await storage.update_vm(VirtualMachine("vm-2", 2048, 4, [Disk("disk-1", 100),
+                                                             Disk("disk-2", 10)]))
+
+    assert await storage.get_totals() == {"vms": 2, "ram": 3072, "cpu": 6, "disks": 2, "disk_size": 110}
+
+
+def test_prefix_upper_bound():
+    assert prefix_upper_bound("vm-") == "vm."
+    assert prefix_upper_bound("a\U0010ffff") == "b"
+    assert prefix_upper_bound("\ud7ff") == "\ue000"
+    assert prefix_upper_bound("") is None
+
+
+async def test_memory_storage_query():
+    storage = MemoryStorage()
+    await storage.add_vms([VirtualMachine(f"vm-{n}", ram, cpu, [Disk(f"disk-{n}", size)])
+                           for n, (ram, cpu, size) in enumerate([(1024, 2, 10), (4096, 8, 500), (4096, 4, 50)])])
+    await storage.add_vms([VirtualMachine("other", 4096, 8, [])])
+
+    async def query(**params):
+        body, total = await storage.query_vms(VMQuery(**params))
+        vms = json.loads(body)
+        assert len(vms) == total
+        return [vm['vm_id'] for vm in vms]
+
+    assert await query(prefix="vm-", ram_min=2048, sort='ram', descending=True) == ["vm-1", "vm-2"]
+    assert await query(cpu_max=4, disk_size_min=20) == ["vm-2"]
+    assert await query(vm_ids=["vm-0", "vm-2", "missing"], descending=True) == ["vm-2", "vm-0"]
+    assert await query(sort='cpu', limit=2) == ["vm-0", "vm-2"]